@@ -0,0 +1,168 @@
+'''Running camera series acquisitions in a dedicated thread.
+
+The camera server's command loop only hands the acquisition over to
+the camera's AcquisitionThread and goes back to taking commands. The
+acquisition thread does not handle commands, so frame draining is not
+delayed by them, and status queries and abort requests are answered
+while the camera acquires.
+
+States
+------
+    idle        No acquisition running
+    armed       The sequence started and the camera waits for
+                triggers (or the first frame)
+    acquiring   Frames are coming in
+    draining    The sequence stopped (or was aborted) and the frames
+                left in the buffer are read out
+'''
+
+import json
+import time
+import queue
+import threading
+
+STATES = ['idle', 'armed', 'acquiring', 'draining']
+
+
+class AcquisitionThread:
+    '''Runs the series acquisitions of one camera one after another.
+
+    Attributes
+    ----------
+    state : string
+        One of STATES
+    aborted : bool
+        True if an abort was requested for the current acquisition.
+        The acquisition function checks this between the frames.
+        An abort applies also to the queued acquisitions, which are
+        then skipped.
+    info : dict
+        Details of the current (or the latest) acquisition: "label",
+        "n_frames", "frame" (frames read so far) and "start_time".
+    '''
+
+    def __init__(self, name='camera'):
+        self.state = 'idle'
+        self.aborted = False
+        self.info = {}
+
+        self._jobs = queue.Queue()
+        # Numbering of the submitted jobs; The jobs up to
+        # _aborted_until are aborted
+        self._n_submitted = 0
+        self._aborted_until = 0
+        self._idle = threading.Event()
+        self._idle.set()
+        self._lock = threading.Lock()
+
+        self.thread = threading.Thread(
+                target=self._loop, name=f'acquisition-{name}', daemon=True)
+        self.thread.start()
+
+
+    def submit(self, function, args, label, n_frames, notify=None):
+        '''Queues an acquisition and returns immediately.
+
+        Arguments
+        ---------
+        function : callable
+            Called in the acquisition thread as
+            function(*args, notify=notify, acquisition=self)
+        args : tuple
+            Arguments for the function
+        label : string
+            Label of the acquisition (for status)
+        n_frames : int
+            Number of frames to acquire (for status)
+        notify : callable or None
+            Notifier that the acquisition thread takes over; It is
+            closed after the acquisition.
+        '''
+        with self._lock:
+            self._idle.clear()
+            self._n_submitted += 1
+            self._jobs.put(
+                    (self._n_submitted, function, args, label, n_frames, notify))
+
+
+    def _loop(self):
+        while True:
+            job = self._jobs.get()
+            if job is None:
+                break
+            i_job, function, args, label, n_frames, notify = job
+
+            with self._lock:
+                self.aborted = i_job <= self._aborted_until
+            self.info = {'label': label, 'n_frames': int(n_frames),
+                         'frame': 0, 'start_time': time.time()}
+            try:
+                if self.aborted:
+                    # Aborted while queued
+                    print(f'Acquisition {label} aborted before starting')
+                    if notify:
+                        notify('aborted')
+                else:
+                    function(*args, notify=notify, acquisition=self)
+            except Exception as e:
+                print(f'Acquisition {label} failed: {e}')
+                if notify:
+                    notify('error')
+            finally:
+                if notify:
+                    notify.close()
+                self.state = 'idle'
+                with self._lock:
+                    if self._jobs.empty():
+                        self._idle.set()
+
+
+    def set_state(self, state):
+        if state not in STATES:
+            raise ValueError(f'Unknown acquisition state {state}')
+        self.state = state
+
+
+    def frame_done(self):
+        '''Called by the acquisition function after each read frame.
+        '''
+        self.info['frame'] = self.info.get('frame', 0) + 1
+
+
+    def abort(self):
+        '''Requests the current acquisition to stop early.
+
+        The acquisitions queued so far are aborted too.
+
+        Returns True if an acquisition was running or queued.
+        '''
+        with self._lock:
+            if self._idle.is_set():
+                return False
+            self._aborted_until = self._n_submitted
+            self.aborted = True
+        return True
+
+
+    def wait_idle(self, timeout=None):
+        '''Waits until no acquisition is running or queued.
+
+        Returns True if idle, False if timed out.
+        '''
+        return self._idle.wait(timeout)
+
+
+    def status(self):
+        '''Returns the state and the acquisition details as JSON.
+        '''
+        status = {'state': self.state, 'aborted': self.aborted, **self.info}
+        if 'start_time' in status:
+            status['elapsed'] = time.time() - status['start_time']
+        return json.dumps(status)
+
+
+    def stop(self):
+        '''Stops the thread after the queued acquisitions.
+        '''
+        self._jobs.put(None)
+        self.thread.join()
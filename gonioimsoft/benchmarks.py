@@ -0,0 +1,169 @@
+'''Benchmarks for measuring the performance of GonioImsoft parts.
+
+Run all the benchmarks from the terminal
+
+    python -m gonioimsoft.benchmarks
+
+None of the benchmarks requires any hardware.
+'''
+
+import io
+import time
+import threading
+import contextlib
+
+import numpy as np
+
+from .common import UNIX_SOCKETS
+from .serverbase import ServerBase
+from .clientbase import ClientBase
+from .stimulus import camera_trains
+
+# The port used by the benchmark servers
+BENCHMARK_PORT = 50995
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values)//2]
+
+
+def transport_latency(n_commands=1000, port=BENCHMARK_PORT):
+    '''Measures the command round trip time over TCP and Unix sockets.
+
+    Starts a local server in a thread and sends it pong commands
+    that need a response back.
+
+    Arguments
+    ---------
+    n_commands : int
+        How many commands to send per transport.
+    port : int
+        The port used by the benchmark server.
+
+    Returns a dictionary where keys are transport names ("tcp" or
+    "unix") and values are the median round trip times in seconds.
+    '''
+    results = {}
+
+    # The server prints every command; Keep the output clean
+    with contextlib.redirect_stdout(io.StringIO()):
+        server = ServerBase('', port, None)
+        thread = threading.Thread(target=server.run)
+        thread.start()
+
+        client = ClientBase('127.0.0.1', port)
+        unix_path = client.unix_path
+
+        transports = ['tcp']
+        if UNIX_SOCKETS:
+            transports.append('unix')
+
+        for transport in transports:
+            if transport == 'tcp':
+                client.unix_path = None
+            else:
+                client.unix_path = unix_path
+
+            times = []
+            for i in range(n_commands):
+                start_time = time.perf_counter()
+                client.send_command(f'pong;{i}', listen=True)
+                times.append(time.perf_counter()-start_time)
+
+            results[transport] = _median(times)
+
+        client.send_command('exit;')
+        thread.join()
+
+    return results
+
+
+def _camera_loop(shifts, N_total_samples, samples_per_frame, N_frames):
+    # The camera triggers as StimulusBuilder.get_camera made them
+    # before camera_trains, one camera at a time
+    cameras = []
+    for ashift in shifts:
+        camera = np.concatenate( ( np.ones((samples_per_frame, N_frames)), np.zeros((samples_per_frame, N_frames)) ) )
+        camera = camera.T.flatten()
+        camera = 3.3*camera
+
+        if ashift:
+            a,b = np.split(camera, [ashift], axis=0)
+            camera = np.concatenate((b,a))
+
+        if len(camera) > N_total_samples:
+            camera = camera[0:N_total_samples]
+        elif len(camera) < N_total_samples:
+            camera = np.concatenate(
+                (camera, np.zeros(N_total_samples-len(camera)))
+                )
+        camera[-1] = 0
+        cameras.append(camera)
+    return cameras
+
+
+def camera_triggers(durations=(10, 100, 600), n_cameras=(1, 4, 16),
+        fs=10000, frame_length=0.01, n_repeats=3):
+    '''Measures making the interleaved camera trigger trains.
+
+    Compares the old loop (one camera at a time) to camera_trains
+    that makes all the cameras at once.
+
+    Arguments
+    ---------
+    durations : sequence
+        Recording lengths in seconds
+    n_cameras : sequence
+        Numbers of the cameras
+    fs : int
+        Sampling rate in Hz
+    frame_length : float
+        Frame length in seconds
+    n_repeats : int
+        How many times to make each (the median is taken)
+
+    Returns a list of dictionaries with keys "duration", "cameras",
+    "loop" and "vectorized" (median times in seconds).
+    '''
+    results = []
+    samples_per_frame = int(frame_length * fs / 2)
+    for duration in durations:
+        N_total_samples = int(duration * fs)
+        N_frames = int(round(duration/frame_length))
+        for N in n_cameras:
+            shifts = int(samples_per_frame*2/N) * np.arange(N)
+            
+            times = {'loop': [], 'vectorized': []}
+            for i in range(n_repeats):
+                start_time = time.perf_counter()
+                _camera_loop(shifts, N_total_samples, samples_per_frame, N_frames)
+                times['loop'].append(time.perf_counter()-start_time)
+
+                start_time = time.perf_counter()
+                trains = camera_trains(shifts, N_total_samples, samples_per_frame, N_frames)
+                trains[:, -1] = 0
+                times['vectorized'].append(time.perf_counter()-start_time)
+
+            results.append({
+                'duration': duration, 'cameras': N,
+                'loop': _median(times['loop']),
+                'vectorized': _median(times['vectorized'])})
+    return results
+
+
+def main():
+    print('Command round trip (median)')
+    for transport, latency in transport_latency().items():
+        print(f'  {transport: >8}    {1e6*latency:.1f} us')
+
+    print('Camera trigger trains (median)')
+    print(f'  {"duration": >8} {"cameras": >8} {"loop": >10} {"vectorized": >10}')
+    for result in camera_triggers():
+        print((
+            f'  {result["duration"]: >6} s {result["cameras"]: >8} '
+            f'{1e3*result["loop"]: >7.1f} ms {1e3*result["vectorized"]: >7.1f} ms'))
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ import atexit
 from .directories import CODE_ROOTDIR, USERDATA_DIR
 from .common import SERVER_HOSTNAME, CAMERA_PORT
 from .clientbase import ClientBase, run_client
+from .framestream import FrameSubscriber
 
 MAX_RETRIES = 100
 RETRY_INTERVAL = 1
@@ -29,17 +30,26 @@ class CameraClient(ClientBase):
     
     No big data is transmitted over the connection, only commands (strings).
     It is the CameraServer's job to store the images, and display them on
-    screen (livefeed) if needed.
+    screen (livefeed) if needed. Frames can be optionally streamed over
+    a separate connection, see the subscribe method.
     
     See also clientbase.py and camera_server.py for more information.
 
     Attributes
     ----------
     modified_settings : set
+    series_events : obj or None
+        EventListener of the latest acquireSeries or acquireSingle
+        command
+    device : string or None
+        If the server controls many cameras, the name of the camera
+        (device) that this client uses. None for the server's first
+        camera.
     '''
 
+    server_type = 'camera'
 
-    def __init__(self, host=None, port=None, running_index=0):
+    def __init__(self, host=None, port=None, running_index=0, device=None):
         
         if host is None:
             host = SERVER_HOSTNAME
@@ -49,9 +59,29 @@ class CameraClient(ClientBase):
 
         self.modified_settings = set()
         self._roi = None
+        self._camera = None
+        self.series_events = None
+        self.device = device
 
 
-    def acquireSeries(self, exposure_time, image_interval, N_frames, label, subdir):
+    def _address(self, command):
+        '''Adds the device to the command name ("name@device;...").
+        '''
+        if self.device is None or not isinstance(command, str):
+            return command
+        name, sep, parameters = command.partition(';')
+        return f'{name}@{self.device}{sep}{parameters}'
+
+
+    def send_command(self, command, *args, **kwargs):
+        return super().send_command(self._address(command), *args, **kwargs)
+
+    def send_event_command(self, command, *args, **kwargs):
+        return super().send_event_command(
+                self._address(command), *args, **kwargs)
+
+
+    def acquireSeries(self, exposure_time, image_interval, N_frames, label, subdir, frames_per_label=None):
         '''
         Acquire a time series of images.
         For more see camera_server.py.
@@ -59,16 +89,86 @@ class CameraClient(ClientBase):
         Notice that it is important to give a new label every time
         or to change data savedir, otherwise images may be written over
         each other (or error raised).
+
+        To acquire many protocol repeats as one series, give label as
+        a list of labels and frames_per_label. Each label gets its own
+        saved frames.
         '''
         function = 'acquireSeries;'
+        if isinstance(label, (list, tuple)):
+            label = '|'.join(label)
         parameters = "{}:{}:{}:{}:{}".format(exposure_time, image_interval, N_frames, label, subdir)
+        if frames_per_label:
+            parameters += f':{int(frames_per_label)}'
         message = function+parameters
         
-        self.send_command(message)
+        if self.series_events is not None:
+            self.series_events.close()
+        self.series_events = self.send_event_command(message)
+
+
+    def wait_armed(self, timeout):
+        '''Waits until the camera is ready to receive triggers.
+
+        Returns True if the camera reported armed within the timeout
+        (in seconds) or if no series acquisition has been started.
+        '''
+        if self.series_events is None:
+            return True
+        return self.series_events.wait('armed', timeout)
+
+
+    def wait_complete(self, timeout):
+        '''Waits until the camera has acquired all the series frames.
+
+        Returns True if the camera reported complete within the timeout
+        (in seconds) or if no series acquisition has been started.
+        If the acquisition ended without completing (an error or a
+        closed connection), returns False and forgets it, so that
+        series_events is None afterwards.
+        '''
+        if self.series_events is None:
+            return True
+        if self.series_events.wait('complete', timeout):
+            self.series_events.close()
+            self.series_events = None
+            return True
+        if self.series_events.ended:
+            print(f'Acquisition on {self.host}:{self.port} ended without completing')
+            self.series_events.close()
+            self.series_events = None
+        return False
+
+
+    def get_acquisition_status(self):
+        '''Returns the server's series acquisition status as a dictionary.
+
+        Keys "state" ("idle", "armed", "acquiring" or "draining"),
+        "aborted", and for the latest acquisition "label", "n_frames",
+        "frame" and "elapsed". Answered also during an acquisition.
+        '''
+        return json.loads(self.send_command(
+            'get_acquisition_status', listen=True, raw=True))
+
+
+    def abort_acquisition(self):
+        '''Stops the running series acquisition early.
+
+        The frames acquired so far are saved. Returns True if an
+        acquisition was running.
+        '''
+        return self.send_command(
+                'abort_acquisition', listen=True) == 'True'
 
 
     def acquireSingle(self, save, subdir, exposure_time=0.01, suffix=''):
-        self.send_command('acquireSingle;{}:{}:{}:{}'.format(
+        '''Acquire a single image (on the next trigger).
+
+        Like with acquireSeries, see wait_armed and wait_complete.
+        '''
+        if self.series_events is not None:
+            self.series_events.close()
+        self.series_events = self.send_event_command('acquireSingle;{}:{}:{}:{}'.format(
             exposure_time, str(save), subdir, suffix))
     
     def saveDescription(self, filename, string):
@@ -97,6 +197,7 @@ class CameraClient(ClientBase):
     def set_camera(self, name):
         '''Sets what camera to use on the server.
         '''
+        self._camera = name
         self.send_command(f'set_camera;{name}')
 
 
@@ -124,6 +225,36 @@ class CameraClient(ClientBase):
         self.send_command(f'set_setting;{setting_name}:{value}')
         self.modified_settings.add(setting_name)
 
+    def get_all_settings(self, names=None):
+        '''Returns all the settings and their values in one go.
+
+        Arguments
+        ---------
+        names : list or None
+            If given, get only these settings (the camera's other
+            settings are not read)
+
+        Returns a dictionary where keys are the setting names and
+        values the current setting values.
+        '''
+        command = 'get_all_settings'
+        if names:
+            command = f'get_all_settings;{json.dumps(list(names))}'
+        return json.loads(
+                self.send_command(command, listen=True, raw=True))
+
+    def set_settings(self, settings):
+        '''Sets many settings in one go.
+
+        Arguments
+        ---------
+        settings : dict
+            Keys setting names and values the new values. The settings
+            are set in the order of the dictionary.
+        '''
+        self.send_command(f'set_settings;{json.dumps(settings)}')
+        self.modified_settings.update(settings)
+
 
     def save_state(self, label, modified_only=True):
         '''Acquires the current camera state and saves it
@@ -136,10 +267,11 @@ class CameraClient(ClientBase):
         state['settings'] = {}
         
         # Save camera device settings
-        for setting in self.get_settings():
-            if modified_only and setting not in self.modified_settings:
-                continue
-            state['settings'][setting] = self.get_setting(setting)
+        if not modified_only:
+            state['settings'] = self.get_all_settings()
+        elif self.modified_settings:
+            state['settings'] = self.get_all_settings(
+                    sorted(self.modified_settings))
 
         savedir = os.path.join(SAVEDIR, self.get_camera())
         os.makedirs(savedir, exist_ok=True)
@@ -166,8 +298,7 @@ class CameraClient(ClientBase):
         with open(fn, 'r') as fp:
             state = json.load(fp)
 
-        for setting, value in state['settings'].items():
-            self.set_setting(setting, value)
+        self.set_settings(state['settings'])
 
 
     def list_states(self):
@@ -179,16 +310,101 @@ class CameraClient(ClientBase):
         return [fn.removesuffix('.json') for fn in os.listdir(savedir) if fn.endswith('.json')]
 
 
-    def start_server(self):
-        super().start_server('camera')
+    def subscribe(self, decimation=1, max_queue=16, policy='drop'):
+        '''Subscribes to the frames that the camera server acquires.
+
+        The server starts streaming on the first subscription.
+
+        Arguments
+        ---------
+        decimation, max_queue, policy
+            See framestream.FrameSubscriber
+
+        Returns a FrameSubscriber.
+        '''
+        port = int(self.send_command('start_stream', listen=True))
+        return FrameSubscriber(
+                self.host, port, decimation=decimation,
+                max_queue=max_queue, policy=policy)
+
+
+    def unsubscribe_all(self):
+        '''Stops the server's frame streaming for all the subscribers.
+        '''
+        self.send_command('stop_stream')
+
+
+    def set_transfer(self, host, port=None):
+        '''Makes the server push saved files to a TransferReceiver.
+
+        Arguments
+        ---------
+        host : string or None
+            The receiver's address. If None, stops the transfers.
+        port : int or None
+            The receiver's port. If None, uses the default port.
+        '''
+        self.send_command(f'set_transfer;{host}:{port}')
+
+
+    def get_transfer_status(self):
+        '''Returns the server's transfer counters as a dictionary.
+
+        Keys "queued", "sent_files", "sent_bytes" and "failures". Empty
+        if no transfers have been set.
+        '''
+        return json.loads(self.send_command(
+            'get_transfer_status', listen=True, raw=True))
+
+
+    def start_server(self, wait=True, devices=None):
+        '''Starts a local camera server.
+
+        Arguments
+        ---------
+        wait : bool
+            See ClientBase.start_server
+        devices : list or None
+            Names of the cameras for a server controlling many
+            cameras. None for a server with one camera.
+        '''
+        args = []
+        if devices:
+            args = ['--devices', ','.join(devices)]
+        super().start_server('camera', wait=wait, args=args)
 
     def reboot(self):
         '''Performs a "reboot" for the camera and restores settings.
 
         Can be used as a "dirty fix" when the first image acqusition
         works fine but the subsequent ones crash for unkown reasons.
+
+        The server first tries a soft reset that keeps the camera
+        settings. Only if the server had to reload the whole camera
+        configuration, the settings are restored.
+
+        Returns "soft" or "full" depending on the reset done.
+        '''
+        start_time = time.perf_counter()
+
+        reset = self.send_command('soft_reset', listen=True)
+        if reset != 'soft':
+            self.load_state('previous')
+            if self._roi:
+                self.set_roi(self._roi)
+
+        self.timings.record('reboot', reset, time.perf_counter()-start_time)
+        return reset
+
+
+    def on_restart(self):
+        '''Reapplies the camera and its last state after a server restart.
         '''
-        self.set_camera(self.get_camera())
+        if self._camera is None:
+            return
+        # A spare server may have the camera already loaded
+        if self.get_camera() != self._camera:
+            self.set_camera(self._camera)
         self.load_state('previous')
         if self._roi:
             self.set_roi(self._roi)
@@ -25,27 +25,44 @@ import time
 import datetime
 import argparse
 import threading
+import json
+import queue
+import functools
 import multiprocessing
+import importlib.util
+import concurrent.futures
 
-try:
-    import pymmcore
-except ImportError:
-    pymmcore = None
-    print('pymmcore not installed')
-import tifffile
 import numpy as np
-import matplotlib.pyplot as plt
-from matplotlib.animation import FuncAnimation
-from matplotlib.widgets import RectangleSelector
 
-from .common import CAMERA_PORT
-from .serverbase import ServerBase
+# The heavy modules (pymmcore, tifffile and matplotlib) are imported
+# only when first needed so that the server starts up fast.
+if importlib.util.find_spec('pymmcore') is None:
+    print('pymmcore not installed')
+    HAS_PYMMCORE = False
+else:
+    HAS_PYMMCORE = True
+
+from .common import CAMERA_PORT, STREAM_PORT_OFFSET
+from .serverbase import ServerBase, wait_spare_assignment
+from .framestream import FramePublisher
+from .transfer import TransferAgent
+from .acquisition import AcquisitionThread
 
 DEFAULT_MICROMANAGER_DIR = 'C:/Program Files/Micro-Manager-2.0'
 
 # Integer between 1-inf (1 = no downsampling), images for imageshower
 LIVE_DOWNSAMPLE = 2
 
+# In MB, the memory for MicroManager's circular buffers, shared
+# between all the cameras of a server
+CIRCULAR_BUFFER_MB = 4000
+
+# How many threads save images (shared by all the cameras of a server)
+WRITER_THREADS = 4
+
+# In seconds, how long a snap waits its trigger after reporting armed
+SNAP_TIMEOUT = 10
+
 class ImageShower:
     '''Shows images on the screen in its own window.
 
@@ -64,8 +81,8 @@ class ImageShower:
     self.loop       Set this as multiprocessing target
     '''
     def __init__(self):
-        self.fig = plt.figure()
-        self.ax = self.fig.add_subplot(111)
+        self.fig = None
+        self.ax = None
         self.close = False
 
         #self.cid = self.fig.canvas.mpl_connect('key_press_event', self.callbackButtonPressed)
@@ -152,6 +169,13 @@ class ImageShower:
 
         queue           Multiprocessing queue with a get method.
         '''
+        import matplotlib.pyplot as plt
+        from matplotlib.animation import FuncAnimation
+        from matplotlib.widgets import RectangleSelector
+
+        self.fig = plt.figure()
+        self.ax = self.fig.add_subplot(111)
+
         self.queue = queue
         self.rectangle = RectangleSelector(self.ax, self.__onSelectRectangle, useblit=True)
         
@@ -178,11 +202,40 @@ class DummyCamera:
     def __init__(self):
         self.settings = {'setting1' : 'na', 'setting2': 0.0, 'setting3': 1}
         self.camera = None
-
-    def acquire_single(self, save, subdir):
-        pass
-    def acquire_series(self, exposure_time, image_interval, N_frames, label, subdir):
-        pass
+        self.publisher = None
+        self.acquisition = AcquisitionThread()
+
+    def acquire_single(self, exposure_time, save, subdir, suffix=None, notify=None):
+        if notify:
+            notify('armed')
+        if self.publisher:
+            self.publisher.publish(np.zeros((64, 64), dtype=np.uint16))
+        if notify:
+            notify('complete')
+    def acquire_series(self, exposure_time, image_interval, N_frames, label, subdir, frames_per_label=0, notify=None):
+        if notify:
+            notify = notify.hand_off()
+        self.acquisition.submit(
+                self._acquire_series, (exposure_time, N_frames),
+                label, N_frames, notify)
+    def _acquire_series(self, exposure_time, N_frames, notify=None, acquisition=None):
+        acquisition.set_state('armed')
+        if notify:
+            notify('armed')
+        acquisition.set_state('acquiring')
+        for i in range(int(N_frames)):
+            if acquisition.aborted:
+                break
+            time.sleep(float(exposure_time))
+            if self.publisher:
+                self.publisher.publish(np.full((64, 64), i, dtype=np.uint16))
+            acquisition.frame_done()
+        if notify:
+            notify('aborted' if acquisition.aborted else 'complete')
+    def get_acquisition_status(self):
+        return self.acquisition.status()
+    def abort_acquisition(self):
+        return self.acquisition.abort()
     def save_images(images, label, metadata, savedir):
         pass
     def set_binning(self, binning):
@@ -221,6 +274,19 @@ class DummyCamera:
         return value
     def set_setting(self, setting_name, value):
         self.settings[setting_name] = value
+    def get_all_settings(self, names=None):
+        settings = self.settings
+        if names:
+            settings = {name: settings[name] for name in json.loads(names) if name in settings}
+        return json.dumps(settings)
+    def set_settings(self, settings):
+        self.settings.update(json.loads(settings))
+    def set_transfer(self, host, port=None):
+        pass
+    def get_transfer_status(self):
+        return json.dumps({})
+    def soft_reset(self):
+        return 'soft'
 
 
 
@@ -230,12 +296,21 @@ class MMCamera:
 
     def __init__(self):
 
-        self.mmc = pymmcore.CMMCore() 
-        self.mmc.setDeviceAdapterSearchPaths([DEFAULT_MICROMANAGER_DIR])
+        self._mmc = None
 
         self._device_name = None
         self._configuration_name = ''
 
+        # Property schema of the camera device, see _build_schema
+        self._schema = {}
+
+        # This camera's share of the circular buffer memory (in MB)
+        self.buffer_mb = CIRCULAR_BUFFER_MB
+
+        # A concurrent.futures executor saving the images or None to
+        # save each acquisition in its own thread
+        self.writer = None
+
         #self.mmc.loadDevice('Camera', 'HamamatsuHam', 'HamamatsuHam_DCAM')
         #self.mmc.initializeAllDevices()
         #self.mmc.setCameraDevice('Camera')
@@ -247,7 +322,6 @@ class MMCamera:
             'flipud': 0,
             }
         
-        self.mmc.setCircularBufferMemoryFootprint(4000)
         self.live_queue= False
 
         self.shower = ImageShower()
@@ -263,6 +337,27 @@ class MMCamera:
         self.title = 'Camera not set'
         self.servertitle = ''
 
+        # FramePublisher if frames are streamed to subscribers
+        self.publisher = None
+
+        # Series acquisitions run in their own thread
+        self.acquisition = AcquisitionThread()
+
+        # TransferAgent if saved files are pushed to a central storage
+        self.transfer = None
+
+
+    @property
+    def mmc(self):
+        '''The MicroManager core, created on the first use.
+        '''
+        if self._mmc is None:
+            import pymmcore
+            self._mmc = pymmcore.CMMCore()
+            self._mmc.setDeviceAdapterSearchPaths([DEFAULT_MICROMANAGER_DIR])
+            self._mmc.setCircularBufferMemoryFootprint(int(self.buffer_mb))
+        return self._mmc
+
 
     def get_cameras(self):
         '''Lists available MicroManager configuration files in .
@@ -278,7 +373,8 @@ class MMCamera:
     def set_camera(self, name):
         '''Set the provided configuration file.
         '''
-        if not os.path.exists(name):
+        path = name
+        if not os.path.exists(path):
             path = os.path.join(DEFAULT_MICROMANAGER_DIR, name)
             
             if not os.path.exists(path):
@@ -289,18 +385,68 @@ class MMCamera:
         
         self._device_name = self.mmc.getCameraDevice()
         self._configuration_name = name
+        self._build_schema()
         self.mmc.prepareSequenceAcquisition(self._device_name)
 
         self.title = f'{name} ({self._device_name}) | {self.servertitle}'
 
+    def _build_schema(self):
+        '''Caches the camera device's property names, types and limits.
+
+        Called when a configuration is loaded so that getting and
+        setting properties does not need to query the driver for them
+        every time.
+        '''
+        types = {1: 'string', 2: 'float', 3: 'integer'}
+        mmc = self.mmc
+        device = self._device_name
+
+        self._schema = {}
+        for name in mmc.getDevicePropertyNames(device):
+            prop = {
+                'type': types.get(mmc.getPropertyType(device, name), 'string'),
+                'allowed': list(mmc.getAllowedPropertyValues(device, name)),
+                'read_only': mmc.isPropertyReadOnly(device, name),
+                'limits': None,
+                }
+            if mmc.hasPropertyLimits(device, name):
+                prop['limits'] = (
+                        mmc.getPropertyLowerLimit(device, name),
+                        mmc.getPropertyUpperLimit(device, name))
+            self._schema[name] = prop
+
+
+    def soft_reset(self):
+        '''Resets the camera without reloading the configuration.
+
+        Stops any stuck sequence acquisition, clears the circular
+        buffer and prepares the sequence acquisition again. Only if
+        this fails, reloads the whole configuration (set_camera),
+        which also resets the camera settings.
+
+        Returns "soft" or "full" depending on which reset was done.
+        '''
+        try:
+            if self._device_name is None:
+                raise RuntimeError('No camera set')
+            if self.mmc.isSequenceRunning():
+                self.mmc.stopSequenceAcquisition()
+            self.mmc.clearCircularBuffer()
+            self.mmc.prepareSequenceAcquisition(self._device_name)
+            return 'soft'
+        except Exception as e:
+            print(f'Soft reset failed ({e}), reloading the configuration')
+
+        self.set_camera(self._configuration_name)
+        return 'full'
+
+
     def get_settings(self):
         '''Returns device property names
         '''
         if self._device_name is None:
             return ''
-        properties = self.mmc.getDevicePropertyNames(self._device_name)
-        
-        return list(properties) + list(self.settings.keys())
+        return list(self._schema) + list(self.settings.keys())
 
 
     def get_setting_type(self, setting_name):
@@ -311,18 +457,46 @@ class MMCamera:
         if setting_name in self.settings:
             return 'float'
 
-        try:
-            num = self.mmc.getPropertyType(self._device_name, setting_name)
-        except RuntimeError as e:
+        if setting_name not in self._schema:
             print(f'Error! No setting named: {setting_name}')
             return ''
-        
-        if num == 1:
-            return 'string'
-        elif num == 2:
-            return 'float'
-        elif num == 3:
-            return 'integer'
+        return self._schema[setting_name]['type']
+
+
+    def _validate(self, setting_name, value):
+        '''Casts the value to the property's type and checks it.
+
+        Returns the value or raises ValueError.
+        '''
+        prop = self._schema.get(setting_name)
+        if prop is None:
+            raise ValueError(f'No setting named: {setting_name}')
+        if prop['read_only']:
+            raise ValueError(f'Setting {setting_name} is read-only')
+
+        if prop['type'] == 'float':
+            value = float(value)
+        elif prop['type'] == 'integer':
+            # "2.0" is fine but "2.7" is not silently truncated
+            number = float(value)
+            if not number.is_integer():
+                raise ValueError(
+                        f'{value} is not an integer for {setting_name}')
+            value = int(number)
+
+        if prop['allowed'] and str(value) not in prop['allowed']:
+            # Allowed values are strings; For numbers compare the values
+            if prop['type'] == 'string' or not any(
+                    float(a) == value for a in prop['allowed']):
+                raise ValueError(
+                        f'{value} not allowed for {setting_name}, use one of {prop["allowed"]}')
+
+        if prop['limits'] is not None and prop['type'] != 'string':
+            lower, upper = prop['limits']
+            if not lower <= value <= upper:
+                raise ValueError(
+                        f'{value} out of range for {setting_name} ({lower} to {upper})')
+        return value
 
 
     def get_setting(self, setting_name):
@@ -338,13 +512,10 @@ class MMCamera:
             return
         
         # b) Camera device setting
-        type_name = self.get_setting_type(setting_name)
-        if type_name == 'float':
-            value = float(value)
-        elif type_name == 'integer':
-            value = int(value)
-        elif type_name == '':
-            print('Error! No setting named: {setting_name}')
+        try:
+            value = self._validate(setting_name, value)
+        except ValueError as e:
+            print(f'Error! {e}')
             return
 
         print(f'Changing {setting_name} to its new value {value}')
@@ -354,6 +525,27 @@ class MMCamera:
             print('Error! The set value likely out of range.')
             print(e)
 
+    def get_all_settings(self, names=None):
+        '''Returns all the settings and their values as a JSON string.
+
+        names       If given, JSON list of the setting names to get;
+                    Names that the camera does not have are skipped
+        '''
+        available = self.get_settings()
+        if names:
+            available = [name for name in json.loads(names) if name in available]
+        return json.dumps(
+                {name: self.get_setting(name) for name in available})
+
+    def set_settings(self, settings):
+        '''Sets many settings at once.
+
+        settings        JSON string of a dictionary, keys the setting
+                        names and values the new values
+        '''
+        for setting_name, value in json.loads(settings).items():
+            self.set_setting(setting_name, value)
+
     def _image_postprocess(self, image):
         if self.settings['transpose'] != 0:
             image = np.transpose(image)
@@ -364,12 +556,14 @@ class MMCamera:
         return image
             
 
-    def acquire_single(self, exposure_time, save, subdir, suffix=None):
+    def acquire_single(self, exposure_time, save, subdir, suffix=None, notify=None):
         '''
         Acquire a single image.
 
         save        'True' or 'False'
         subdir      Subdirectory for saving
+        notify      If given, called with "armed" when waiting for
+                    the trigger and "complete" when the image is in
         '''
         
         exposure_time = float(exposure_time)
@@ -380,9 +574,22 @@ class MMCamera:
 
         start_time = str(datetime.datetime.now())
  
-        self.mmc.snapImage()
-        image = self.mmc.getImage()
+        if notify:
+            # snapImage blocks until the image is in, so the camera
+            # could be told armed only before it really is. A one
+            # frame sequence waits the trigger once started.
+            self.mmc.clearCircularBuffer()
+            self.mmc.startSequenceAcquisition(1, 0, False)
+            notify('armed')
+            image = self._pop_single(exposure_time)
+            notify('complete')
+        else:
+            self.mmc.snapImage()
+            image = self.mmc.getImage()
         image = self._image_postprocess(image)
+
+        if self.publisher:
+            self.publisher.publish(image)
         
         if not self.live_queue:
             self.live_queue = multiprocessing.Queue()
@@ -404,26 +611,77 @@ class MMCamera:
             if suffix:
                 name = f'{name}_{suffix}'
             
-            save_thread = threading.Thread(target=self.save_images,args=([image], name, metadata,os.path.join(self.save_directory, subdir)))
-            save_thread.start()
+            self._save_background([image], name, metadata, os.path.join(self.save_directory, subdir))
+
 
 
+    def _pop_single(self, exposure_time):
+        '''Returns the image of a one frame sequence (see acquire_single).
+        '''
+        end_time = time.time() + exposure_time + SNAP_TIMEOUT
+        while self.mmc.getRemainingImageCount() == 0:
+            if time.time() > end_time:
+                self.mmc.stopSequenceAcquisition()
+                raise TimeoutError(f'No snap trigger in {SNAP_TIMEOUT} s')
+            self.mmc.sleep(1)
+        return self.mmc.popNextImage()
+
 
-    def acquire_series(self, exposure_time, image_interval, N_frames, label, subdir):
+    def acquire_series(self, exposure_time, image_interval, N_frames, label, subdir, frames_per_label=0, notify=None):
         '''
         Acquire a series of images
 
+        The acquisition runs in the camera's acquisition thread and
+        this returns immediately. See get_acquisition_status and
+        abort_acquisition.
+
         exposure_time       How many seconds to expose each image
         image_interval      How many seconds to wait in between the exposures
         N_frames            How many images to take
         label               Label for saving the images (part of the filename later)
         subdir
+        frames_per_label    If given, label has many labels separated by "|"
+                            and each gets this many frames, saved separately
+                            (one series for many protocol repeats).
+        notify              Notifier or None. Gets "armed" when the camera
+                            is ready for triggers and "complete" when all
+                            the frames have been acquired ("aborted" if
+                            aborted).
+        '''
+        if notify:
+            notify = notify.hand_off()
+        self.acquisition.submit(
+                self._acquire_series,
+                (exposure_time, image_interval, N_frames, label, subdir, frames_per_label),
+                label, N_frames, notify)
+
+
+    def get_acquisition_status(self):
+        '''
+        Returns the acquisition state and progress as a JSON string.
+        '''
+        return self.acquisition.status()
+
+
+    def abort_acquisition(self):
+        '''
+        Stops the running series acquisition early. The frames acquired
+        so far are saved.
+        '''
+        return self.acquisition.abort()
+
+
+    def _acquire_series(self, exposure_time, image_interval, N_frames, label, subdir, frames_per_label=0, notify=None, acquisition=None):
+        '''
+        Acquires the series in the acquisition thread (see acquire_series)
         '''
 
         exposure_time = float(exposure_time)
         image_interval = float(image_interval)
         N_frames = int(N_frames)
         label = str(label)
+        frames_per_label = int(frames_per_label)
+        labels = label.split('|')
 
         print("Now aquire_series with label " + label)
         print("- IMAGING PARAMETERS -")
@@ -460,6 +718,8 @@ class MMCamera:
         self.mmc.setExposure(exposure)
 
         self.mmc.clearCircularBuffer()
+        if self.transfer:
+            self.transfer.set_acquiring(True)
         #self.mmc.prepareSequenceAcquisition(self._device_name)
         #self.wait_for_client()
         
@@ -467,6 +727,10 @@ class MMCamera:
         start_time = str(datetime.datetime.now())
         self.mmc.startSequenceAcquisition(N_frames, image_interval+(1-scaler)*exposure, False)
         
+        acquisition.set_state('armed')
+        if notify:
+            notify('armed')
+
         #while self.mmc.isSequenceRunning():
         #    self.mmc.sleep(1000*exposure_time)
 
@@ -475,25 +739,48 @@ class MMCamera:
         images = []
 
         for i in range(N_frames):
-            while True:
+            image = None
+            while image is None:
+                if acquisition.aborted and acquisition.state != 'draining':
+                    # Stop the camera and read out what it has left
+                    self.mmc.stopSequenceAcquisition()
+                    acquisition.set_state('draining')
+                if acquisition.state == 'draining' and self.mmc.getRemainingImageCount() == 0:
+                    break
                 try:
                     image = self.mmc.popNextImage()
-                    break
                 except:
                     # Index error for example when circular buffer is still empty
                     self.mmc.sleep(1000*exposure_time)
                     print(f'No image {i}/{N_frames}, waiting...')
 
+            if image is None:
+                break
+
+            if acquisition.state == 'armed':
+                acquisition.set_state('acquiring')
+            elif acquisition.state == 'acquiring' and not self.mmc.isSequenceRunning():
+                acquisition.set_state('draining')
+
             image = self._image_postprocess(image)
             images.append(image)
+            acquisition.frame_done()
+
+            if self.publisher:
+                self.publisher.publish(image)
+
+            # Save each repeat as soon as its frames are in
+            if frames_per_label and len(images) == frames_per_label and len(labels) > 1:
+                self._save_series(images, labels.pop(0), exposure_time, image_interval, start_time, subdir, False)
+                images = []
             
+        if notify:
+            notify('aborted' if acquisition.aborted else 'complete')
+        if self.transfer:
+            self.transfer.set_acquiring(False)
             
-        metadata = {'exposure_time_s': exposure_time, 'image_interval_s': image_interval,
-                    'N_frames': N_frames, 'label': label, 'function': 'acquireSeries', 'start_time': start_time}
-        metadata.update(self.settings)
-
-        save_thread = threading.Thread(target=self.save_images, args=(images,label,metadata,os.path.join(self.save_directory, subdir)))
-        save_thread.start()
+        if images:
+            self._save_series(images, labels[0], exposure_time, image_interval, start_time, subdir, acquisition.aborted)
         
         #if 'hamamatsu' in device_name.lower() and trigger_direction == 'receive':
         #    self.mmc.setProperty(self._device_name, "TRIGGER SOURCE","INTERNAL")
@@ -501,10 +788,36 @@ class MMCamera:
         print('acquired')
 
     
+    def _save_series(self, images, label, exposure_time, image_interval, start_time, subdir, aborted):
+        '''
+        Saves the series images with their metadata in the background.
+        '''
+        metadata = {'exposure_time_s': exposure_time, 'image_interval_s': image_interval,
+                    'N_frames': len(images), 'label': label, 'function': 'acquireSeries', 'start_time': start_time}
+        if aborted:
+            metadata['aborted'] = True
+        metadata.update(self.settings)
+
+        self._save_background(images, label, metadata, os.path.join(self.save_directory, subdir))
+
+
+    def _save_background(self, images, label, metadata, savedir):
+        '''
+        Saves the images without blocking, using the writer if set.
+        '''
+        if self.writer is not None:
+            self.writer.submit(self.save_images, images, label, metadata, savedir)
+        else:
+            save_thread = threading.Thread(target=self.save_images, args=(images,label,metadata,savedir))
+            save_thread.start()
+
+
     def save_images(self, images, label, metadata, savedir):
         '''
         Save given images as grayscale tiff images.
         '''
+        import tifffile
+
         savedir = os.path.join(self._startdir, savedir)
         if not os.path.isdir(savedir):
             try:
@@ -514,17 +827,52 @@ class MMCamera:
                 # the folders simultaneously
                 pass
 
+        fns = []
         if self.save_stack == False:
             # Save separate images
             for i, image in enumerate(images):
                 fn = '{}_{}.tiff'.format(label, i)
                 tifffile.imwrite(os.path.join(savedir, fn), image, metadata=metadata)
+                fns.append(fn)
         else:
             # Save a stack
             fn = '{}_stack.tiff'.format(label)
             tifffile.imwrite(os.path.join(savedir, fn), np.asarray(images), metadata=metadata)
+            fns.append(fn)
         
         self.save_description(os.path.join(savedir, 'description'), self.description_string, internal=True)
+        fns.append('description.txt')
+
+        if self.transfer:
+            for fn in fns:
+                self.transfer.enqueue(os.path.join(savedir, fn))
+
+
+    def set_transfer(self, host, port=None):
+        '''
+        Pushes the saved files to a TransferReceiver in the background.
+
+        host        Address of the receiver or "none" to stop transfers
+        port        Port of the receiver
+        '''
+        if self.transfer:
+            self.transfer.stop()
+            self.transfer = None
+        if host.lower() == 'none':
+            return
+        if port in [None, '', 'None']:
+            self.transfer = TransferAgent(host, root=self._startdir)
+        else:
+            self.transfer = TransferAgent(host, port, root=self._startdir)
+
+
+    def get_transfer_status(self):
+        '''
+        Returns the transfer counters as a JSON string (or "{}").
+        '''
+        if self.transfer is None:
+            return json.dumps({})
+        return json.dumps(self.transfer.status)
 
 
     def set_save_stack(self, boolean):
@@ -603,48 +951,263 @@ class MMCamera:
             self.live_queue.put('close')
 
 
+class DeviceWorker:
+    '''Runs the commands of one camera device in its own thread.
+
+    Each camera of a server has its own worker so that the cameras
+    can acquire at the same time and so that the server keeps
+    accepting commands while a camera is busy.
+    '''
+
+    def __init__(self, server, device):
+        self.server = server
+        self.device = device
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(
+                target=self._loop, name=f'camera-{device}', daemon=True)
+        self.thread.start()
+
+
+    def put(self, func, function, parameters, conn, label):
+        '''Queues a command (see ServerBase.execute) for the device.
+        '''
+        self.queue.put((func, function, parameters, conn, label))
+
+
+    def call(self, function):
+        '''Queues a plain function call, in order with the commands.
+        '''
+        self.queue.put(function)
+
+
+    def _loop(self):
+        acquisition = getattr(self.server.devices[self.device], 'acquisition', None)
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            # The camera is not touched while it acquires a series
+            if acquisition is not None:
+                acquisition.wait_idle()
+            if callable(item):
+                item()
+            else:
+                self.server.execute(*item)
+
+
+    def stop(self):
+        '''Stops after the already queued commands.
+        '''
+        self.queue.put(None)
+        self.thread.join()
+
+
 class CameraServer(ServerBase):
     '''Camera server listens incoming connections from the client and
     controls a camera class.
+
+    One server can control many cameras (devices). Commands are
+    addressed to a device as "{command_name}@{device}"; Commands
+    without a device go to the first device. The camera commands
+    of each device run in the device's own thread (DeviceWorker),
+    and the devices share the image writer threads and the
+    circular buffer memory.
+
+    Series acquisitions run in each camera's AcquisitionThread. Camera
+    commands wait until the acquisition is over, except the commands
+    listed in immediate that are run straight away.
+
+    Attributes
+    ----------
+    devices : dict
+        Keys device names and values camera objects
+    workers : dict
+        Keys device names and values DeviceWorkers
+    immediate : list
+        Camera commands that do not wait for the device (status
+        queries, abort and stream toggles)
     '''
 
     def __init__(self, camera, port=None):
-        
+        '''
+        Arguments
+        ---------
+        camera : obj or dict
+            A camera object, or a dictionary of cameras where keys
+            are the device names.
+        port : int or None
+            The server port. If None, uses CAMERA_PORT
+        '''
         if port is None:
             port = CAMERA_PORT
+
+        if isinstance(camera, dict):
+            devices = camera
+        else:
+            devices = {'cam0': camera}
+        self.devices = devices
+        self.default_device = next(iter(devices))
+
+        super().__init__('', port, devices[self.default_device])
         
-        super().__init__('', port, camera)
-        
-        
-        print(f'Using the camera <{camera.__class__.__name__}>')
         self.cam = self.device
-        self.cam.servertitle = f'Server on port {port}'
-        self.cam.wait_for_client = self.wait_for_client
-        
-        added_functions = {'acquireSeries': self.cam.acquire_series,
-                          'acquireSingle': self.cam.acquire_single,
-                          'saveDescription': self.cam.save_description,
-                          'set_roi': self.cam.set_roi,
-                          'set_save_stack': self.cam.set_save_stack,
-                          'get_cameras': self.cam.get_cameras,
-                          'get_camera': self.cam.get_camera,
-                          'set_camera': self.cam.set_camera,
-                          'get_settings': self.cam.get_settings,
-                          'get_setting_type': self.cam.get_setting_type,
-                          'get_setting': self.cam.get_setting,
-                          'set_setting': self.cam.set_setting,
-                          }
-
-        self.functions = {**self.functions, **added_functions}
+        self.writer = concurrent.futures.ThreadPoolExecutor(WRITER_THREADS)
+
+        for name, cam in devices.items():
+            print(f'Using the camera <{cam.__class__.__name__}> as {name}')
+            cam.servertitle = f'Server on port {port}'
+            if len(devices) > 1:
+                cam.servertitle += f' ({name})'
+            cam.wait_for_client = self.wait_for_client
+            if hasattr(cam, 'writer'):
+                cam.writer = self.writer
+
+        self.device_functions = {
+                name: self._device_functions(name, cam)
+                for name, cam in devices.items()}
+        self.workers = {
+                name: DeviceWorker(self, name) for name in devices}
+
+        self.functions = {
+                **self.functions,
+                **self.device_functions[self.default_device]}
 
         self.responders.extend(
                 ['get_cameras', 'get_camera', 'get_settings',
-                 'get_setting_type', 'get_setting']
+                 'get_setting_type', 'get_setting', 'get_all_settings',
+                 'start_stream', 'get_transfer_status', 'soft_reset',
+                 'get_acquisition_status', 'abort_acquisition']
                 )
 
+        self.immediate = [
+                'get_acquisition_status', 'abort_acquisition',
+                'get_transfer_status', 'start_stream', 'stop_stream']
+
+        self.raw_parameters.extend(['set_settings', 'get_all_settings'])
+        
+        self.notifiers.extend(['acquireSeries', 'acquireSingle'])
+
+        self.stream_port = port + STREAM_PORT_OFFSET
+
+
+    def _device_functions(self, name, cam):
+        '''Returns the commands of one device (keys command names).
+        '''
+        return {'acquireSeries': cam.acquire_series,
+                'acquireSingle': cam.acquire_single,
+                'saveDescription': cam.save_description,
+                'set_roi': cam.set_roi,
+                'set_save_stack': cam.set_save_stack,
+                'get_cameras': cam.get_cameras,
+                'get_camera': cam.get_camera,
+                'set_camera': cam.set_camera,
+                'get_settings': cam.get_settings,
+                'get_setting_type': cam.get_setting_type,
+                'get_setting': cam.get_setting,
+                'set_setting': cam.set_setting,
+                'get_all_settings': cam.get_all_settings,
+                'set_settings': cam.set_settings,
+                'set_transfer': cam.set_transfer,
+                'get_transfer_status': cam.get_transfer_status,
+                'get_acquisition_status': cam.get_acquisition_status,
+                'abort_acquisition': cam.abort_acquisition,
+                'start_stream': functools.partial(self.start_stream, name),
+                'stop_stream': functools.partial(self.stop_stream, name),
+                'soft_reset': functools.partial(self.soft_reset, name),
+                }
+
+
+    def dispatch(self, func, parameters, conn):
+        '''Runs camera commands in the device threads, others directly.
+        '''
+        name, _, device = func.partition('@')
+        if not device:
+            device = self.default_device
+
+        functions = self.device_functions.get(device)
+        if functions is None:
+            print(f'Skipping command to unknown device: {func}')
+            conn.close()
+        elif name in self.immediate:
+            self.execute(name, functions[name], parameters, conn, func)
+        elif name in functions:
+            self.workers[device].put(
+                    name, functions[name], parameters, conn, func)
+        elif name in self.functions:
+            self.execute(name, self.functions[name], parameters, conn, func)
+        else:
+            print(f'Skipping unkown command: {func}')
+            conn.close()
+
+
+    def set_save_directory(self, directory):
+        '''Sets the location for the data saving (for all the devices)
+
+        Each device takes the directory in its own thread after its
+        already queued commands, so a series is saved in one place.
+        '''
+        self._create_save_directory(directory)
+        for name, cam in self.devices.items():
+            self.workers[name].call(
+                    functools.partial(setattr, cam, 'save_directory', directory))
+
+
+    def run(self):
+        super().run()
+        for cam in self.devices.values():
+            if hasattr(cam, 'acquisition'):
+                cam.acquisition.wait_idle()
+        for worker in self.workers.values():
+            worker.stop()
+        self.writer.shutdown(wait=True)
+
+
+    def soft_reset(self, device=None, _=None):
+        '''Resets the camera, see MMCamera.soft_reset.
+
+        The durations of the soft and full resets are recorded in
+        the server's timings.
+        '''
+        cam = self.devices[device or self.default_device]
+
+        start_time = time.perf_counter()
+        reset = cam.soft_reset()
+        duration = time.perf_counter() - start_time
+
+        self.timings.record('soft_reset', reset, duration)
+        print(f'Camera reset ({reset}) took {duration:.3f} seconds')
+        return reset
+
+
+    def start_stream(self, device=None, _=None):
+        '''Starts publishing the acquired frames to subscribers.
+
+        Each device streams on its own port, the first device on
+        stream_port and the next ones on the following ports.
+
+        Returns the stream port where the subscribers can connect.
+        '''
+        device = device or self.default_device
+        cam = self.devices[device]
+        if cam.publisher is None:
+            port = self.stream_port + list(self.devices).index(device)
+            print(f'Streaming frames of {device} on port {port}')
+            cam.publisher = FramePublisher(port)
+        return cam.publisher.port
+
+
+    def stop_stream(self, device=None, _=None):
+        '''Stops publishing frames and disconnects the subscribers.
+        '''
+        cam = self.devices[device or self.default_device]
+        if cam.publisher is not None:
+            cam.publisher.close()
+            cam.publisher = None
+
         
 
 def test_camera():
+    import matplotlib.pyplot as plt
     cam = Camera()
     images = cam.acquireSeries(0.01, 1, 5, 'testing')
     
@@ -663,6 +1226,13 @@ def main():
     parser.add_argument('-p', '--port')
     parser.add_argument('-c', '--camera')
     parser.add_argument('-s', '--save-directory')
+    parser.add_argument('-r', '--ready-port')
+    parser.add_argument('--spare', action='store_true',
+            help='Start as a spare server and wait for a port (needs --ready-port)')
+    parser.add_argument('--preload',
+            help='Camera (configuration) to set already at the startup')
+    parser.add_argument('-d', '--devices',
+            help='Names of the cameras that this server controls, separated by commas')
 
     args = parser.parse_args()
 
@@ -673,20 +1243,53 @@ def main():
         Camera = DummyCamera
     else:
         # Default
-        if pymmcore:
+        if HAS_PYMMCORE:
             Camera = MMCamera
         else:
             Camera = DummyCamera
 
-    camera = Camera()
-
-    if args.save_directory:
-        self.set_save_directory(args.save_directory)
+    if args.devices:
+        names = args.devices.split(',')
+    else:
+        names = ['cam0']
+
+    cameras = {name: Camera() for name in names}
+    camera = cameras[names[0]]
+
+    for cam in cameras.values():
+        # Share the circular buffer memory
+        if hasattr(cam, 'buffer_mb'):
+            cam.buffer_mb = CIRCULAR_BUFFER_MB / len(cameras)
+        if args.save_directory:
+            cam.save_directory = args.save_directory
+
+    if args.preload:
+        camera.set_camera(args.preload)
+
+    ready_conn = None
+    if args.spare:
+        # Do the slow imports now, before anybody waits for us
+        if Camera is MMCamera:
+            for cam in cameras.values():
+                cam.mmc
+        try:
+            import tifffile
+        except ModuleNotFoundError:
+            pass
+        try:
+            ready_conn, args.port = wait_spare_assignment(int(args.ready_port))
+        except ConnectionError:
+            print('The spare was not taken into use')
+            return
 
     if args.port:
         args.port = int(args.port)
 
-    cam_server = CameraServer(camera, args.port)
+    cam_server = CameraServer(cameras, args.port)
+    if ready_conn is not None:
+        cam_server.send_ready(conn=ready_conn)
+    elif args.ready_port:
+        cam_server.send_ready(int(args.ready_port))
     cam_server.run()
             
         
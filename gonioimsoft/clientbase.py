@@ -1,10 +1,30 @@
 '''Commond code for all client programs.
 '''
+import os
+import json
 import socket
 import time
-import subprocess
-import sys
 import atexit
+import threading
+
+from .common import UNIX_SOCKETS, LOCAL_HOSTNAMES, unix_socket_path, frame_command
+from .timings import CommandTimings
+from .clocksync import ClockModel, measure
+from .supervisor import ServerProcess
+
+# In seconds, how often the heartbeat contacts the server and
+# how long it waits for the server's response
+HEARTBEAT_INTERVAL = 1
+HEARTBEAT_TIMEOUT = 2
+
+# After how many failed heartbeats in a row the server is down
+HEARTBEAT_DOWN_AFTER = 3
+
+
+class ServerDownError(ConnectionError):
+    '''Raised when a command is sent to a server known to be down.
+    '''
+
 
 class ClientBase:
     '''Base class for all clients.
@@ -19,17 +39,56 @@ class ClientBase:
         The server IP (v4) address or a hostname
     port : int
         The server port number
-    local_server : Popen obj or None
-        None if no local server started by the client
+    local_server : obj or None
+        supervisor.ServerProcess of the local server started by the
+        client, or None if no local server started
+    supervisor : obj or None
+        If a supervisor.ServerSupervisor, local servers are started
+        and stopped through it (so that its spares can be used)
+    unix_path : string or None
+        The server's Unix domain socket path if the server is local
+        and the platform supports Unix sockets. Used instead of TCP
+        when the server has created it.
+    timings : obj
+        CommandTimings of the commands sent by this client.
+    clock : obj
+        ClockModel of the server's clock relative to this machine's
+        clock. Updated by sync_clock.
+    state : string or None
+        The server's state tracked by the heartbeat; "up", "degraded"
+        (missed heartbeats or busy) or "down". None if no heartbeat.
+    journal : obj or None
+        If a journal.CommandJournal, the sent commands are recorded
+        in it.
+    server_type : string or None
+        The type of the server ("camera" or "vio"), set by subclasses.
     '''
 
+    server_type = None
+
     def __init__(self, host, port, running_index=0):
         self.host = host
         self.port = port
+        self.local_server = None
+        self.supervisor = None
+        self.timings = CommandTimings()
+        self.clock = ClockModel()
+
+        self.state = None
+        self._save_directory = None
+        self._server_name = None
+        self._server_args = []
+        self._heartbeat = None
+        self._n_failed_beats = 0
+        self.journal = None
+
+        self.unix_path = None
+        if UNIX_SOCKETS and host in LOCAL_HOSTNAMES:
+            self.unix_path = unix_socket_path(port)
 
 
     def send_command(self, command, listen=False,
-                     n_retry=60, retry_interval=1):
+                     n_retry=60, retry_interval=1, raw=False):
         '''Sends an arbitrary command to the server.
 
         Opens a connection to the server, send the command string and
@@ -53,43 +112,131 @@ class ClientBase:
         retry_interval : int or float
             In seconds, how long to sleep between between the connection
             retries. Default is 1.
+        raw : bool
+            If True, return the response string as it is. Otherwise,
+            a response containing ":" is split into a list.
         '''
         if not isinstance(command, str):
             typ = type(command)
             raise TypeError(f'command must be a string, not {typ}')
         
+        command_name = command.split(';')[0]
+        sent_time = time.time()
+        start_time = time.perf_counter()
+        response = None
+
+        try:
+            with self._connect(n_retry, retry_interval, command_name) as soc:
+                connect_time = time.perf_counter()
+
+                soc.sendall(frame_command(command))
+
+                if listen:
+                    response = []
+                    while True:
+                        data = soc.recv(1024)
+                        if not data: break
+                        response.append(data.decode())
+                    response = ''.join(response)
+        except Exception as e:
+            self._record(command, 'listen' if listen else 'send', sent_time,
+                         time.perf_counter()-start_time, error=e)
+            raise
+
+        end_time = time.perf_counter()
+        self._record(command, 'listen' if listen else 'send', sent_time,
+                     end_time-start_time)
+
+        if listen and ':' in response and not raw:
+            response = response.split(':')
+
+        self.timings.record(command_name, 'connect', connect_time-start_time)
+        if listen:
+            self.timings.record(command_name, 'response', end_time-connect_time)
+        self.timings.record(command_name, 'total', end_time-start_time)
 
+        return response
+
+
+    def _check_not_down(self):
+        if self.state == 'down':
+            raise ServerDownError(
+                    f'The server at {self.host}:{self.port} is down')
+
+
+    def send_event_command(self, command, n_retry=60, retry_interval=1):
+        '''Sends a command and keeps listening the server's events.
+
+        Used for commands that the server lists in its notifiers,
+        such as "acquireSeries" that tells back when the camera is
+        armed and when the acquisition is complete.
+
+        Arguments
+        ---------
+        command, n_retry, retry_interval
+            See send_command
+
+        Returns an EventListener.
+        '''
+        if not isinstance(command, str):
+            typ = type(command)
+            raise TypeError(f'command must be a string, not {typ}')
+
+        command_name = command.split(';')[0]
+        sent_time = time.time()
+        start_time = time.perf_counter()
+
+        try:
+            soc = self._connect(n_retry, retry_interval, command_name)
+        except Exception as e:
+            self._record(command, 'event', sent_time,
+                         time.perf_counter()-start_time, error=e)
+            raise
+        connect_time = time.perf_counter() - start_time
+        self.timings.record(command_name, 'connect', connect_time)
+        self._record(command, 'event', sent_time, connect_time)
+
+        soc.sendall(frame_command(command))
+        return EventListener(soc)
+
+
+    def _record(self, command, mode, sent_time, latency, error=None):
+        if self.journal is not None:
+            self.journal.record(
+                    self, command, mode, sent_time, latency, error=error)
+
+
+    def _connect(self, n_retry, retry_interval, command_name=''):
+        '''Returns a socket connected to the server.
+        '''
         tries = 0
         host = self.host
         port = self.port
 
-        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as soc:
+        while True:
+            self._check_not_down()
 
-            while True:
-                try:
-                    soc.connect((host, port))
-                    break
-                except ConnectionRefusedError:
-                    tries += 1
-                    if tries > n_retry:
-                        raise ConnectionRefusedError(
-                                f'Cannot connect to {host}:{port}')
+            if self.unix_path and os.path.exists(self.unix_path):
+                soc = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                address = self.unix_path
+            else:
+                soc = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                address = (host, port)
+            try:
+                soc.connect(address)
+                break
+            except (ConnectionRefusedError, FileNotFoundError):
+                soc.close()
+                tries += 1
+                self.timings.count(command_name, 'retries')
+                if tries > n_retry:
+                    raise ConnectionRefusedError(
+                            f'Cannot connect to {host}:{port}')
 
-                    print('Server connection unavailable, retrying...')
-                    time.sleep(retry_interval)
+                print('Server connection unavailable, retrying...')
+                time.sleep(retry_interval)
 
-            soc.sendall(command.encode())
-            
-            if listen:
-                response = []
-                while True:
-                    data = soc.recv(1024)
-                    if not data: break
-                    response.append(data.decode())
-                response = ''.join(response)
-                if ':' in response:
-                    response = response.split(':')
-                return response
+        return soc
 
 
     def is_server_running(self):
@@ -98,56 +245,258 @@ class ClientBase:
         try:
             self.send_command(
                     'ping;Hello there!', n_retry=0)
-        except ConnectionRefusedError:
+        except ConnectionError:
             return False
         return True
 
+    def start_heartbeat(self, interval=HEARTBEAT_INTERVAL):
+        '''Starts tracking the server's state in a background thread.
+
+        When the server is down, commands fail straight away with
+        ServerDownError instead of retrying. A local server (started
+        by this client) that has crashed is restarted automatically
+        and on_restart is called.
+        '''
+        if self._heartbeat is not None:
+            return
+        self._heartbeat = threading.Thread(
+                target=self._heartbeat_loop, args=(interval,), daemon=True)
+        self._heartbeat.start()
+
+
+    def stop_heartbeat(self):
+        '''Stops the heartbeat (after its current beat).
+        '''
+        heartbeat, self._heartbeat = self._heartbeat, None
+        if heartbeat is not None:
+            heartbeat.join()
+        self.state = None
+
+
+    def _beat(self):
+        '''Sends one heartbeat. Returns "up", "busy" or "failed".
+        '''
+        if self.unix_path and os.path.exists(self.unix_path):
+            family, address = socket.AF_UNIX, self.unix_path
+        else:
+            family, address = socket.AF_INET, (self.host, self.port)
+
+        try:
+            with socket.socket(family, socket.SOCK_STREAM) as soc:
+                soc.settimeout(HEARTBEAT_TIMEOUT)
+                soc.connect(address)
+                soc.sendall(b'pong;heartbeat')
+                if soc.recv(1024):
+                    return 'up'
+                return 'failed'
+        except socket.timeout:
+            # The server accepts connections but is busy (acquiring)
+            return 'busy'
+        except OSError:
+            return 'failed'
+
+
+    def _heartbeat_loop(self, interval):
+        while self._heartbeat is not None:
+            result = None
+            crashed = (self.local_server is not None
+                       and self.local_server.poll() is not None)
+
+            if crashed:
+                self._n_failed_beats = HEARTBEAT_DOWN_AFTER
+            else:
+                result = self._beat()
+                if result == 'up':
+                    self._n_failed_beats = 0
+                elif result == 'failed':
+                    self._n_failed_beats += 1
+
+            was_down = self.state == 'down'
+
+            if self._n_failed_beats >= HEARTBEAT_DOWN_AFTER:
+                if self.state != 'down':
+                    print(f'Server at {self.host}:{self.port} is down')
+                self.state = 'down'
+            elif self._n_failed_beats > 0 or result == 'busy':
+                self.state = 'degraded'
+            else:
+                self.state = 'up'
+
+            # The server came back (restarted by somebody else)
+            if was_down and self.state == 'up':
+                print(f'Server at {self.host}:{self.port} is back up')
+                self._restore()
+
+            if crashed:
+                self._restart_server()
+
+            time.sleep(interval)
+
+
+    def _restart_server(self):
+        '''Restarts a crashed local server and calls on_restart.
+        '''
+        print(f'Restarting the local server on port {self.port}')
+        self.local_server = None
+        self._launch()
+        self.wait_server_ready()
+        if not self._beat() == 'up':
+            return
+        self._n_failed_beats = 0
+        self.state = 'up'
+        self._restore()
+
+
+    def _restore(self):
+        '''Restores the save directory and calls on_restart.
+        '''
+        try:
+            if self._save_directory is not None:
+                self.set_save_directory(self._save_directory)
+            self.on_restart()
+        except Exception as e:
+            print(f'Restoring the server state failed: {e}')
+
+
+    def on_restart(self):
+        '''Called after a crashed local server was restarted, or
+        after a server that was down is up again.
+
+        Subclasses restore the server's previous state here.
+        '''
+        pass
+
+
+    def sync_clock(self, n_pings=8):
+        '''Estimates the server's clock offset by pinging it.
+
+        Each call adds an estimate to self.clock; Calling this
+        repeatedly over a session allows estimating the clock drift.
+
+        Returns the ClockModel.
+        '''
+        def ping():
+            return float(self.send_command('clock', listen=True, n_retry=0))
+        self.clock.add_estimate(measure(ping, n_pings))
+        return self.clock
+
+    def get_stats(self):
+        '''Returns the server's per-command timing statistics.
+
+        See timings.CommandTimings.summary for the format.
+        '''
+        return json.loads(
+                self.send_command('stats', listen=True, raw=True))
+
     def set_save_directory(self, directory):
         '''For any data saving that the server can do, set the directory.
         '''
+        self._save_directory = directory
         self.send_command(f'set_save_directory;{directory}')
 
-    def start_server(self, name):
+    def start_server(self, name, wait=True, args=()):
         '''Starts a local server if it is not running.
 
-        Starts a new subprocess for the server.
+        Starts a new subprocess for the server. The server reports
+        back over a socket when it is ready to take commands.
         
         Arguments
         ---------
         name : string
             Name of the server. "camera" or "vio"
+        wait : bool
+            If True, wait until the server is ready. If False, return
+            immediately and call wait_server_ready later (allows
+            starting many servers in parallel).
+        args : list
+            Extra command line arguments for the server, for example
+            ['--camera', 'dummy']
         '''
         if name not in ['camera', 'vio']:
             raise ValueError(
                     f'name has to be "camera" or "vio" not {name}')
 
+        self._server_name = name
+        self._server_args = list(args)
+
         if self.is_server_running():
             print(f'Local server on port {self.port} already runs')
             print('-> Not starting another')
             return
 
+        self._launch()
+
+        if wait:
+            self.wait_server_ready()
+
+
+    def _launch(self):
+        '''Starts the local server process with the stored name and args.
+
+        Both start_server and the restarting of a crashed server
+        (see start_heartbeat) launch the server here, so that the
+        arguments given by the subclasses are used in both.
+        '''
         print(f'Starting a local server on port {self.port}')
 
-        self.local_server = subprocess.Popen(
-                [
-                    sys.executable,
-                    '-m', f'gonioimsoft.{name}_server',
-                    '--port', str(self.port),
-                    ],
-                stdout=subprocess.DEVNULL)
+        if self.supervisor is not None:
+            self.local_server = self.supervisor.start_server(
+                    self._server_name, self.port, self._server_args)
+        else:
+            self.local_server = ServerProcess(
+                    self._server_name, self.port, self._server_args)
 
+        atexit.unregister(self.close_server)
         atexit.register(self.close_server)
 
 
+    def hand_over_server(self, other):
+        '''Makes another client of the same server own the local server.
+
+        For a server shared by many clients (controlling many cameras)
+        when this client is removed but the others still use it. Stops
+        this client's heartbeat.
+        '''
+        self.stop_heartbeat()
+        other.local_server, self.local_server = self.local_server, None
+        other._server_name = self._server_name
+        other._server_args = self._server_args
+
+        atexit.unregister(self.close_server)
+        if other.local_server is not None:
+            atexit.unregister(other.close_server)
+            atexit.register(other.close_server)
+
+
+    def wait_server_ready(self, timeout=60):
+        '''Waits until the local server started by start_server is ready.
+
+        Arguments
+        ---------
+        timeout : int or float
+            In seconds, the maximum time to wait.
+
+        Returns True if the server reported ready (or if there is no
+        server starting up) and False otherwise.
+        '''
+        if self.local_server is None:
+            return True
+        return self.local_server.wait_ready(timeout)
+
+
     def close_server(self):
         '''Sens a closeure message for the server.
 
         If the server was started by this client (a local server), also
-        waits the subprocess finish for 10 seconds unil terminates it.
+        waits the subprocess to finish, terminating (and killing) it
+        if it does not exit in time. See supervisor.STOP_TIMEOUT.
         '''
+        # No automatic restarting of the server we are closing
+        self.stop_heartbeat()
+
         try:
             self.send_command('exit;parakalo', n_retry=0)
-        except ConnectionRefusedError:
+        except ConnectionError:
             pass
         
         if self.local_server is None:
@@ -155,12 +504,87 @@ class ClientBase:
 
         atexit.unregister(self.close_server)
 
-        if self.local_server is not None:
+        if self.supervisor is not None:
+            self.supervisor.stop_server(self.port)
+        else:
+            self.local_server.stop()
+        self.local_server = None
+
+
+class EventListener:
+    '''Waits events that the server sends over a kept-open connection.
+
+    Attributes
+    ----------
+    events : list
+        Events received so far, in the order of arrival.
+    closed : bool
+        True if the server has closed the connection.
+    '''
+
+    def __init__(self, soc):
+        self.soc = soc
+        self.events = []
+        self.closed = False
+        self._buffer = ''
+
+
+    def wait(self, event, timeout):
+        '''Waits until the server sends the given event.
+
+        Arguments
+        ---------
+        event : string
+            The event name to wait for, for example "armed"
+        timeout : int or float
+            In seconds, the maximum time to wait.
+
+        Returns True if the event was received, False if timed out
+        or if the server closed the connection (or reported an error)
+        without sending the event.
+        '''
+        end_time = time.time() + timeout
+
+        while event not in self.events:
+            if self.closed or 'error' in self.events:
+                return False
+
+            # When the time is up, still read what has already arrived
+            # (until the recv times out), to notice a closed connection
+            remaining = end_time - time.time()
+            self.soc.settimeout(max(remaining, 0.001))
             try:
-                self.local_server.wait(10)
-            except subprocess.TimeoutExpired:
-                self.local_server.terminate()
-            self.local_server = None
+                data = self.soc.recv(1024)
+            except socket.timeout:
+                return False
+            except OSError:
+                data = b''
+
+            if not data:
+                self.close()
+                continue
+
+            self._buffer += data.decode()
+            *lines, self._buffer = self._buffer.split('\n')
+            self.events.extend(lines)
+
+        return True
+
+
+    @property
+    def ended(self):
+        '''True if no more events can come (the server closed the
+        connection or reported an error).
+        '''
+        return self.closed or 'error' in self.events
+
+
+    def close(self):
+        '''Stops listening and closes the connection.
+        '''
+        if not self.closed:
+            self.soc.close()
+            self.closed = True
 
 
 def run_client(client):
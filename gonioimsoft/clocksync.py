@@ -0,0 +1,133 @@
+'''Estimating clock offsets between the core and the servers.
+
+Servers time stamp their data with their own clocks. To align camera
+frames, vio traces and encoder readings recorded on different PCs,
+each client estimates its server's clock offset (and drift) NTP style
+from repeated ping exchanges, using the round trips that were fastest.
+'''
+
+import time
+import datetime
+
+# How many clock samples to use in one estimate
+N_PINGS = 8
+
+# In seconds, the minimum time span of the estimates before the drift
+# is estimated (closely spaced estimates give only noise)
+MIN_DRIFT_SPAN = 30
+
+
+class ClockModel:
+    '''Offset and drift of a server clock relative to the core clock.
+
+    offset(t) = server_time - core_time at core time t, modelled as
+    a line through the estimates, offset(t) = offset + drift*(t-ref_time)
+
+    Attributes
+    ----------
+    estimates : list
+        (core_time, offset, round_trip) tuples, one per estimate
+    '''
+
+    def __init__(self):
+        self.estimates = []
+
+
+    def add_estimate(self, samples):
+        '''Adds an estimate from ping samples.
+
+        Arguments
+        ---------
+        samples : list
+            (t_sent, t_server, t_received) tuples where t_sent and
+            t_received are core times and t_server is the server's time
+            when it handled the ping.
+        '''
+        t_sent, t_server, t_received = min(samples, key=lambda s: s[2]-s[0])
+        core_time = (t_sent + t_received) / 2
+        self.estimates.append(
+                (core_time, t_server-core_time, t_received-t_sent))
+
+
+    @property
+    def ref_time(self):
+        return self.estimates[-1][0] if self.estimates else 0.
+
+    @property
+    def offset(self):
+        '''Latest estimated offset in seconds (server minus core).
+        '''
+        return self.estimates[-1][1] if self.estimates else 0.
+
+    @property
+    def drift(self):
+        '''Estimated drift in seconds per second (least squares fit).
+        '''
+        if len(self.estimates) < 2:
+            return 0.
+        times = [e[0] for e in self.estimates]
+        if times[-1] - times[0] < MIN_DRIFT_SPAN:
+            return 0.
+        offsets = [e[1] for e in self.estimates]
+        mean_t = sum(times) / len(times)
+        mean_o = sum(offsets) / len(offsets)
+        var = sum((t-mean_t)**2 for t in times)
+        if var == 0:
+            return 0.
+        return sum((t-mean_t)*(o-mean_o) for t, o in zip(times, offsets)) / var
+
+    @property
+    def uncertainty(self):
+        '''Half of the fastest round trip in seconds (error bound).
+        '''
+        if not self.estimates:
+            return None
+        return self.estimates[-1][2] / 2
+
+
+    def to_core_time(self, server_time):
+        '''Converts a server timestamp (seconds since epoch) to core time.
+        '''
+        drift = self.drift
+        return (server_time - self.offset + drift*self.ref_time) / (1+drift)
+
+
+    def to_core_datetime(self, server_datetime):
+        '''Converts a server datetime (or its string) to a core datetime.
+
+        The string format is the one of str(datetime.datetime.now()),
+        used in the saved camera metadata.
+        '''
+        if isinstance(server_datetime, str):
+            server_datetime = datetime.datetime.fromisoformat(server_datetime)
+        core_time = self.to_core_time(server_datetime.timestamp())
+        return datetime.datetime.fromtimestamp(core_time)
+
+
+    def to_dict(self):
+        '''Returns the model as a JSON serializable dictionary.
+        '''
+        return {'offset': self.offset, 'drift': self.drift,
+                'ref_time': self.ref_time, 'uncertainty': self.uncertainty,
+                'estimates': self.estimates}
+
+
+def measure(send_ping, n_pings=N_PINGS):
+    '''Collects clock samples using the given ping function.
+
+    Arguments
+    ---------
+    send_ping : callable
+        Sends a ping and returns the server's time as a float.
+    n_pings : int
+        How many pings to send.
+
+    Returns a list of (t_sent, t_server, t_received) tuples.
+    '''
+    samples = []
+    for i in range(n_pings):
+        t_sent = time.time()
+        t_server = send_ping()
+        t_received = time.time()
+        samples.append((t_sent, t_server, t_received))
+    return samples
@@ -1,6 +1,11 @@
 '''Common settings shared by the camera server/client
 '''
 
+import os
+import socket
+import platform
+import tempfile
+
 
 # Hostname (or IP address) of the server. This is the address that the
 # client tries to connect to
@@ -10,3 +15,63 @@ CAMERA_PORT = 50075
 # Voltage input output server/client
 VIO_PORT = 50085
 
+# Camera servers stream frames (if asked) at their port plus this
+STREAM_PORT_OFFSET = 1000
+
+# Local servers listen also on a Unix domain socket (faster than TCP)
+# when the platform supports it
+UNIX_SOCKETS = hasattr(socket, 'AF_UNIX') and platform.system() != 'Windows'
+
+# Hostnames that refer to this machine
+LOCAL_HOSTNAMES = ['127.0.0.1', 'localhost', '::1']
+
+
+# In bytes, commands up to this long are sent as they are and the
+# server reads them with one recv (as all the versions have done).
+# Longer commands get a "#{length}\n" header; Only the servers that
+# have the bulk settings commands understand it.
+PLAIN_COMMAND_BYTES = 1024
+
+
+def frame_command(command):
+    '''Returns the command string as bytes to send to a server.
+    '''
+    data = command.encode()
+    if len(data) <= PLAIN_COMMAND_BYTES:
+        return data
+    return f'#{len(data)}\n'.encode() + data
+
+
+def read_command(conn):
+    '''Reads one command sent as frame_command made it.
+
+    Returns the command as bytes (empty if the client sent nothing).
+    '''
+    data = conn.recv(PLAIN_COMMAND_BYTES)
+    if not data.startswith(b'#'):
+        return data
+
+    while b'\n' not in data:
+        chunk = conn.recv(4096)
+        if not chunk:
+            raise ConnectionError('The command header was cut short')
+        data += chunk
+    header, data = data[1:].split(b'\n', 1)
+    length = int(header)
+
+    chunks = [data]
+    n_read = len(data)
+    while n_read < length:
+        chunk = conn.recv(min(65536, length-n_read))
+        if not chunk:
+            raise ConnectionError(f'Got {n_read} of {length} command bytes')
+        chunks.append(chunk)
+        n_read += len(chunk)
+    return b''.join(chunks)
+
+
+def unix_socket_path(port):
+    '''Returns the Unix domain socket path used by a server at port.
+    '''
+    return os.path.join(tempfile.gettempdir(), f'gonioimsoft_{port}.sock')
+
@@ -4,18 +4,16 @@
 import os
 import sys
 import time
+import json
 import datetime
 import copy
+import bisect
 
 import numpy as np
 
-try:
-    import nidaqmx
-except ModuleNotFoundError:
-    nidaqmx = None
-
 from gonioimsoft.anglepairs import saveAnglePairs, loadAnglePairs, toDegrees
 from gonioimsoft.arduino_serial import ArduinoReader
+from gonioimsoft.clientbase import ServerDownError
 from gonioimsoft.camera_client import CameraClient
 from gonioimsoft.vio_client import VIOClient
 from gonioimsoft.motors import Motor
@@ -23,11 +21,40 @@ from gonioimsoft.imaging_parameters import (
         DEFAULT_DYNAMIC_PARAMETERS,
         load_parameters,
         getModifiedParameters)
-from gonioimsoft.stimulus import StimulusBuilder
+from gonioimsoft.stimulus import (
+        StimulusBuilder,
+        Waveform,
+        assemble_channels,
+        compile_repeats,
+        CHUNK_SIZE)
+from gonioimsoft.journal import CommandJournal
+from gonioimsoft.supervisor import ServerSupervisor
+from gonioimsoft.daq import DAQSession, port_words
 import gonioimsoft.macro as macro
 
 ENABLE_MOTORS = False
 
+# In seconds, how long to wait cameras to report being armed (ready
+# for triggers) or having completed their series acquisition
+ARMED_TIMEOUT = 5
+COMPLETE_TIMEOUT = 2
+
+# In seconds, how often to re-estimate the servers' clock offsets
+CLOCK_SYNC_INTERVAL = 60
+
+# In seconds, how long to wait instead if the cameras do not report
+# being armed (older camera servers), for series and for snaps
+ARMED_FALLBACK = 1
+SNAP_ARMED_FALLBACK = 0.2
+
+# In seconds, how long the IR is set to ir_imaging before the imaging
+# if the ir_settle parameter is not set (older presets)
+IR_SETTLE = 0.5
+
+# Outputs with more samples than this (over all the channels) are
+# streamed to the NI board in chunks instead of written at once
+STREAM_SAMPLES = 2000000
+
 class GonioImsoftCore:
     '''Main interface to control GonioImsoft recordings.
 
@@ -42,12 +69,25 @@ class GonioImsoftCore:
     vios : list
         Analog voltage input/ouput clients. Similar to the cameras,
         they talk to a vio server.
+    journal : obj or None
+        CommandJournal recording the commands sent by all the clients.
+        See start_journal.
+    supervisor : obj
+        ServerSupervisor owning the local server processes.
+    daq : obj
+        DAQSession keeping the NI tasks between the outputs. Without
+        nidaqmx, it simulates the NI board (see daq.SimulatedBackend).
     '''
 
 
-    def __init__(self, dynamic_parameters=DEFAULT_DYNAMIC_PARAMETERS):
+    def __init__(self, dynamic_parameters=DEFAULT_DYNAMIC_PARAMETERS,
+                 daq_backend=None):
         '''
         Sets up ArduinoReader, CameraClient/Server.
+
+        daq_backend : obj or None
+            NIBackend or SimulatedBackend, see daq.py. If None,
+            uses NI if nidaqmx is available.
         '''
 
         # Angle pairs reader (rotary encoder values)
@@ -104,8 +144,12 @@ class GonioImsoftCore:
 
         self._last_vio = time.time()
 
+        self.journal = None
+        self.supervisor = ServerSupervisor()
+        self.daq = DAQSession(daq_backend)
+
     
-    def _add_client(self, name, host, port):
+    def _add_client(self, name, host, port, wait=True):
         '''Adds a camera client to the given host and port.
 
         If host is None uses the localhost and starts a local
@@ -115,6 +159,10 @@ class GonioImsoftCore:
         ---------
         name : string
             The name of the client. "camera" or "vio"
+        wait : bool
+            If False, do not wait a local server to become ready.
+            See ClientBase.wait_server_ready. The heartbeat is then
+            not started either; Call start_heartbeat once ready.
         '''
         if name == 'camera':
             Client = CameraClient
@@ -130,9 +178,13 @@ class GonioImsoftCore:
             raise ValueError
 
         client = Client(host, port, running_index=index-1)
+        client.journal = self.journal
+        client.supervisor = self.supervisor
 
         if host is None and not client.is_server_running():
-            client.start_server()
+            client.start_server(wait=wait)
+        if wait:
+            client.start_heartbeat()
         register.append(client)
         
         return client
@@ -140,7 +192,61 @@ class GonioImsoftCore:
 
     def add_camera_client(self, host, port):
         return self._add_client('camera', host, port)
+
+    def add_local_camera_clients(self, n_cameras):
+        '''Adds many local camera clients at once.
+
+        The local servers are started up in parallel.
+
+        Arguments
+        ---------
+        n_cameras : int
+            How many cameras (clients and servers) to add.
+
+        Returns a list of the added clients.
+        '''
+        clients = [self._add_client('camera', None, None, wait=False)
+                   for i in range(n_cameras)]
+        for client in clients:
+            client.wait_server_ready()
+        # Beats before the server is ready would report it degraded
+        for client in clients:
+            client.start_heartbeat()
+        return clients
         
+    def add_local_multicamera_clients(self, n_cameras):
+        '''Adds many camera clients that share one local camera server.
+
+        The server controls all the cameras in one process, saving
+        memory and startup time compared to a server per camera.
+
+        Arguments
+        ---------
+        n_cameras : int
+            How many cameras (clients) to add.
+
+        Returns a list of the added clients.
+        '''
+        self.local_camera_servers_running_index += 1
+        index = self.local_camera_servers_running_index
+
+        devices = [f'cam{i}' for i in range(n_cameras)]
+        clients = []
+        for device in devices:
+            client = CameraClient(
+                    None, None, running_index=index-1, device=device)
+            client.journal = self.journal
+            client.supervisor = self.supervisor
+            clients.append(client)
+
+        if not clients[0].is_server_running():
+            clients[0].start_server(devices=devices)
+
+        for client in clients:
+            client.start_heartbeat()
+            self.cameras.append(client)
+        return clients
+
     def add_vio_client(self, host, port):
         return self._add_client('vio', host, port)
 
@@ -149,7 +255,7 @@ class GonioImsoftCore:
         if name == 'camera':
             register = self.cameras
         elif name == 'vio':
-            reigster = self.vios
+            register = self.vios
         # Popping is enough and the client should be garbage collected
         # by Python (the sockets are not kept alive so nothing is
         # left open etc. by the client)
@@ -161,9 +267,17 @@ class GonioImsoftCore:
         else:
             raise ValueError(f'Cannot remove {i_client} from clients')
 
-        # If the client started a local server, close the server
-        if client.local_server is not None:
+        # If the client started a local server, close the server.
+        # Clients of a server controlling many cameras share it; It
+        # is closed only with the last of them.
+        sharing = [other for other in register
+                   if (other.host, other.port) == (client.host, client.port)]
+        if client.local_server is not None and sharing:
+            client.hand_over_server(sharing[0])
+        elif client.local_server is not None:
             client.close_server()
+        else:
+            client.stop_heartbeat()
 
         return client
 
@@ -180,6 +294,127 @@ class GonioImsoftCore:
         return self._remove_client('camera', client)
    
 
+    def get_latency_stats(self):
+        '''Returns per-command timing statistics of the clients and servers.
+
+        Returns a dictionary where keys are client names ("cam0",
+        "vio0", ...) and values dictionaries with keys "client" and
+        "server" holding the timings.CommandTimings summaries. The
+        server summary is None if the server cannot be reached.
+        '''
+        stats = {}
+        clients = [(f'cam{i}', c) for i, c in enumerate(self.cameras)]
+        clients += [(f'vio{i}', c) for i, c in enumerate(self.vios)]
+
+        for name, client in clients:
+            try:
+                server_stats = client.get_stats()
+            except (ConnectionRefusedError, ValueError):
+                server_stats = None
+            stats[name] = {
+                    'client': client.timings.summary(),
+                    'server': server_stats}
+        return stats
+
+
+    def keep_spare(self, name='camera', preload=None):
+        '''Keeps a pre-warmed spare server to replace crashed servers.
+
+        Arguments
+        ---------
+        name : string
+            "camera" or "vio"
+        preload : string or None
+            For camera spares, the camera (MicroManager configuration)
+            that the spare loads beforehand. If None, uses the camera
+            of the first camera client, if set.
+        '''
+        args = []
+        if name == 'camera':
+            if preload is None and self.cameras:
+                preload = self.cameras[0]._camera
+            if preload is not None:
+                args = ['--preload', preload]
+        self.supervisor.keep_spare(name, args)
+
+
+    def get_server_status(self):
+        '''Returns the health and resource usage of the local servers.
+
+        See supervisor.ServerSupervisor.status
+        '''
+        return self.supervisor.status()
+
+
+    def start_journal(self, fn):
+        '''Starts recording all the client commands to a journal file.
+
+        The journal can be replayed against dummy servers using
+        python -m gonioimsoft.journal
+        '''
+        self.stop_journal()
+        self.journal = CommandJournal(fn)
+        for name, client in self._named_clients():
+            client.journal = self.journal
+        print(f'Recording commands to {fn}')
+
+
+    def stop_journal(self):
+        '''Stops recording the client commands.
+        '''
+        if self.journal is None:
+            return
+        for name, client in self._named_clients():
+            client.journal = None
+        self.journal.close()
+        self.journal = None
+
+
+    def _named_clients(self):
+        clients = [(f'cam_{i}', c) for i, c in enumerate(self.cameras)]
+        clients += [(f'vio_{i}', c) for i, c in enumerate(self.vios)]
+        return clients
+
+
+    def check_servers(self):
+        '''Raises ServerDownError if any of the servers is down.
+
+        The server states are tracked by the clients' heartbeats.
+        '''
+        for name, client in self._named_clients():
+            if client.state == 'down':
+                raise ServerDownError(
+                        f'The {name} server ({client.host}:{client.port}) is down')
+
+
+    def sync_clocks(self, force=False):
+        '''Estimates the clock offsets of all the servers.
+
+        Arguments
+        ---------
+        force : bool
+            If False, only servers not synced during the last
+            CLOCK_SYNC_INTERVAL seconds are synced.
+        '''
+        for name, client in self._named_clients():
+            if not force and time.time()-client.clock.ref_time < CLOCK_SYNC_INTERVAL:
+                continue
+            try:
+                client.sync_clock()
+            except ConnectionRefusedError:
+                print(f'Could not sync the clock of {name}')
+
+
+    def get_clock_metadata(self):
+        '''Returns the servers' clock models (see clocksync.ClockModel).
+
+        Returns a dictionary where keys are client names ("cam_0",
+        "vio_0", ...) and values the ClockModel dictionaries.
+        '''
+        return {name: client.clock.to_dict()
+                for name, client in self._named_clients()}
+
+
     def remove_vio_client(self, client):
         '''Removes the vio client and closes its server if local server
 
@@ -193,85 +428,132 @@ class GonioImsoftCore:
 
 
 
-    def analog_output(self, channels, stimuli, fs, wait_trigger, camera=True):
+    def analog_output(self, channels, stimuli, fs, wait_trigger, camera=True,
+                      raw=False, progress=None):
         '''
 
         channels    List of channel names
-        stimuli     List of 1D numpy arrays
+        stimuli     List of 1D numpy arrays or stimulus.Waveforms
         fs          Sampling frequency of the stimuli
         camera : bool
             If True, send the camera server a "ready" command
+        raw : bool
+            If True, write int16 codes and port words instead of
+            volts and bools (see daq.py)
+        progress : callable or None
+            If given, the output is streamed and progress is called
+            with the samples output so far, about once per chunk. If
+            it returns False, the output is stopped.
+
+        A channel can be a list of channel names that all output the
+        same stimulus. Long outputs given as Waveforms are streamed
+        (if all the channels are analog). The given lists and arrays
+        are not modified.
+
+        Returns False if stopped by progress, otherwise True.
         '''
-        
-        if nidaqmx is None:
-            print('    pretending analog_output on channels {}'.format(channels))
-            return None
-
-        # Pop off digital channels
-        index_digi = []
-        for i_channel, channel in enumerate(channels):
-            if isinstance(channel, str) and 'port' in channel:
-                index_digi.append(i_channel)
-
-        if index_digi:
-            dtask = nidaqmx.Task()
-            dout = []
-            for index in index_digi:
-                channel = channels.pop(index)
-                dout.append(stimuli.pop(index))
-                # Dev1/port0/line8
-                dtask.do_channels.add_do_chan(channel)
-                
-            dtask.timing.cfg_samp_clk_timing(float(fs), samps_per_chan=len(stimuli[0]))
-            #dtask.triggers.start_trigger.cfg_dig_edge_start_trig("/Dev1/PFI0", trigger_edge=nidaqmx.constants.Edge.RISING)
-            if len(dout) > 1:
-                stimulus = dout[0]
-                for s in dout[1:]:
-                    stimulus = np.vstack((stimulus, s))
+        aoplan, doplan = self._channel_plan(channels, stimuli)
+
+        if aoplan and not doplan:
+            if progress is not None or (
+                    any(isinstance(stimulus, Waveform) for stimulus in stimuli)
+                    and len(stimuli[0])*len(aoplan) > STREAM_SAMPLES):
+                return self._stream_output(aoplan, fs, wait_trigger, raw, progress)
+        elif progress is not None:
+            print('Warning! Digital outputs cannot be streamed, no progress until the output ends')
+
+        # The tasks are kept between the calls, only write and start
+        tasks = []
+        if aoplan:
+            aochannels = [channel for channel, stimulus in aoplan]
+            if raw:
+                stimulus = assemble_channels(
+                        [stimulus for channel, stimulus in aoplan], dtype=np.int16,
+                        scaling=self.daq.ao_scaling(aochannels))
             else:
-                stimulus = dout[0]
-            dout = np.digitize(stimulus, [1]).astype(bool)
-            dtask.write(dout)
-        
-        with nidaqmx.Task() as task:
-            for i_channel, channel in enumerate(channels):
-                if type(channel) == type('string'):
-                    task.ao_channels.add_ao_voltage_chan(channel)
-                else:
-                    for subchan in channel:
-                        task.ao_channels.add_ao_voltage_chan(subchan)
-                        stimuli.insert(i_channel, stimuli[i_channel])
-                    stimuli.pop(i_channel)
-
-            task.timing.cfg_samp_clk_timing(float(fs), samps_per_chan=len(stimuli[0]))
+                stimulus = assemble_channels([stimulus for channel, stimulus in aoplan])
+            tasks.append(self.daq.output(
+                    'ao', aochannels, stimulus, fs,
+                    trigger='rising' if wait_trigger else None, raw=raw))
+        if doplan:
+            dochannels = [channel for channel, stimulus in doplan]
+            dout = assemble_channels([stimulus for channel, stimulus in doplan], dtype=bool)
+            if raw:
+                dochannels, dout = port_words(dochannels, dout)
+            tasks.append(self.daq.output('do', dochannels, dout, fs, raw=raw))
+
+        #if camera:
+        #    for camera in self.cameras:
+        #        camera.send_command('ready')
             
-            if len(stimuli) > 1:
-                stimulus = stimuli[0]
-                for s in stimuli[1:]:
-                    stimulus = np.vstack((stimulus, s))
-            else:
-                stimulus = stimuli[0]
+        timeout = (len(stimuli[0])/fs)*1.5+20
+        for task in tasks:
+            self.daq.wait_done(task, timeout)
+        return True
 
-            task.write(stimulus)
-            
 
-            if wait_trigger:
-                task.triggers.start_trigger.cfg_dig_edge_start_trig("/Dev1/PFI0", trigger_edge=nidaqmx.constants.Edge.RISING)
+    @staticmethod
+    def _channel_plan(channels, stimuli):
+        '''Pairs each physical channel with its stimulus.
 
-            
-            task.start()
-            if index_digi:
-                dtask.start()
+        Returns (aoplan, doplan), lists of (channel, stimulus) for the
+        analog and the digital ("port" in the name) channels.
+        '''
+        aoplan = []
+        doplan = []
+        for channel, stimulus in zip(channels, stimuli):
+            if isinstance(channel, str):
+                if 'port' in channel:
+                    # Dev1/port0/line8
+                    doplan.append((channel, stimulus))
+                else:
+                    aoplan.append((channel, stimulus))
+            else:
+                for subchan in channel:
+                    aoplan.append((subchan, stimulus))
+        return aoplan, doplan
 
-            #if camera:
-            #    for camera in self.cameras:
-            #        camera.send_command('ready')
-                
-            task.wait_until_done(timeout=(len(stimuli[0])/fs)*1.5+20)
 
-        if index_digi:
-            dtask.wait_until_done(timeout=(len(stimuli[0])/fs)*1.5+20)
-            dtask.close()
+    def _stream_output(self, aoplan, fs, wait_trigger, raw=False, progress=None):
+        '''Outputs analog stimuli in chunks, see analog_output.
+        '''
+        aochannels = [channel for channel, stimulus in aoplan]
+        scaling = self.daq.ao_scaling(aochannels) if raw else None
+        waveforms = []
+        for channel, stimulus in aoplan:
+            if not isinstance(stimulus, Waveform):
+                stimulus = Waveform([np.asarray(stimulus)])
+            waveforms.append(stimulus)
+        n_samples = len(waveforms[0])
+
+        # Progress is reported once per chunk, at least every second
+        chunk_size = CHUNK_SIZE
+        if progress is not None:
+            chunk_size = max(1, min(CHUNK_SIZE, int(fs)))
+
+        def chunks():
+            for i0 in range(0, n_samples, chunk_size):
+                # The board buffers two chunks, so when the next one is
+                # asked the output is about two chunks behind
+                if progress is not None and i0 >= 2*chunk_size:
+                    if progress(i0-2*chunk_size) == False:
+                        return
+                i1 = min(i0+chunk_size, n_samples)
+                chunk = np.empty((len(waveforms), i1-i0))
+                for row, waveform in zip(chunk, waveforms):
+                    waveform.get(i0, i1, out=row)
+                if raw:
+                    yield assemble_channels(list(chunk), dtype=np.int16, scaling=scaling)
+                elif len(waveforms) == 1:
+                    yield chunk[0]
+                else:
+                    yield chunk
+
+        print(f'Streaming {n_samples/fs:.1f} s of output on {aochannels}')
+        return self.daq.stream(
+                'ao', aochannels, chunks(), n_samples, fs,
+                trigger='rising' if wait_trigger else None, raw=raw)
+
 
     def send_trigger(self):
         '''
@@ -282,17 +564,9 @@ class GonioImsoftCore:
         if isinstance(chans, str):
             chans = [chans]
         for chan in chans:
-            if nidaqmx is None:
-                print(f'    pretending to send trigger on chan {chan}')
-                return None
-
             if chan:
-                with nidaqmx.Task() as task:
-                    task.ao_channels.add_ao_voltage_chan(chan)
-                    task.timing.cfg_samp_clk_timing(1000., samps_per_chan=4)
-                    task.write(self.trigger_signal)
-                    task.start()
-                    task.wait_until_done(timeout=1.)
+                task = self.daq.output('ao', [chan], self.trigger_signal, 1000.)
+                self.daq.wait_done(task, 1.)
             else:
                 print('trigger_out_channel not specified, no trigger out')
 
@@ -307,37 +581,25 @@ class GonioImsoftCore:
         INPUT ARGUMENTS     DESCRIPTION
         device              A string (single device) or a list of strings (many devices at once)
         '''
-        if nidaqmx is None:
-            print(f'    pretending to set {device} on value {value}')
-            return None
-
         if isinstance(device, str) and device.lower() in ['none']:
             return
 
-        excluded = 0
-
-        with nidaqmx.Task() as task:
-            
-            if type(device) == type('string'):
-                # If there's only a single device
-                if '/port' in device:
-                    task.do_channels.add_do_chan(device)
-                    value = bool(value)
-                else:
-                    task.ao_channels.add_ao_voltage_chan(device)
-            else:
-                # If device is actually a list of devices
-                for dev in device:
-                    if exclude and dev in exclude:
-                        excluded += 1
-                        continue
-                    task.ao_channels.add_ao_voltage_chan(dev)
-                value = [value for i in range(len(device)-excluded)]
-            
-            if wait_trigger:
-                task.timing.cfg_samp_clk_timing(10000)
-                task.triggers.start_trigger.cfg_dig_edge_start_trig("/Dev1/PFI0", trigger_edge=nidaqmx.constants.Edge.FALLING)
-            task.write(value)
+        kind = 'ao'
+        if type(device) == type('string'):
+            # If there's only a single device
+            channels = [device]
+            if '/port' in device:
+                kind = 'do'
+                value = bool(value)
+        else:
+            # If device is actually a list of devices
+            channels = [dev for dev in device if not (exclude and dev in exclude)]
+            value = [value for i in range(len(channels))]
+        
+        if wait_trigger:
+            self.daq.write(kind, channels, value, fs=10000, trigger='falling')
+        else:
+            self.daq.write(kind, channels, value)
             
 
 
@@ -345,19 +607,90 @@ class GonioImsoftCore:
         '''
         Doesn't return until trigger signal is received.
         '''
-        if nidaqmx is None:
-            print(f'    waiting for trigger')
-            return None
+        self.daq.wait_trigger('Dev1/ai0', 10000, trigger='rising')
+
+    def _wait_cameras_armed(self, timeout=ARMED_TIMEOUT, fallback=ARMED_FALLBACK):
+        '''Waits until all the cameras are ready for the triggers.
+
+        If some camera did not report armed in time, waits fallback
+        seconds more.
+
+        Returns True if all the cameras reported armed in time.
+        '''
+        end_time = time.time() + timeout
+        armed = True
+        for i_camera, camera in enumerate(self.cameras):
+            if not camera.wait_armed(max(end_time-time.time(), 0)):
+                print(f'Warning! cam{i_camera} did not report armed')
+                armed = False
+        if not armed:
+            self._settle(time.time(), fallback, 'the cameras to get ready')
+        return armed
+
+
+    @staticmethod
+    def _settle(since, duration, what):
+        '''Waits until duration seconds have passed since the given time.
+
+        For the delays that have no readiness signal to wait for,
+        such as the optics settling after the IR change. Prints how
+        long was waited.
+        '''
+        remaining = since + duration - time.time()
+        if remaining > 0:
+            print(f'Waiting {remaining:.3f} s for {what}')
+            time.sleep(remaining)
+
+
+    def _release_cameras(self, timeout=COMPLETE_TIMEOUT, max_triggers=3):
+        '''Waits the cameras complete their series, triggering if needed.
+
+        A camera that missed some trigger pulses keeps waiting for
+        the missed frames, so extra triggers are sent only then.
+        Cameras whose acquisition ended without completing (error or
+        closed connection) wait nothing and are not triggered.
+
+        Returns True if all the cameras completed.
+        '''
+        ended = False
+        for i_trigger in range(max_triggers+1):
+            waiting = []
+            for camera in self.cameras:
+                if camera.wait_complete(timeout):
+                    continue
+                if camera.series_events is None:
+                    ended = True
+                else:
+                    waiting.append(camera)
+            if not waiting:
+                return not ended
+            if i_trigger < max_triggers:
+                print(f'{len(waiting)} camera(s) not complete, sending a trigger')
+                self.do_trigger()
+                timeout = 0.1
+        
+        print('Warning! Cameras did not complete their acquisition')
+        return False
+
+
+    def release_cameras(self):
+        '''Triggers the cameras that still wait triggers (of a snap).
+
+        Returns straight away if no camera is waiting.
+        '''
+        return self._release_cameras(timeout=0)
+
+
+    def abort_acquisitions(self):
+        '''Aborts the series acquisitions running on the cameras.
+        '''
+        for i_camera, camera in enumerate(self.cameras):
+            if camera.abort_acquisition():
+                print(f'Aborted the acquisition of cam_{i_camera}')
+            if camera.series_events is not None:
+                camera.series_events.close()
+                camera.series_events = None
 
-        with nidaqmx.Task() as task:
-            device = nidaqmx.system.device.Device('Dev1')
-            
-            task.ai_channels.add_ai_voltage_chan('Dev1/ai0' )
-            
-            task.timing.cfg_samp_clk_timing(10000)
-            
-            task.triggers.start_trigger.cfg_dig_edge_start_trig("/Dev1/PFI0", trigger_edge=nidaqmx.constants.Edge.RISING)
-            task.read(number_of_samples_per_channel=1)
 
     def do_trigger(self):
         chans = self.dynamic_parameters.get('trigger_out_channel', None)
@@ -388,16 +721,22 @@ class GonioImsoftCore:
         save        Whether to save the image directly or not.
         '''
         if save:
+            self.check_servers()
             self.set_led(self.dynamic_parameters['ir_channel'], self.dynamic_parameters['ir_imaging'])
-            time.sleep(0.3)
+            ir_time = time.time()
             for i_camera, camera in enumerate(self.cameras):
                 camera.acquireSingle(
                     True, os.path.join(self.preparation['name'], 'snaps'),
                     exposure_time=self.snap_exposure_time, suffix=f'cam{i_camera}'
                     )
 
-            time.sleep(0.2)
+            # The IR settles while the cameras get armed
+            self._wait_cameras_armed(fallback=SNAP_ARMED_FALLBACK)
+            self._settle(
+                    ir_time, self.dynamic_parameters.get('ir_settle', IR_SETTLE),
+                    'the IR to settle')
             self.do_trigger()
+            self._release_cameras(timeout=self.snap_exposure_time+COMPLETE_TIMEOUT)
             
             self.set_led(self.dynamic_parameters['ir_channel'], self.dynamic_parameters['ir_livefeed'])
             
@@ -408,11 +747,14 @@ class GonioImsoftCore:
                 return
 
             for camera in self.cameras:
+                if camera.state == 'down':
+                    continue
                 camera.acquireSingle(
                     False, '', exposure_time=self.live_exposure_time)
             
-            time.sleep(0.1)
+            self._wait_cameras_armed(fallback=SNAP_ARMED_FALLBACK)
             self.do_trigger()
+            self._release_cameras(timeout=self.live_exposure_time+COMPLETE_TIMEOUT)
 
 
 
@@ -455,6 +797,9 @@ class GonioImsoftCore:
         
         exit_imaging = False
 
+        # Fail fast instead of waiting for the servers' responses
+        self.check_servers()
+
         print('Starting dynamic imaging using {} triggering'.format(trigger))
         if trigger == 'none':
             imaging_function = self.image_trigger_none
@@ -475,6 +820,17 @@ class GonioImsoftCore:
         
         dynamic_parameters = copy.deepcopy(self.dynamic_parameters)
 
+        compiled = dynamic_parameters.get('compile_protocol', False)
+        if compiled and trigger != 'from-NI':
+            print('Warning! compile_protocol needs from-NI triggering, imaging repeat by repeat')
+            compiled = False
+        if compiled and dynamic_parameters['reboot_cameras']:
+            print('Warning! reboot_cameras is ignored with compile_protocol (one acquisition for all repeats)')
+        builders = []
+        labels = []
+
+        self.sync_clocks()
+
         # Check that certain variables are actually lists (used for intensity series etc.)
         # Check also for correct length if a list
         for param in ['isi', 'flash_on']:
@@ -507,7 +863,8 @@ class GonioImsoftCore:
             label = 'im_pos{}_rep{}'.format(spaceless_angle, i)
             
             # INTER_LOOP_CALLBACK for showing info to the user and for exiting
-            if callable(inter_loop_callback) and inter_loop_callback(label, i) == False:
+            # (when compiled, called during the output instead)
+            if not compiled and callable(inter_loop_callback) and inter_loop_callback(label, i) == False:
                 exit_imaging = True  
             if exit_imaging:
                 break
@@ -530,6 +887,12 @@ class GonioImsoftCore:
             if i==0 and dynamic_parameters['avgint_adaptation']:
                 self.set_led(dynamic_parameters['flash_channel'], np.mean(builder.get_stimulus_pulse()), exclude='Dev1/ao4')
                 time.sleep(dynamic_parameters['avgint_adaptation'])
+
+            if compiled:
+                # Imaged all at once after the loop
+                builders.append(builder)
+                labels.append(label)
+                continue
             
             imaging_function(dynamic_parameters, builder, label, N_frames, image_directory, set_led=bool(dynamic_parameters['isi'][i]))
 
@@ -562,6 +925,13 @@ class GonioImsoftCore:
                         break
                     time.sleep(0.01)
 
+        if builders and not exit_imaging:
+            if self.image_series_compiled(
+                    dynamic_parameters, builders, labels, N_frames, image_directory,
+                    inter_loop_callback=inter_loop_callback) == False:
+                exit_imaging = True
+            self.isi_slept_time = time.time() + dynamic_parameters['isi'][len(builders)-1]
+
         self.set_led(dynamic_parameters['flash_channel'], dynamic_parameters['flash_off'])
         self.set_led(dynamic_parameters['ir_channel'], dynamic_parameters['ir_livefeed'])
         print('DONE!')
@@ -572,6 +942,189 @@ class GonioImsoftCore:
             return True
 
 
+    @staticmethod
+    def _use_ir(dynamic_parameters):
+        return dynamic_parameters['ir_channel'].lower() not in ['none']
+
+
+    def _stimulus_waveforms(self, dynamic_parameters, builder, set_led):
+        '''Returns the channels and Waveforms of the stimulus and the IR.
+
+        set_led : bool
+            If True, the IR waveform ends to ir_waiting
+        '''
+        stimulus = builder.get_stimulus_waveform()
+
+        if isinstance(stimulus, list):
+            # Many stimulus channels
+            print('Many stimulus channels')
+            stimuli = [*stimulus]
+            channels = [*dynamic_parameters['flash_channel']]
+        else:
+            # One stimulus channel
+            stimuli = [stimulus]
+            channels = [dynamic_parameters['flash_channel']]
+
+        if self._use_ir(dynamic_parameters):
+            irwave = Waveform()
+            irwave.constant(dynamic_parameters['ir_imaging'], len(stimuli[0]))
+            if set_led:
+                irwave.set_last(dynamic_parameters['ir_waiting'])
+            stimuli.append(irwave)
+            channels.append(dynamic_parameters['ir_channel'])
+
+        return channels, stimuli
+
+
+    def _trigger_waveforms(self, builder, n_samples):
+        '''Returns the trigger out channels and their Waveforms.
+
+        With cameras, the camera frame triggers. Without cameras, one
+        pulse at the start (to sync the analog inputs).
+        '''
+        chans = self.dynamic_parameters.get('trigger_out_channel', None)
+        if isinstance(chans, str):
+            chans = [chans]
+        N = len(chans)
+
+        if not self.cameras:
+            trigwave = Waveform()
+            trigwave.constant(3, min(100, n_samples))
+            trigwave.constant(0, n_samples-100)
+            return chans, N*[trigwave]
+        return chans, builder.get_camera_waveforms(N, interleaved=False)
+
+
+    def image_series_compiled(self, dynamic_parameters, builders, labels, N_frames, image_directory,
+                              inter_loop_callback=None):
+        '''Images all the repeats with one hardware-timed output.
+
+        The stimuli, IR and camera triggers of all the repeats and the
+        ISIs between them are compiled into one waveform per channel
+        and streamed to a single NI task, so the ISIs are sample
+        accurate. The cameras are armed once for the whole train and
+        save the frames of each repeat under its label. The vios
+        record the whole train into one file.
+
+        Arguments
+        ---------
+        builders : list
+            StimulusBuilder of each repeat
+        labels : list
+            Label of each repeat
+        N_frames : int
+            Frames per repeat
+        inter_loop_callback : callable or None
+            Called as in image_series while the output runs, with the
+            label when a repeat starts and None in between. If it
+            returns False, the output and the acquisitions are stopped.
+
+        Returns True if finished properly and False if user cancelled.
+        '''
+        fs = builders[0].fs
+        if any(builder.fs != fs for builder in builders):
+            raise ValueError('All the compiled repeats need the same sampling rate')
+
+        use_ir = self._use_ir(dynamic_parameters)
+        ir_settle = dynamic_parameters.get('ir_settle', IR_SETTLE)
+        repeats = []
+        gaps = []
+        starts = []
+        n_total = 0
+        for i, builder in enumerate(builders):
+            isi = dynamic_parameters['isi'][i]
+            channels, stimuli = self._stimulus_waveforms(
+                    dynamic_parameters, builder, set_led=bool(isi))
+            chans, trigwaves = self._trigger_waveforms(builder, len(stimuli[0]))
+            repeats.append([*stimuli, *trigwaves])
+
+            # The ISI after the last repeat is waited as usual
+            n_gap = int(isi*fs) if i+1 < len(builders) else 0
+            starts.append(n_total)
+            n_total += len(stimuli[0]) + n_gap
+
+            # During the ISI, the outputs stay at their final values,
+            # the IR is turned to ir_imaging ir_settle before the next
+            # repeat and the flash shows the stimulus mean value after
+            # the first repeat if avgint_adaptation
+            levels = [waveform.last for waveform in [*stimuli, *trigwaves]]
+            if i == 0 and dynamic_parameters['avgint_adaptation']:
+                for i_flash in range(len(stimuli)-int(use_ir)):
+                    levels[i_flash] = stimuli[i_flash].mean()
+
+            gap = []
+            for level in levels:
+                gap.append(Waveform())
+                gap[-1].constant(level, n_gap)
+            if use_ir:
+                n_warmup = min(int(ir_settle*fs), n_gap)
+                gap[len(stimuli)-1] = irgap = Waveform()
+                irgap.constant(levels[len(stimuli)-1], n_gap-n_warmup)
+                irgap.constant(dynamic_parameters['ir_imaging'], n_warmup)
+            gaps.append(gap)
+
+        stimuli = compile_repeats(repeats, gaps)
+        channels = [*channels, *chans]
+        duration = len(stimuli[0]) / fs
+        print(f'Compiled {len(builders)} repeats into {duration:.1f} s of output')
+
+        # Release cameras still waiting triggers from the last run
+        self._release_cameras(timeout=0)
+
+        ir_time = None
+        if use_ir:
+            self.set_led(dynamic_parameters['ir_channel'], dynamic_parameters['ir_imaging'])
+            ir_time = time.time()
+
+        # One recording for the whole train, ISIs included, named
+        # after its first and last repeat
+        for i_vio, vio in enumerate(self.vios):
+            vio.set_save_directory(os.path.join(self.data_savedir, image_directory))
+            vio_label = f'vi{i_vio}{labels[0][2:]}-{len(labels)-1}'
+            print(f'Recording all the repeats into {vio_label}')
+            vio.analog_input(duration, save=vio_label, wait_trigger=True)
+
+        for i_camera, camera in enumerate(self.cameras):
+            camera_labels = labels
+            if len(self.cameras) > 1:
+                camera_labels = [f'{label}_cam{i_camera}' for label in labels]
+            camera.acquireSeries(
+                    dynamic_parameters['frame_length'], 0, N_frames*len(labels),
+                    camera_labels, image_directory, frames_per_label=N_frames)
+
+        self._wait_cameras_armed()
+        if ir_time is not None:
+            self._settle(ir_time, ir_settle, 'the IR to settle')
+
+        i_current = [-1]
+        def progress(i_sample):
+            i = max(0, bisect.bisect_right(starts, i_sample)-1)
+            if not callable(inter_loop_callback):
+                return True
+            if i == i_current[0]:
+                return inter_loop_callback(None, i)
+            # Every repeat is told, even if it started between two calls
+            for i_repeat in range(i_current[0]+1, i+1):
+                i_current[0] = i_repeat
+                if inter_loop_callback(labels[i_repeat], i_repeat) == False:
+                    return False
+            return True
+
+        finished = self.analog_output(
+                channels, stimuli, fs, wait_trigger=False,
+                raw=dynamic_parameters.get('raw_output', False),
+                progress=progress)
+        if finished:
+            # The last chunks are output without progress calls
+            finished = progress(n_total-1)
+        if finished == False:
+            print(f'Stopped during repeat {i_current[0]}, the frames acquired so far are saved')
+            self.abort_acquisitions()
+            return False
+        self._release_cameras()
+        return True
+
+
     def image_trigger_hard_cameramaster(self, dynamic_parameters, builder, label, N_frames, image_directory, set_led=True,
                                         wait_for_trigger='from-NI'):
         '''
@@ -591,51 +1144,17 @@ class GonioImsoftCore:
             If False, does not wait for trigger.
         '''
         if wait_for_trigger == 'from-NI':
-            # Trigger to release
-            self.do_trigger()
-            self.do_trigger()
+            # Release cameras still waiting triggers from the last run
+            self._release_cameras(timeout=0)
 
-        # If IR is used or not
-        if dynamic_parameters['ir_channel'].lower() in ['none']:
-            use_ir = False
-        else:
-            use_ir = True            
-        
-        if use_ir and set_led:
+        ir_time = None
+        if self._use_ir(dynamic_parameters) and set_led:
             self.set_led(dynamic_parameters['ir_channel'], dynamic_parameters['ir_imaging'])
-            time.sleep(0.5)
+            ir_time = time.time()
         
         fs = builder.fs
 
-        # Create stimulus
-        stimulus = builder.get_stimulus_pulse()
-        if isinstance(stimulus, list):
-            NN = len(stimulus[0])
-        else:
-            NN = stimulus.shape
-
-        if use_ir:
-            irwave = dynamic_parameters['ir_imaging'] * np.ones(NN)
-            #irwave = dynamic_parameters['ir_imaging'] * np.ones(stimulus.shape)
-            if set_led:
-                irwave[-1] = dynamic_parameters['ir_waiting']
-
-        stimuli = []
-        channels = []
-
-        if isinstance(stimulus, list):
-            # Many stimulus channels
-            print('Many stimulus channels')
-            stimuli = [*stimulus]
-            channels = [*dynamic_parameters['flash_channel']]
-        else:
-            # One stimulus channel
-            stimuli = [stimulus]
-            channels = [dynamic_parameters['flash_channel']]
-
-        if use_ir:
-            stimuli.append(irwave)
-            channels.append(dynamic_parameters['ir_channel'])
+        channels, stimuli = self._stimulus_waveforms(dynamic_parameters, builder, set_led)
 
 
         # Arm analog input recording if any vio clients
@@ -645,6 +1164,12 @@ class GonioImsoftCore:
             vio_label = f'vi{i_vio}{label[2:]}'
             vio.analog_input(duration, save=vio_label, wait_trigger=True)
 
+        # The IR settles while the stimuli are made and the vios armed;
+        # Cameras triggering the NI board start right when armed
+        if ir_time is not None:
+            self._settle(
+                    ir_time, dynamic_parameters.get('ir_settle', IR_SETTLE),
+                    'the IR to settle')
 
         if len(self.cameras) == 1:
             self.cameras[0].acquireSeries(dynamic_parameters['frame_length'], 0, N_frames, label, image_directory)
@@ -659,38 +1184,16 @@ class GonioImsoftCore:
         # - This is needed to sync two NI cards, one input one output
         # - If only one NI card then not needed?
         print(f'Wait for trigger is: {wait_for_trigger}')
-        if not self.cameras:
+        if not self.cameras or wait_for_trigger == 'from-NI':
             wait_trigger = False
-            trigwave = np.zeros(len(stimuli[0]))
-            for i in range(min(100, len(trigwave))):
-                trigwave[i] = 3
-
-            chans = self.dynamic_parameters.get('trigger_out_channel', None)
-            if isinstance(chans, str):
-                chans = [chans]
-            N =len(chans)
-            
-            stimuli = [*stimuli, *(N*[trigwave])]
-            channels = [*channels, *chans]
-        elif wait_for_trigger == 'from-NI':
-            wait_trigger = False
-            
-
-            chans = self.dynamic_parameters.get('trigger_out_channel', None)
-            if isinstance(chans, str):
-                chans = [chans]
-            N=len(chans)
-
-            trigwaves = builder.get_camera(N, interleaved=False)
 
+            chans, trigwaves = self._trigger_waveforms(builder, len(stimuli[0]))
             stimuli = [*stimuli, *trigwaves]
             channels = [*channels, *chans]
 
-            #stimuli = [*stimuli, trigwave]
-            #channels = [*channels, dynamic_parameters['trigger_out_channel']]
-
-            # Give 1000 ms for the cameras to get ready for incoming trigger
-            time.sleep(1)
+            # Wait the cameras to get ready for the incoming trigger
+            if self.cameras:
+                self._wait_cameras_armed()
         elif wait_for_trigger == 'to-NI':
             wait_trigger = True
         elif not wait_for_trigger:
@@ -700,11 +1203,11 @@ class GonioImsoftCore:
         print(f'Wait trigger is: {wait_trigger}')
 
         
-        self.analog_output(channels, stimuli, fs, wait_trigger=wait_trigger)
+        self.analog_output(
+                channels, stimuli, fs, wait_trigger=wait_trigger,
+                raw=dynamic_parameters.get('raw_output', False))
         if wait_for_trigger == 'from-NI':
-            self.do_trigger()
-            self.do_trigger()
-            self.do_trigger()
+            self._release_cameras()
 
     def set_savedir(self, savedir, camera=True):
         '''
@@ -742,6 +1245,13 @@ class GonioImsoftCore:
         desc_string += '\n#CAMERA NUMBER-NAME RELATIONS\n'
         for i_camera, camera in enumerate(self.cameras):
             desc_string += f'cam_{i_camera} {camera.get_camera()}\n'
+
+        # Server clocks relative to the core's clock, for aligning
+        # the server time stamps (core_time = server_time - offset)
+        desc_string += '\n#CLOCK OFFSETS (server minus core) OFFSET_S DRIFT_S/S UNCERTAINTY_S\n'
+        for name, client in self._named_clients():
+            clock = client.clock
+            desc_string += f'{name} {clock.offset} {clock.drift} {clock.uncertainty}\n'
             
         for camera in self.cameras:
             camera.saveDescription(self.preparation['name'], desc_string)
@@ -770,6 +1280,8 @@ class GonioImsoftCore:
 
         self.dynamic_parameters = params
 
+        self.sync_clocks(force=True)
+
         if camera:
             self._update_descriptions_file()
         else:
@@ -788,6 +1300,8 @@ class GonioImsoftCore:
     def load_preset(self, preset_name):
         fn = os.path.join('presets', preset_name)
         self.dynamic_parameters = load_parameters(fn)
+        # The channels may have changed
+        self.daq.close()
         self._update_descriptions_file()
 
 
@@ -883,10 +1397,21 @@ class GonioImsoftCore:
 
             self.triggered_anglepairs = None
 
+        if self.data_savedir and (self.cameras or self.vios):
+            fn = os.path.join(self.data_savedir, self.preparation['name'], 'clocks.json')
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            with open(fn, 'w') as fp:
+                json.dump(self.get_clock_metadata(), fp)
+
 
     def exit(self):
         for camera in self.cameras:
             camera.close_server()
+        for vio in self.vios:
+            vio.close_server()
+        self.supervisor.close()
+        self.daq.close()
+        self.stop_journal()
 
     #
     # CONTROLLING LEDS, MOTORS ETC
@@ -0,0 +1,806 @@
+'''Reusing NI-DAQmx tasks between the outputs.
+
+Creating an NI task, adding its channels, configuring the timing and
+reserving the hardware takes tens of milliseconds, and the core sends
+triggers and sets LEDs many times per imaging repeat. The DAQSession
+creates and commits each task once and keeps it. Later calls with the
+same channels, timing and trigger only write the data and start.
+
+A task is identified by its key
+
+    (kind, channels, fs, n_samples, trigger)
+
+where kind is "ao", "do" or "ai". When any of these change, a new
+task is made and the cached tasks sharing channels with it are closed
+(an NI channel can be reserved by one task at a time).
+
+Backends
+--------
+The tasks come from a backend. NIBackend makes real nidaqmx tasks and
+SimulatedBackend simulated ones, so that the timing sensitive code
+can run and be tested on a machine without the NI board. A backend
+has the methods
+
+    create_task(kind, channels, fs, n_samples, trigger, trigger_source)
+    commit(task)        Returns False if the resources are reserved
+    unreserve(task)
+
+and the tasks have the write, start, stop, wait_until_done, read and
+close methods of nidaqmx.Task.
+
+Streaming
+---------
+Long outputs can be streamed (DAQSession.stream). The task gets a
+buffer of two chunks that is not regenerated, and each next chunk is
+written as the board drains the buffer, so the memory use does not
+depend on the output length.
+
+Raw output
+----------
+Instead of float64 volts and a bool per line, outputs can be written
+raw (raw=True): analog samples as int16 DAC codes (see
+DAQSession.ao_scaling for the calibration) and digital lines packed
+into uint32 port words (see port_words). The buffers are a quarter
+of the size and the driver does not need to scale them. The backends
+write raw data with
+
+    write_raw(task, data, timeout)
+    ao_scaling(task)    Volts to codes coefficients of each channel
+
+A digital channel name listing many lines separated by commas is
+made one channel (all the lines in one port word).
+'''
+
+import time
+import collections
+import importlib.util
+
+import numpy as np
+
+# The heavy nidaqmx is imported only when a NIBackend is made
+if importlib.util.find_spec('nidaqmx') is None:
+    HAS_NIDAQMX = False
+else:
+    HAS_NIDAQMX = True
+
+# The trigger input of the output board
+TRIGGER_SOURCE = '/Dev1/PFI0'
+
+# How many tasks to keep at most; The least recently used is closed
+MAX_TASKS = 16
+
+# How many written waveforms (or samples in them) the SimulatedBackend
+# remembers at most
+HISTORY_LENGTH = 1000
+HISTORY_SAMPLES = 10000000
+
+# Volts to codes coefficients of the simulated analog outputs, as of a
+# 16-bit DAC with the range of -10 to 10 V
+SIMULATED_AO_SCALING = (0., 3276.7)
+
+
+def split_lines(channels):
+    '''Returns the set of the channels, digital line lists split.
+    '''
+    return {line for channel in channels for line in channel.split(',')}
+
+
+def port_words(channels, lines):
+    '''Packs digital line samples into port words for raw output.
+
+    Arguments
+    ---------
+    channels : list
+        Line channel names, for example ["Dev1/port0/line8"]
+    lines : array
+        (lines, samples) or 1D for one line; Nonzero is high
+
+    Returns (ports, words) where ports are the channel names for the
+    task (the lines of each port joined by commas) and words an
+    uint32 (ports, samples) array where the bit n is the line n.
+    '''
+    lines = np.asarray(lines).reshape(len(channels), -1)
+
+    ports = {}
+    for channel, line in zip(channels, lines):
+        port, sep, number = channel.rpartition('/line')
+        if not sep or not number.isdigit():
+            raise ValueError(f'Raw digital output needs single lines, not {channel}')
+        ports.setdefault(port, []).append((channel, int(number), line))
+
+    names = []
+    words = np.zeros((len(ports), lines.shape[1]), dtype=np.uint32)
+    for word, port_lines in zip(words, ports.values()):
+        names.append(','.join(channel for channel, number, line in port_lines))
+        for channel, number, line in port_lines:
+            word |= line.astype(np.uint32) << number
+    return names, words
+
+
+class NIBackend:
+    '''Makes real nidaqmx tasks.
+    '''
+
+    def __init__(self):
+        import nidaqmx
+        self.nidaqmx = nidaqmx
+
+
+    def create_task(self, kind, channels, fs=None, n_samples=None,
+                    trigger=None, trigger_source=TRIGGER_SOURCE,
+                    buffer_size=None):
+        '''Returns a configured nidaqmx.Task.
+
+        See DAQSession.task for the arguments. If buffer_size (samples
+        per channel) is given, makes a streaming output task.
+        '''
+        from nidaqmx.constants import Edge, LineGrouping, RegenerationMode
+
+        task = self.nidaqmx.Task()
+        try:
+            for channel in channels:
+                if kind == 'ao':
+                    task.ao_channels.add_ao_voltage_chan(channel)
+                elif kind == 'do' and ',' in channel:
+                    task.do_channels.add_do_chan(
+                            channel, line_grouping=LineGrouping.CHAN_FOR_ALL_LINES)
+                elif kind == 'do':
+                    task.do_channels.add_do_chan(channel)
+                elif kind == 'ai':
+                    task.ai_channels.add_ai_voltage_chan(channel)
+                else:
+                    raise ValueError(f'Unknown task kind {kind}')
+
+            if fs is not None:
+                if n_samples is None:
+                    task.timing.cfg_samp_clk_timing(float(fs))
+                else:
+                    task.timing.cfg_samp_clk_timing(
+                            float(fs), samps_per_chan=int(n_samples))
+            if trigger is not None:
+                edge = Edge.RISING if trigger == 'rising' else Edge.FALLING
+                task.triggers.start_trigger.cfg_dig_edge_start_trig(
+                        trigger_source, trigger_edge=edge)
+            if buffer_size is not None:
+                task.out_stream.regen_mode = RegenerationMode.DONT_ALLOW_REGENERATION
+                task.out_stream.output_buf_size = int(buffer_size)
+        except Exception:
+            task.close()
+            raise
+        return task
+
+
+    def commit(self, task):
+        from nidaqmx.constants import TaskMode
+        try:
+            task.control(TaskMode.TASK_COMMIT)
+        except self.nidaqmx.DaqError:
+            return False
+        return True
+
+
+    def unreserve(self, task):
+        from nidaqmx.constants import TaskMode
+        task.control(TaskMode.TASK_UNRESERVE)
+
+
+    def ao_scaling(self, task):
+        return [list(channel.ao_dev_scaling_coeff) for channel in task.ao_channels]
+
+
+    def write_raw(self, task, data, timeout=10.):
+        '''Writes int16 codes (ao) or uint32 port words (do).
+        '''
+        from nidaqmx.stream_writers import (
+                AnalogUnscaledWriter, DigitalMultiChannelWriter)
+
+        # The stream writers take only (channels, samples) arrays
+        data = np.atleast_2d(data)
+        if data.dtype == np.int16:
+            writer = AnalogUnscaledWriter(task.out_stream, auto_start=False)
+            writer.write_int16(data, timeout=timeout)
+        elif data.dtype == np.uint32:
+            writer = DigitalMultiChannelWriter(task.out_stream, auto_start=False)
+            writer.write_many_sample_port_uint32(data, timeout=timeout)
+        else:
+            raise ValueError(f'Cannot write {data.dtype} data raw')
+
+
+class VirtualClock:
+    '''Time of the simulated board.
+
+    Attributes
+    ----------
+    time : float
+        In seconds, the simulated time since the clock was made
+    realtime : bool
+        If True, advancing the clock also waits the same time, so
+        that the simulated outputs take as long as the real ones.
+        If False, the simulation runs as fast as possible.
+    '''
+
+    def __init__(self, realtime=False):
+        self.time = 0.
+        self.realtime = realtime
+
+    def now(self):
+        return self.time
+
+    def advance_to(self, end_time):
+        if end_time <= self.time:
+            return
+        if self.realtime:
+            time.sleep(end_time-self.time)
+        self.time = end_time
+
+
+class SimulatedTask:
+    '''A simulated NI task, see SimulatedBackend.
+    '''
+
+    def __init__(self, backend, kind, channels, fs, n_samples,
+                 trigger, trigger_source, buffer_size=None):
+        if kind not in ['ao', 'do', 'ai']:
+            raise ValueError(f'Unknown task kind {kind}')
+        self.backend = backend
+        self.kind = kind
+        # A digital channel of many lines is simulated line by line
+        self.ports = list(channels)
+        self.channels = [line for channel in channels for line in channel.split(',')]
+        self.fs = fs
+        self.n_samples = n_samples
+        self.trigger = trigger
+        self.trigger_source = trigger_source
+        self.buffer_size = buffer_size
+
+        # Streaming: samples written so far and the chunks written
+        # before the start
+        self.n_written = 0
+        self._pending = []
+
+        self.data = None
+        self.running = False
+        self.start_time = None
+        self.closed = False
+
+
+    def _check_open(self):
+        if self.closed:
+            raise RuntimeError('The simulated task is closed')
+
+
+    def write(self, data, auto_start=True, timeout=10.):
+        self._check_open()
+        if self.kind == 'ai':
+            raise ValueError('Cannot write to an analog input task')
+
+        data = np.array(data, dtype=bool if self.kind == 'do' else float)
+        n_channels = len(self.channels)
+        if n_channels > 1 and (data.ndim == 0 or data.shape[0] != n_channels):
+            raise ValueError(
+                    f'Data for {n_channels} channels has shape {data.shape}')
+        self.data = data
+
+        if self.buffer_size is not None:
+            self._write_stream(data, timeout)
+            return
+
+        if self.fs is None:
+            # On-demand output is set straight away
+            self.start_time = self.backend.clock.now()
+            self.backend._record(self)
+        elif auto_start:
+            self.start()
+
+
+    def write_raw(self, data, timeout=10.):
+        '''Decodes raw codes or port words as the board would and writes.
+        '''
+        data = np.atleast_2d(data)
+        if self.kind == 'ao' and data.dtype == np.int16:
+            offset, gain = SIMULATED_AO_SCALING
+            values = (data - offset) / gain
+        elif self.kind == 'do' and data.dtype == np.uint32:
+            if data.shape[0] != len(self.ports):
+                raise ValueError(
+                        f'Data for {len(self.ports)} ports has shape {data.shape}')
+            values = np.array([
+                (word >> int(line.rpartition('/line')[2])) & 1
+                for port, word in zip(self.ports, data)
+                for line in port.split(',')], dtype=bool)
+        else:
+            raise ValueError(f'Cannot write {data.dtype} data raw to a {self.kind} task')
+
+        if len(self.channels) == 1:
+            values = values[0]
+        self.write(values, auto_start=False, timeout=timeout)
+
+
+    def _write_stream(self, data, timeout):
+        n = data.shape[-1]
+        if self.n_samples is not None and self.n_written + n > self.n_samples:
+            raise ValueError('Writing more samples than the task has')
+
+        offset = self.n_written
+        if not self.running:
+            if offset + n > self.buffer_size:
+                raise ValueError('The data does not fit in the buffer')
+            self._pending.append((offset, data))
+        else:
+            # Wait until the board has drained room for the chunk
+            clock = self.backend.clock
+            room_time = self.start_time + (offset+n-self.buffer_size) / self.fs
+            if room_time - clock.now() > timeout:
+                raise TimeoutError('No room in the buffer in time')
+            clock.advance_to(room_time)
+            self.backend._record(self, data, self.start_time + offset/self.fs)
+        self.n_written += n
+
+
+    def start(self):
+        self._check_open()
+        if self.running:
+            raise RuntimeError('The simulated task is already running')
+        if self.kind != 'ai' and self.data is None:
+            raise RuntimeError('Write the data before starting the task')
+
+        self.running = True
+        self.start_time = self.backend.clock.now()
+        if self.trigger is not None:
+            self.start_time += self.backend.trigger_delay
+        if self.buffer_size is not None:
+            for offset, data in self._pending:
+                self.backend._record(self, data, self.start_time + offset/self.fs)
+            self._pending = []
+        elif self.kind != 'ai':
+            self.backend._record(self)
+
+
+    def _end_time(self, n_samples):
+        if self.fs is None or n_samples is None:
+            return self.start_time
+        return self.start_time + n_samples / self.fs
+
+
+    def wait_until_done(self, timeout=10.):
+        self._check_open()
+        if not self.running:
+            return
+        n_samples = self.n_samples
+        if n_samples is None and self.data is not None:
+            n_samples = self.data.shape[-1] if self.data.ndim else 1
+        end_time = self._end_time(n_samples)
+
+        clock = self.backend.clock
+        if end_time - clock.now() > timeout:
+            clock.advance_to(clock.now()+timeout)
+            raise TimeoutError('The simulated task did not finish in time')
+        clock.advance_to(end_time)
+
+
+    def read(self, number_of_samples_per_channel=1, timeout=10.):
+        self._check_open()
+        if self.kind != 'ai':
+            raise ValueError('Can read only from an analog input task')
+        if not self.running:
+            self.start()
+
+        n = int(number_of_samples_per_channel)
+        fs = self.fs or 1000.
+        times = self.start_time + np.arange(n) / fs
+
+        data = [self.backend.ai_values(channel, times).tolist()
+                for channel in self.channels]
+        self.backend.clock.advance_to(times[-1] + 1/fs)
+        if len(data) == 1:
+            return data[0]
+        return data
+
+
+    def stop(self):
+        self.running = False
+
+
+    def close(self):
+        self.running = False
+        self.closed = True
+
+
+class SimulatedBackend:
+    '''Simulated NI board for testing without the hardware.
+
+    The outputs last as long as their samples at the sample rate take
+    on the VirtualClock. Triggered tasks start trigger_delay after
+    they were started.
+
+    Attributes
+    ----------
+    clock : obj
+        The VirtualClock
+    waveforms : deque
+        The written outputs as dictionaries with the keys "time" (of
+        the output start on the clock), "kind", "channels", "fs"
+        (None for static values), "trigger" and "data".
+    values : dict
+        Keys output channels and values their current levels
+    ai_signals : dict
+        Keys analog input channels and values the signals to read,
+        see set_ai_signal.
+    trigger_delay : float
+        In seconds, when the triggers arrive after the start
+    '''
+
+    def __init__(self, realtime=False, trigger_delay=0.):
+        self.clock = VirtualClock(realtime)
+        self.waveforms = collections.deque(maxlen=HISTORY_LENGTH)
+        self.values = {}
+        self.ai_signals = {}
+        self.trigger_delay = trigger_delay
+
+
+    def create_task(self, kind, channels, fs=None, n_samples=None,
+                    trigger=None, trigger_source=TRIGGER_SOURCE,
+                    buffer_size=None):
+        return SimulatedTask(
+                self, kind, channels, fs, n_samples, trigger, trigger_source,
+                buffer_size)
+
+
+    def commit(self, task):
+        return True
+
+
+    def unreserve(self, task):
+        pass
+
+
+    def ao_scaling(self, task):
+        return [list(SIMULATED_AO_SCALING) for channel in task.channels]
+
+
+    def write_raw(self, task, data, timeout=10.):
+        task.write_raw(data, timeout=timeout)
+
+
+    def set_ai_signal(self, channel, signal):
+        '''Sets what reading the analog input channel gives.
+
+        Arguments
+        ---------
+        channel : string
+            For example "Dev1/ai0"
+        signal : float or callable
+            A constant voltage or a function that takes the sample
+            times (1D array, seconds on the clock) and returns the
+            voltages.
+        '''
+        self.ai_signals[channel] = signal
+
+
+    def ai_values(self, channel, times):
+        signal = self.ai_signals.get(channel, 0.)
+        if callable(signal):
+            return np.asarray(signal(times), dtype=float)
+        return np.full(len(times), float(signal))
+
+
+    def _record(self, task, data=None, start_time=None):
+        '''Remembers an output (or a streamed chunk of it).
+        '''
+        if data is None:
+            data = task.data
+        if start_time is None:
+            start_time = task.start_time
+        data = data.copy()
+
+        self.waveforms.append({
+            'time': start_time,
+            'kind': task.kind,
+            'channels': list(task.channels),
+            'fs': task.fs,
+            'trigger': task.trigger,
+            'data': data,
+            })
+        while (sum(waveform['data'].size for waveform in self.waveforms) > HISTORY_SAMPLES
+               and len(self.waveforms) > 1):
+            self.waveforms.popleft()
+
+        # The level left on each channel after the output
+        if data.ndim == 0:
+            data = np.full(len(task.channels), data)
+        elif len(task.channels) == 1:
+            data = data.reshape(1, -1)[:, -1]
+        elif data.ndim == 2:
+            data = data[:, -1]
+        for channel, value in zip(task.channels, data):
+            self.values[channel] = value.item()
+
+
+    def get_waveforms(self, channel):
+        '''Returns the (time, fs, data) of the outputs on the channel.
+        '''
+        outputs = []
+        for waveform in self.waveforms:
+            if channel not in waveform['channels']:
+                continue
+            data = waveform['data']
+            if len(waveform['channels']) > 1:
+                data = data[waveform['channels'].index(channel)]
+            outputs.append((waveform['time'], waveform['fs'], data))
+        return outputs
+
+
+    def clear(self):
+        self.waveforms.clear()
+
+
+def default_backend():
+    '''Returns a NIBackend if nidaqmx is available.
+
+    Otherwise a SimulatedBackend that runs in real time.
+    '''
+    if HAS_NIDAQMX:
+        return NIBackend()
+    print('nidaqmx not available, simulating the NI board')
+    return SimulatedBackend(realtime=True)
+
+
+class DAQSession:
+    '''Cache of committed NI tasks.
+
+    Attributes
+    ----------
+    tasks : dict
+        Keys task keys (see the module docstring) and values the
+        nidaqmx Tasks, the most recently used last.
+    committed : set
+        Keys of the tasks that hold their hardware reservation.
+    scalings : dict
+        Keys analog output channels and values their volts to codes
+        coefficients (for raw output)
+    backend : obj
+        NIBackend or SimulatedBackend making the tasks
+    '''
+
+    def __init__(self, backend=None):
+        self.tasks = {}
+        self.committed = set()
+        self.scalings = {}
+
+        if backend is None:
+            backend = default_backend()
+        self.backend = backend
+
+
+    def _commit(self, key, task):
+        '''Reserves and commits the task's hardware.
+
+        If another cached task holds the resources (for example the
+        analog output sample clock of the board), the other tasks
+        are unreserved and the commit retried.
+        '''
+        if key in self.committed:
+            return
+        if not self.backend.commit(task):
+            for other_key, other in self.tasks.items():
+                if other_key != key and other_key in self.committed:
+                    self.backend.unreserve(other)
+                    self.committed.discard(other_key)
+            if not self.backend.commit(task):
+                raise RuntimeError(f'Could not reserve the NI task {key}')
+        self.committed.add(key)
+
+
+    def task(self, kind, channels, fs=None, n_samples=None, trigger=None):
+        '''Returns a committed task, creating it if needed.
+
+        Arguments
+        ---------
+        kind : string
+            "ao", "do" or "ai"
+        channels : list
+            Physical channel names, for example ["Dev1/ao0"]
+        fs : float or None
+            Sample clock rate in Hz. If None, an on-demand task.
+        n_samples : int or None
+            Samples per channel of a finite task
+        trigger : string or None
+            "rising" or "falling" to start on the TRIGGER_SOURCE edge
+        '''
+        channels = tuple(channels)
+        if fs is not None:
+            fs = float(fs)
+        key = (kind, channels, fs, n_samples, trigger)
+
+        task = self.tasks.pop(key, None)
+        if task is None:
+            self.invalidate(channels)
+            while len(self.tasks) >= MAX_TASKS:
+                self._close(next(iter(self.tasks)))
+            task = self.backend.create_task(*key)
+        self.tasks[key] = task
+
+        try:
+            self._commit(key, task)
+        except Exception:
+            self._close(key)
+            raise
+        return task
+
+
+    def write(self, kind, channels, values, fs=None, trigger=None):
+        '''Sets static values on output channels.
+
+        If fs and trigger are given, the values are set only when
+        the trigger arrives.
+        '''
+        task = self.task(kind, channels, fs, trigger=trigger)
+
+        def run():
+            if fs is not None:
+                # The previous triggered write may still be waiting
+                task.stop()
+            task.write(values, auto_start=True)
+        self._run(task, run)
+
+
+    def output(self, kind, channels, data, fs, trigger=None, raw=False):
+        '''Writes a finite waveform and starts the output.
+
+        Returns the running task; Pass it to wait_done.
+
+        Arguments
+        ---------
+        data : array
+            1D array for one channel or 2D (channels, samples)
+        raw : bool
+            If True, data are int16 codes (ao) or uint32 port words
+            (do), see the module docstring.
+        '''
+        n_samples = data.shape[-1] if hasattr(data, 'shape') else len(data)
+        task = self.task(kind, channels, fs, n_samples, trigger)
+
+        def run():
+            self._write(task, data, raw)
+            task.start()
+        self._run(task, run)
+        return task
+
+
+    def _write(self, task, data, raw, timeout=10.):
+        if raw:
+            self.backend.write_raw(task, data, timeout=timeout)
+        else:
+            task.write(data, auto_start=False, timeout=timeout)
+
+
+    def ao_scaling(self, channels):
+        '''Returns the volts to codes coefficients of analog outputs.
+
+        One list (c0, c1, ...) per channel, to give to
+        stimulus.assemble_channels for raw output. Asked from the
+        board only once per channel.
+        '''
+        missing = [channel for channel in channels if channel not in self.scalings]
+        if missing:
+            task = self.task('ao', missing)
+            self.scalings.update(zip(missing, self.backend.ao_scaling(task)))
+        return [self.scalings[channel] for channel in channels]
+
+
+    def wait_done(self, task, timeout):
+        '''Waits a finite task to finish and stops it for the next use.
+
+        After an explicit commit, stopping returns the task to the
+        committed state, so the next start is fast.
+        '''
+        def run():
+            try:
+                task.wait_until_done(timeout=timeout)
+            finally:
+                task.stop()
+        self._run(task, run)
+
+
+    def stream(self, kind, channels, chunks, n_samples, fs, trigger=None, raw=False):
+        '''Outputs a long waveform chunk by chunk and waits it done.
+
+        Arguments
+        ---------
+        chunks : iterable
+            Yields the waveform in pieces: 1D arrays for one channel or
+            2D (channels, samples). All but the last of the same length.
+            If it ends before n_samples, the output is stopped there.
+        n_samples : int
+            Total samples per channel
+        raw : bool
+            If True, the chunks are raw data (see output)
+
+        Returns False if the output was stopped early, otherwise True.
+        '''
+        chunks = iter(chunks)
+        first = next(chunks)
+        chunk_size = first.shape[-1]
+
+        # Streaming tasks are not kept; Their length changes every time
+        key = ('stream', tuple(channels), float(fs), n_samples, trigger)
+        self.invalidate(channels)
+        task = self.backend.create_task(
+                kind, channels, fs, n_samples, trigger,
+                buffer_size=2*chunk_size)
+        try:
+            self._commit(key, task)
+            self._write(task, first, raw)
+            n_written = first.shape[-1]
+            second = next(chunks, None)
+            if second is not None:
+                self._write(task, second, raw)
+                n_written += second.shape[-1]
+            task.start()
+
+            for chunk in chunks:
+                # Blocks until the board has room for the chunk
+                self._write(task, chunk, raw, timeout=2*chunk_size/fs+10)
+                n_written += chunk.shape[-1]
+
+            if n_written > n_samples:
+                raise ValueError(f'Streamed {n_written} samples instead of {n_samples}')
+            if n_written < n_samples:
+                # Closing the task stops the output straight away
+                print(f'Stopped the output after {n_written} of {n_samples} samples')
+                return False
+            task.wait_until_done(timeout=2*chunk_size/fs*1.5+20)
+            return True
+        finally:
+            self.committed.discard(key)
+            task.close()
+
+
+    def wait_trigger(self, channel, fs=10000, trigger='rising'):
+        '''Returns after a trigger edge arrives (reads one AI sample).
+        '''
+        task = self.task('ai', [channel], fs, trigger=trigger)
+
+        def run():
+            try:
+                task.read(number_of_samples_per_channel=1)
+            finally:
+                task.stop()
+        self._run(task, run)
+
+
+    def _run(self, task, function):
+        # A failed task may be left in a bad state; Drop it so that
+        # the next call starts from a fresh one
+        try:
+            function()
+        except Exception:
+            for key, other in list(self.tasks.items()):
+                if other is task:
+                    self._close(key)
+            raise
+
+
+    def _close(self, key):
+        task = self.tasks.pop(key)
+        self.committed.discard(key)
+        try:
+            task.close()
+        except Exception as e:
+            print(f'Closing the NI task {key} failed: {e}')
+
+
+    def invalidate(self, channels=None):
+        '''Closes the cached tasks that use any of the channels.
+
+        If channels is None, closes all the tasks.
+        '''
+        for key in list(self.tasks):
+            if channels is None or split_lines(key[1]) & split_lines(channels):
+                self._close(key)
+
+
+    def close(self):
+        '''Closes all the tasks and releases the hardware.
+        '''
+        self.invalidate()
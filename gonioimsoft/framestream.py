@@ -0,0 +1,356 @@
+'''Streaming camera frames from a camera server to subscribers.
+
+The camera server's command connection carries only short strings.
+Frames are streamed over a separate port (the server port plus
+STREAM_PORT_OFFSET) that a subscriber connects to.
+
+Protocol
+--------
+1) The subscriber connects and sends its options as one JSON line
+   {"decimation": 1, "max_queue": 16, "policy": "drop"}
+2) The publisher then sends frames, each as
+   - 4 bytes, big-endian unsigned int, the header length
+   - the header as JSON {"shape", "dtype", "index", "timestamp",
+     "dropped", "nbytes"}
+   - nbytes of raw frame data (C-order)
+
+"dropped" tells how many frames the publisher had to discard for
+this subscriber since the previous sent frame.
+'''
+
+import os
+import json
+import time
+import queue
+import socket
+import struct
+import threading
+
+import numpy as np
+
+from .common import STREAM_PORT_OFFSET
+
+HEADER_LENGTH = struct.Struct('!I')
+
+# In seconds, how often an offer blocked by a full queue checks
+# whether the subscriber has gone (policy "block")
+BLOCK_POLL_INTERVAL = 0.1
+
+# The subscription options and their types
+OPTIONS = {'decimation': int, 'max_queue': int, 'policy': str}
+POLICIES = ['drop', 'block']
+
+
+def _parse_options(data):
+    '''Returns the subscription options from the subscriber's JSON line.
+
+    Raises ValueError if the options are not valid.
+    '''
+    options = json.loads(data.decode())
+    if not isinstance(options, dict):
+        raise ValueError(f'Options have to be a JSON object, not {options!r}')
+    for key, value in options.items():
+        if key not in OPTIONS:
+            raise ValueError(f'Unknown option {key}')
+        if OPTIONS[key] is int and isinstance(value, float) and value.is_integer():
+            value = int(value)
+        if not isinstance(value, OPTIONS[key]) or isinstance(value, bool):
+            raise ValueError(f'Option {key} has to be {OPTIONS[key].__name__}, not {value!r}')
+        options[key] = value
+    if options.get('policy', 'drop') not in POLICIES:
+        raise ValueError(f'Policy has to be one of {POLICIES}, not {options["policy"]!r}')
+    return options
+
+
+class _Subscription:
+    '''Publisher side state of one subscriber.
+
+    Frames are put in a bounded queue and sent by a sender thread so
+    that a slow subscriber never stalls the acquisition (policy "drop")
+    or, if wanted, the acquisition waits for it (policy "block").
+    '''
+
+    def __init__(self, conn, decimation=1, max_queue=16, policy='drop'):
+        self.conn = conn
+        self.decimation = max(int(decimation), 1)
+        self.policy = policy
+        self.queue = queue.Queue(maxsize=max(int(max_queue), 1))
+        self.dropped = 0
+        self.closed = False
+
+        self.thread = threading.Thread(target=self._send_loop, daemon=True)
+        self.thread.start()
+
+
+    def offer(self, index, timestamp, image):
+        '''Queues a frame for sending (takes decimation into account).
+        '''
+        if self.closed or index % self.decimation:
+            return
+        if self.policy == 'block':
+            # Waits for room but not for a subscriber that has gone
+            while not self.closed:
+                try:
+                    self.queue.put((index, timestamp, image), timeout=BLOCK_POLL_INTERVAL)
+                    return
+                except queue.Full:
+                    pass
+            return
+        try:
+            self.queue.put_nowait((index, timestamp, image))
+        except queue.Full:
+            self.dropped += 1
+
+
+    def _send_loop(self):
+        while not self.closed:
+            item = self.queue.get()
+            if item is None:
+                break
+            index, timestamp, image = item
+
+            image = np.ascontiguousarray(image)
+            dropped, self.dropped = self.dropped, 0
+            header = json.dumps({
+                'shape': image.shape, 'dtype': image.dtype.str,
+                'index': index, 'timestamp': timestamp,
+                'dropped': dropped, 'nbytes': image.nbytes,
+                }).encode()
+            try:
+                self.conn.sendall(HEADER_LENGTH.pack(len(header)) + header)
+                self.conn.sendall(memoryview(image).cast('B'))
+            except OSError:
+                break
+        self.close()
+
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.conn.close()
+
+            # Drop the unsent frames so that the sentinel fits
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                self.queue.put_nowait(None)
+            except queue.Full:
+                pass
+
+
+class FramePublisher:
+    '''Sends frames to all the subscribers connected to a stream port.
+
+    Attributes
+    ----------
+    port : int
+        The port where the subscribers connect to.
+    subscriptions : list
+        Currently connected subscribers.
+    i_frame : int
+        Running index of the published frames.
+    '''
+
+    def __init__(self, port):
+        self.port = port
+        self.subscriptions = []
+        self.i_frame = 0
+
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('', port))
+        self.socket.listen(4)
+
+        self._lock = threading.Lock()
+        self.thread = threading.Thread(target=self._accept_loop, daemon=True)
+        self.thread.start()
+
+
+    def _accept_loop(self):
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except OSError:
+                break
+
+            # A bad request closes only its own connection
+            options = b''
+            try:
+                while not options.endswith(b'\n'):
+                    data = conn.recv(1024)
+                    if not data:
+                        break
+                    options += data
+                options = _parse_options(options)
+            except (OSError, ValueError) as e:
+                print(f'Refused the frame subscriber from {addr}: {e}')
+                conn.close()
+                continue
+
+            print(f'Frame subscriber from {addr} with {options}')
+            with self._lock:
+                self.subscriptions.append(_Subscription(conn, **options))
+
+
+    def publish(self, image, timestamp=None):
+        '''Offers the frame to all the subscribers.
+
+        The frame is not copied; It should not be modified afterwards.
+        '''
+        if timestamp is None:
+            timestamp = time.time()
+        with self._lock:
+            self.subscriptions = [s for s in self.subscriptions if not s.closed]
+            for subscription in self.subscriptions:
+                subscription.offer(self.i_frame, timestamp, image)
+        self.i_frame += 1
+
+
+    def close(self):
+        '''Disconnects all the subscribers and stops listening.
+        '''
+        self.socket.close()
+        with self._lock:
+            for subscription in self.subscriptions:
+                subscription.close()
+            self.subscriptions = []
+
+
+class FrameSubscriber:
+    '''Receives frames from a camera server's frame stream.
+
+    Frames are numpy arrays wrapping the receive buffers directly
+    (no copies after the socket read).
+
+    Attributes
+    ----------
+    dropped : int
+        Total number of frames that the publisher dropped because
+        this subscriber was falling behind.
+    '''
+
+    def __init__(self, host, port, decimation=1, max_queue=16,
+                 policy='drop'):
+        '''
+        Arguments
+        ---------
+        host : string
+            The camera server's address
+        port : int
+            The stream port (the camera server port + STREAM_PORT_OFFSET)
+        decimation : int
+            Receive only every Nth frame
+        max_queue : int
+            How many frames the publisher buffers for this subscriber
+        policy : string
+            "drop" to drop frames when the queue is full (the default)
+            or "block" to make the camera server wait this subscriber
+        '''
+        if policy not in ['drop', 'block']:
+            raise ValueError(f'policy has to be "drop" or "block", not {policy}')
+
+        self.socket = socket.create_connection((host, port))
+        options = {'decimation': decimation, 'max_queue': max_queue,
+                   'policy': policy}
+        self.socket.sendall(json.dumps(options).encode() + b'\n')
+
+        self.dropped = 0
+        self._thread = None
+        self._stop = False
+
+
+    def _recv_exact(self, n_bytes):
+        buffer = bytearray(n_bytes)
+        view = memoryview(buffer)
+        received = 0
+        while received < n_bytes:
+            n = self.socket.recv_into(view[received:])
+            if n == 0:
+                return None
+            received += n
+        return buffer
+
+
+    def receive(self):
+        '''Waits and returns the next frame.
+
+        Returns (header, frame) where header is a dictionary (see the
+        module documentation) and frame a numpy array, or None if the
+        stream was closed.
+        '''
+        length = self._recv_exact(HEADER_LENGTH.size)
+        if length is None:
+            return None
+        header = self._recv_exact(HEADER_LENGTH.unpack(length)[0])
+        if header is None:
+            return None
+        header = json.loads(header.decode())
+
+        data = self._recv_exact(header['nbytes'])
+        if data is None:
+            return None
+
+        self.dropped += header['dropped']
+        frame = np.frombuffer(data, dtype=header['dtype'])
+        return header, frame.reshape(header['shape'])
+
+
+    def __iter__(self):
+        while True:
+            item = self.receive()
+            if item is None:
+                break
+            yield item
+
+
+    def start(self, callback):
+        '''Calls callback(header, frame) for each frame in a thread.
+
+        Use for live recording or analysis. See also FrameRecorder.
+        '''
+        def target():
+            for header, frame in self:
+                if self._stop:
+                    break
+                callback(header, frame)
+
+        self._stop = False
+        self._thread = threading.Thread(target=target, daemon=True)
+        self._thread.start()
+
+
+    def close(self):
+        '''Stops receiving and closes the stream.
+        '''
+        self._stop = True
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.socket.close()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+
+class FrameRecorder:
+    '''Saves streamed frames as npy files (a FrameSubscriber callback).
+
+    Each frame is saved as {label}_{index}.npy in the directory and
+    the headers are appended to {label}_headers.jsonl.
+    '''
+
+    def __init__(self, directory, label):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.label = label
+
+    def __call__(self, header, frame):
+        fn = os.path.join(self.directory, f'{self.label}_{header["index"]}.npy')
+        np.save(fn, frame)
+        with open(os.path.join(
+                self.directory, f'{self.label}_headers.jsonl'), 'a') as fp:
+            fp.write(json.dumps(header)+'\n')
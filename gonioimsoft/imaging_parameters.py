@@ -15,7 +15,7 @@ from gonioimsoft.directories import USERDATA_DIR
 DEFAULT_DYNAMIC_PARAMETERS = {
         'isi': 10.0, 'repeats': 1, 'pre_stim': 0.000,
         'stim': 0.200, 'post_stim': 0.00, 'frame_length' : 0.010,
-        'ir_imaging': 5, 'ir_waiting': 0, 'ir_livefeed': 1,
+        'ir_imaging': 5, 'ir_waiting': 0, 'ir_livefeed': 1, 'ir_settle': 0.5,
         'flash_on': 5, 'flash_off': 0,
         'ir_channel': "Dev1/ao1", 'flash_channel': "Dev1/ao0",
         'suffix': '', 'trigger_channel': "/Dev1/PFI0",
@@ -27,17 +27,19 @@ DEFAULT_DYNAMIC_PARAMETERS = {
         'flash_type': 'square',
         'save_stack': True,
         'reboot_cameras': False,
+        'compile_protocol': False,
+        'raw_output': False,
         'ROI': None,
         }
 
 DYNAMIC_PARAMETERS_TYPES = {
-        'seconds': ['isi', 'pre_stim', 'stim', 'post_stim', 'frame_length', 'avgint_adaptation'],
+        'seconds': ['isi', 'pre_stim', 'stim', 'post_stim', 'frame_length', 'avgint_adaptation', 'ir_settle'],
         'voltage': ['ir_imaging', 'ir_waiting', 'ir_livefeed', 'flash_on', 'flash_off'],
         'channel': ['ir_channel', 'flash_channel', 'trigger_channel', 'trigger_out_channel'],
         'integer': ['repeats', 'biosyst_channel'],
         'float': ['biosyst_multiplier'],
         'string': ['suffix', 'biosyst_stimulus', 'flash_type'],
-        'boolean': ['save_stack', 'reboot_cameras'],
+        'boolean': ['save_stack', 'reboot_cameras', 'compile_protocol', 'raw_output'],
         'roibox': ['ROI']}
 
 
@@ -51,6 +53,7 @@ DYNAMIC_PARAMETERS_HELP = {
         'ir_imaging': 'IR brightness during image acqusition [0-10]',
         'ir_waiting': 'IR brightness when waiting ISI [0-10]',
         'ir_livefeed': 'IR brightness while updating the live image[0-10]',
+        'ir_settle': 'How long to let the IR (optics) settle before imaging [s]',
         'flash_on': 'Flash brightness during stim [0-10]',
         'flash_off': 'Flash brightness during pre- and post-stim [0-10]',
         'ir_channel': 'NI channel for IR [0-10]',
@@ -65,6 +68,8 @@ DYNAMIC_PARAMETERS_HELP = {
         'flash_type': 'square, sinelogsweep, squarelogsweep or 3steplogsweep. "{sweep},f0,f1" for Hz',
         'save_stack': 'If true, save a stack instead separate images',
         'reboot_cameras': 'If true, reboots cameras after each run (dirtyfix)',
+        'compile_protocol': 'If true, output all repeats and ISIs as one waveform (from-NI only; no reboot_cameras, one vio file for all repeats)',
+        'raw_output': 'If true, write stimuli to the NI board as int16 codes and port words',
         'ROI': 'If set, crops the sensor area (allows higher fps). x,y,w,h',
         }
 
@@ -0,0 +1,252 @@
+'''Recording the sent client commands and replaying them later.
+
+A CommandJournal writes every command that the clients send to a
+journal file (one JSON object per line) with
+
+    "time"      Core time (seconds since epoch) when it was sent
+    "target"    The server address as "host:port"
+    "server"    The server type ("camera" or "vio")
+    "command"   The command string
+    "mode"      "send", "listen" (waited a response) or "event"
+    "latency"   In seconds, how long sending (and listening) took
+    "error"     Present if the command failed
+
+The journal of a real imaging session can be replayed against local
+dummy servers (DummyCamera and DummyBoard) to reproduce slowdowns
+and to load-test server changes without the rig
+
+    python -m gonioimsoft.journal session.jsonl
+    python -m gonioimsoft.journal session.jsonl --fast
+'''
+
+import os
+import json
+import time
+import tempfile
+import argparse
+import threading
+
+from .timings import CommandTimings, format_summary
+
+# Commands that are not replayed (the replay manages the servers itself)
+SKIP_COMMANDS = ['exit']
+
+# First port of the dummy servers started by the replay
+REPLAY_PORT = 50900
+
+
+class CommandJournal:
+    '''Appends the sent commands to a journal file.
+
+    A single journal can be shared by many clients (thread safe).
+    '''
+
+    def __init__(self, fn):
+        directory = os.path.dirname(fn)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.fn = fn
+        self._fp = open(fn, 'a')
+        self._lock = threading.Lock()
+
+
+    def record(self, client, command, mode, start_time, latency, error=None):
+        '''Writes one entry for a command that the client sent.
+        '''
+        entry = {
+                'time': start_time,
+                'target': f'{client.host}:{client.port}',
+                'server': client.server_type,
+                'command': command,
+                'mode': mode,
+                'latency': latency,
+                }
+        if error is not None:
+            entry['error'] = str(error)
+
+        line = json.dumps(entry) + '\n'
+        with self._lock:
+            if self._fp is None:
+                return
+            # Flush every entry so that the journal survives crashes
+            self._fp.write(line)
+            self._fp.flush()
+
+
+    def close(self):
+        with self._lock:
+            if self._fp is not None:
+                self._fp.close()
+                self._fp = None
+
+
+def read_journal(fn):
+    '''Returns the journal entries as a list of dictionaries.
+    '''
+    entries = []
+    with open(fn, 'r') as fp:
+        for line in fp:
+            line = line.strip()
+            if line:
+                entries.append(json.loads(line))
+    return entries
+
+
+def journal_timings(entries):
+    '''Returns CommandTimings of the latencies recorded in the journal.
+    '''
+    timings = CommandTimings()
+    for entry in entries:
+        timings.record(entry['command'].split(';')[0], 'total', entry['latency'])
+    return timings
+
+
+def _replay_target(client, entries, t0, start_time, fast, listeners, timings):
+    # t0 is the same for all the targets so that their commands keep
+    # their original offsets to each other
+    for entry in entries:
+        if not fast:
+            wait = start_time + (entry['time']-t0) - time.time()
+            if wait > 0:
+                time.sleep(wait)
+
+        command = entry['command']
+        command_name = command.split(';')[0]
+        begin = time.perf_counter()
+        try:
+            if entry['mode'] == 'event':
+                listeners.append(client.send_event_command(command, n_retry=0))
+            else:
+                client.send_command(
+                        command, listen=entry['mode'] == 'listen',
+                        n_retry=0, raw=True)
+        except ConnectionError as e:
+            print(f'Replaying {command} failed: {e}')
+            timings.count(command_name, 'errors')
+            continue
+        timings.record(command_name, 'total', time.perf_counter()-begin)
+
+
+def replay(entries, fast=False, port=REPLAY_PORT, save_directory=None):
+    '''Replays journal entries against local dummy servers.
+
+    Each target server in the journal gets its own dummy server and
+    the commands to different servers are sent in parallel, as they
+    were in the original session.
+
+    Arguments
+    ---------
+    entries : list
+        Journal entries, see read_journal
+    fast : bool
+        If True, send the commands as fast as possible. Otherwise
+        keep the original pacing.
+    port : int
+        Port of the first dummy server; The next ones use the
+        following ports.
+    save_directory : string or None
+        Where the dummy servers save their data. The save directories
+        in the journal are replaced by this. If None, uses a temporary
+        directory.
+
+    Returns CommandTimings of the replayed commands.
+    '''
+    from .clientbase import ClientBase
+
+    if save_directory is None:
+        save_directory = tempfile.mkdtemp(prefix='gonioimsoft_replay_')
+
+    targets = {}
+    for entry in entries:
+        # Failed commands never reached the server
+        if 'error' in entry or entry['command'].split(';')[0] in SKIP_COMMANDS:
+            continue
+        if entry['command'].startswith('set_save_directory;'):
+            entry = dict(entry, command=f'set_save_directory;{save_directory}')
+        targets.setdefault((entry['target'], entry['server']), []).append(entry)
+
+    clients = []
+    for i_target, (target, server) in enumerate(targets):
+        if server not in ['camera', 'vio']:
+            raise ValueError(f'Cannot replay unknown server type {server} ({target})')
+        client = ClientBase('127.0.0.1', port+i_target)
+        if server == 'camera':
+            args = ['--camera', 'dummy']
+            # Cameras of a server controlling many cameras
+            devices = []
+            for entry in targets[(target, server)]:
+                name = entry['command'].split(';')[0]
+                if '@' in name and name.split('@')[1] not in devices:
+                    devices.append(name.split('@')[1])
+            if devices:
+                args += ['--devices', ','.join(devices)]
+        else:
+            args = ['--board', 'dummy']
+        client.start_server(server, wait=False, args=args)
+        clients.append(client)
+        print(f'Replaying {target} ({server}) on port {client.port}')
+
+    # The start of the original session
+    t0 = min((entry['time'] for entry in entries), default=0)
+
+    timings = CommandTimings()
+    listeners = []
+    try:
+        for client in clients:
+            if not client.wait_server_ready():
+                raise ConnectionError(f'Dummy server on {client.port} failed')
+
+        start_time = time.time()
+        threads = [
+                threading.Thread(
+                    target=_replay_target,
+                    args=(client, target_entries, t0, start_time, fast, listeners, timings))
+                for client, target_entries in zip(clients, targets.values())]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        summary = timings.summary()
+        n_sent = sum(phases['total']['n'] for phases in summary.values() if 'total' in phases)
+        n_errors = sum(phases.get('errors', 0) for phases in summary.values())
+        print(f'Replayed {n_sent} commands in {time.time()-start_time:.1f} s ({n_errors} failed)')
+    finally:
+        for listener in listeners:
+            listener.close()
+        for client in clients:
+            client.close_server()
+
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            prog='GonioImsoft Journal Replay',
+            description='Replays a command journal against dummy servers')
+
+    parser.add_argument('journal')
+    parser.add_argument('-f', '--fast', action='store_true',
+            help='Send the commands as fast as possible')
+    parser.add_argument('-p', '--port', type=int, default=REPLAY_PORT)
+    parser.add_argument('-s', '--save-directory')
+
+    args = parser.parse_args()
+
+    entries = read_journal(args.journal)
+    if not entries:
+        print('The journal is empty')
+        return
+
+    timings = replay(
+            entries, fast=args.fast, port=args.port,
+            save_directory=args.save_directory)
+
+    print('\nOriginal session')
+    print(format_summary(journal_timings(entries).summary()))
+    print('\nReplay')
+    print(format_summary(timings.summary()))
+
+
+if __name__ == "__main__":
+    main()
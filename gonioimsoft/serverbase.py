@@ -2,12 +2,83 @@
 '''
 
 import socket
+import select
 import time
+import json
 import os
 
+from .common import UNIX_SOCKETS, unix_socket_path, read_command
+from .timings import CommandTimings
+
 DEFAULT_SAVE_DIRECTORY = 'gonioimsoft_data'
 
 
+def wait_spare_assignment(ready_port):
+    '''Waits until the supervisor assigns a port to this spare server.
+
+    Connects to the localhost at ready_port, sends "spare" and waits
+    for the port number. See supervisor.py for the handshake.
+
+    Returns (conn, port) where conn is to be given to send_ready.
+    '''
+    conn = socket.create_connection(('127.0.0.1', ready_port))
+    port = b''
+    conn.sendall(b'spare\n')
+    while not port.endswith(b'\n'):
+        data = conn.recv(64)
+        if not data:
+            conn.close()
+            raise ConnectionError('The supervisor closed the spare')
+        port += data
+    return conn, int(port)
+
+
+class Notifier:
+    '''Sends event messages back to the client over an open connection.
+
+    Commands listed in ServerBase.notifiers get a Notifier instance
+    as their notify keyword argument. Each event is a short string
+    terminated by a newline, for example "armed" or "complete".
+
+    Attributes
+    ----------
+    conn : obj or None
+        The client connection. None after closing.
+    '''
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __call__(self, event):
+        '''Sends the event to the client (if still connected).
+        '''
+        if self.conn is None:
+            return
+        try:
+            self.conn.sendall(f'{event}\n'.encode())
+        except OSError:
+            # The client went away; Events are best effort only
+            self.close()
+
+    def close(self):
+        '''Closes the connection to the client.
+        '''
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def hand_off(self):
+        '''Returns a new Notifier that takes over the connection.
+
+        For commands that continue running in another thread after
+        returning; The server closes this (now empty) notifier and
+        the thread closes the returned one when done.
+        '''
+        notifier = Notifier(self.conn)
+        self.conn = None
+        return notifier
+
+
 class ServerBase:
     '''The base class for any server.
 
@@ -15,6 +86,9 @@ class ServerBase:
     ----------
     socket : obj
         The socket object.
+    unix_socket : obj or None
+        A Unix domain socket that local clients use instead of TCP
+        if the platform supports it.
     device : obj or None
         
     functions : dict
@@ -22,6 +96,15 @@ class ServerBase:
     responders : list
         Command names (a subset from functions) that also need to
         send a return value to the client.
+    raw_parameters : list
+        Command names (a subset from functions) that get their
+        parameters as one string, not split by ":" (for JSON etc.)
+    notifiers : list
+        Command names (a subset from functions) that keep the
+        connection open while running and that get a Notifier as
+        their notify keyword argument to send events to the client.
+    timings : obj
+        CommandTimings of the executed commands.
     '''
     
     def __init__(self, host, port, device):
@@ -30,7 +113,17 @@ class ServerBase:
         self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.socket.bind(('', port))
-        self.socket.listen(1)
+        self.socket.listen(5)
+
+        self.unix_socket = None
+        if UNIX_SOCKETS:
+            self.unix_path = unix_socket_path(port)
+            if os.path.exists(self.unix_path):
+                os.remove(self.unix_path)
+            print(f'Binding a socket (path {self.unix_path})')
+            self.unix_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.unix_socket.bind(self.unix_path)
+            self.unix_socket.listen(5)
         
         if getattr(device, 'save_directory', None):
             device.save_directory = DEFAULT_SAVE_DIRECTORY
@@ -42,9 +135,15 @@ class ServerBase:
                 'pong': self.pong,
                 'exit': self.exit,
                 'set_save_directory': self.set_save_directory,
+                'stats': self.stats,
+                'clock': self.clock,
                 }
 
-        self.responders = ['pong']
+        self.responders = ['pong', 'stats', 'clock']
+        self.raw_parameters = []
+        self.notifiers = []
+
+        self.timings = CommandTimings()
 
         self.run_exit = False
 
@@ -60,26 +159,54 @@ class ServerBase:
         '''Sends the client's message back to the server with a greeting.
         '''
         return f'General Kenobi! (response to {message})'
+
+    def clock(self, _=None):
+        '''Returns the server's current time (seconds since epoch).
+        '''
+        return repr(time.time())
+
+    def stats(self, _=None):
+        '''Returns the per-command timing statistics (JSON string).
+        '''
+        return json.dumps(self.timings.summary())
     
     def set_save_directory(self, directory):
         '''Sets the location for the data saving
         '''
+        self._create_save_directory(directory)
+        if self.device is not None:
+            self.device.save_directory = directory
+
+
+    @staticmethod
+    def _create_save_directory(directory):
         abspath = os.path.abspath(directory)
         if not os.path.isdir(directory):
             print(f'Creating directory {abspath} for saving data')
             os.makedirs(directory)
         else:
             print(f'Setting directory {abspath} for saving data')
-        
-        if self.device is not None:
-            self.device.save_directory = directory
+
+
+    def send_ready(self, ready_port=None, conn=None):
+        '''Tells the process that started this server that it is ready.
+
+        Connects to the localhost at ready_port and sends "ready".
+        Called once the server sockets are bound, so that clients
+        can connect straight away. Spare servers give instead the
+        connection from wait_spare_assignment.
+        '''
+        if conn is None:
+            conn = socket.create_connection(('127.0.0.1', ready_port))
+        with conn:
+            conn.sendall(b'ready')
 
 
     def wait_for_client(self):
         '''Waits for any command from the client and then discards it.
         '''
         print('Waiting for any command...')
-        conn, addr = self.socket.accept()
+        conn, addr = self._accept()
         while True:
             data = conn.recv(1024)
             if not data: break
@@ -87,6 +214,88 @@ class ServerBase:
         print('Got a command from the client, waiting done!')
 
 
+    def dispatch(self, func, parameters, conn):
+        '''Runs the command received over the connection.
+
+        Subclasses can override this to run commands elsewhere, for
+        example in per device threads. See execute.
+        '''
+        if func not in self.functions:
+            print(f'Skipping unkown command: {func}')
+            conn.close()
+            return
+        self.execute(func, self.functions[func], parameters, conn)
+
+
+    def execute(self, func, function, parameters, conn, label=None):
+        '''Calls the command's function and answers the client.
+
+        Arguments
+        ---------
+        func : string
+            The command name (for responders, notifiers etc.)
+        function : callable
+            The function to call with the parameters
+        parameters : list
+            The command parameters
+        conn : obj
+            The client connection. Closed when done.
+        label : string or None
+            Name to record the timings under. If None, func.
+        '''
+        # If the client expects no response, then we can close the
+        # connection early and let the client go.
+        kwargs = {}
+        if func in self.notifiers:
+            notifier = Notifier(conn)
+            kwargs['notify'] = notifier
+        elif not func in self.responders:
+            conn.close()
+
+        start_time = time.perf_counter()
+        try:
+            response = function(*parameters, **kwargs)
+        except Exception as e:
+            print()
+            print('Failure running the command')
+            print(f'  Invocation (Python): {func}(*{parameters})')
+            print('  Error below:')
+            print(e)
+            print()
+            response = 'error'
+            if func in self.notifiers:
+                notifier('error')
+
+        self.timings.record(
+                label or func, 'execute', time.perf_counter()-start_time)
+
+        if func in self.notifiers:
+            notifier.close()
+
+        # Say back the response and close
+        if func in self.responders:
+
+            if isinstance(response, (list, tuple)):
+                response = ':'.join(response)
+
+            try:
+                conn.sendall(str(response).encode())
+            except OSError:
+                print(f'Could not send the response of {func}')
+            conn.close()
+
+
+    def _accept(self):
+        '''Waits and accepts a connection from TCP or Unix socket.
+        '''
+        if self.unix_socket is None:
+            return self.socket.accept()
+
+        readable, _, _ = select.select(
+                [self.socket, self.unix_socket], [], [])
+        return readable[0].accept()
+
+
     def run(self):
         '''Runs the server mainloop until receives an exit command.
 
@@ -95,9 +304,16 @@ class ServerBase:
         '''
         print('Waiting clients to connect')
         while not self.run_exit:
-            conn, addr = self.socket.accept()
-            data = conn.recv(1024)
-            string = data.decode()
+            conn, addr = self._accept()
+
+            # Short commands come in one piece, long ones with a
+            # length header (see common.frame_command)
+            try:
+                string = read_command(conn).decode()
+            except (OSError, ValueError) as e:
+                print(f'Could not read a command: {e}')
+                conn.close()
+                continue
 
             if not string:
                 conn.close()
@@ -106,44 +322,27 @@ class ServerBase:
             print(f'Got command {string} at {time.time()}')
 
             # The char ';' is used as a delimiter between the
-            # command name and the arguments. Parameters by ':'
+            # command name and the arguments. Parameters by ':'.
+            # The command name may be addressed to a device of the
+            # server as "{command_name}@{device}"
             if ';' in string:
-                func, parameters = string.split(';')
-                parameters = parameters.split(':')
+                func, parameters = string.split(';', 1)
+                if func.split('@')[0] in self.raw_parameters:
+                    parameters = [parameters]
+                else:
+                    parameters = parameters.split(':')
             else:
                 func = string
                 parameters = []
 
-            if func not in self.functions:
-                print(f'Skipping unkown command: {func}')
-                conn.close()
-                continue
+            self.dispatch(func, parameters, conn)
 
-            # If the client expects no response, then we can close the
-            # connection early and let the client go.
-            if not func in self.responders:
-                conn.close()
-            
-            try:
-                response = self.functions[func](*parameters)
-            except Exception as e:
-                print()
-                print('Failure running the command')
-                print(f'  Invocation (Python): {func}(*{parameters})')
-                print('  Error below:')
-                print(e)
-                print()
-                response = 'error'
-
-                
-            # Say back the response and close
-            if func in self.responders:
-
-                if isinstance(response, (list, tuple)):
-                    response = ':'.join(response)
 
-                conn.sendall(str(response).encode())
-                conn.close()
+        self.socket.close()
+        if self.unix_socket is not None:
+            self.unix_socket.close()
+            if os.path.exists(self.unix_path):
+                os.remove(self.unix_path)
 
 
     def exit(self, _=None):
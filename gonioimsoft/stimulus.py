@@ -1,5 +1,7 @@
 
 import os
+import threading
+import collections
 
 import numpy as np
 import json
@@ -16,6 +18,294 @@ except ModuleNotFoundError:
 
 from .directories import USERDATA_DIR
 
+# Samples per channel in each chunk when streaming waveforms
+CHUNK_SIZE = 50000
+
+# In bytes, how much generated waveforms to keep in the WAVEFORM_CACHE,
+# and the largest generated Waveform segment to cache (longer ones
+# are made chunk by chunk when needed)
+CACHE_BYTES = 256 * 1024**2
+CACHE_SEGMENT_BYTES = 16 * 1024**2
+
+
+class WaveformCache:
+    '''Least recently used cache of generated waveforms.
+
+    The repeats of a protocol mostly share their stimuli, so the
+    waveforms are generated once and then reused. The keys are the
+    exact parameters that the waveform was generated from. The cached
+    arrays are read-only because they are shared.
+
+    Attributes
+    ----------
+    max_bytes : int
+        The cache size budget; The least recently used waveforms are
+        dropped to stay under it.
+    hits, misses, evictions : int
+        Counts for the statistics, see stats
+    '''
+
+    def __init__(self, max_bytes=CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        self._entries = collections.OrderedDict()
+        self._nbytes = 0
+        self._lock = threading.Lock()
+
+
+    def get(self, key, make):
+        '''Returns the cached array of the key, made by make() if needed.
+        '''
+        with self._lock:
+            array = self._entries.get(key)
+            if array is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return array
+            self.misses += 1
+
+        array = np.asarray(make())
+        array.flags.writeable = False
+
+        with self._lock:
+            if key not in self._entries and array.nbytes <= self.max_bytes:
+                self._entries[key] = array
+                self._nbytes += array.nbytes
+                while self._nbytes > self.max_bytes:
+                    old_key, old = self._entries.popitem(last=False)
+                    self._nbytes -= old.nbytes
+                    self.evictions += 1
+        return array
+
+
+    def stats(self):
+        '''Returns a dictionary of the hits, misses, evictions, entries
+        and bytes (used and max_bytes).
+        '''
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'entries': len(self._entries),
+                    'bytes': self._nbytes, 'max_bytes': self.max_bytes}
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._nbytes = 0
+
+
+# Shared by all the StimulusBuilders
+WAVEFORM_CACHE = WaveformCache()
+
+
+class StimulusFileCache:
+    '''Loaded stimulus files, keyed by their path and modification.
+
+    Parsing a Biosyst stimulus (a JSON of long number lists or the
+    binary file) is slow, so a file is parsed only on its first load.
+    Its stimuli are then saved to a .npy sidecar next to it
+
+        {fn}.{variant}.npy     The stimuli as a (stimuli, samples) array
+        {fn}.{variant}.json    The sampling rate and the file's mtime and size
+
+    that later sessions load memory-mapped. Within a session, the
+    loaded stimuli are kept. When the file is modified, it is parsed
+    again.
+    '''
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+
+    def load(self, fn, variant, parse):
+        '''Returns (stimuli, fs, stamp) of the stimulus file.
+
+        Arguments
+        ---------
+        fn : string
+            Path to the stimulus file
+        variant : string
+            What is loaded from the file (for example the channel), so
+            that each variant gets its own sidecar
+        parse : callable
+            Parses the file, returning (list of 1D arrays, fs)
+
+        stimuli is a list of read-only 1D arrays and stamp the file's
+        (mtime_ns, size), identifying the loaded version of it.
+        '''
+        stat = os.stat(fn)
+        stamp = (stat.st_mtime_ns, stat.st_size)
+
+        with self._lock:
+            entry = self._entries.get((fn, variant))
+        if entry is not None and entry[0] == stamp:
+            return entry[1], entry[2], stamp
+
+        sidecar = f'{fn}.{variant}'
+        loaded = self._load_sidecar(sidecar, stamp)
+        if loaded is None:
+            stimuli, fs = parse()
+            stimuli = [np.asarray(stimulus, dtype=float) for stimulus in stimuli]
+            self._save_sidecar(sidecar, stamp, stimuli, fs)
+        else:
+            stimuli, fs = loaded
+
+        for stimulus in stimuli:
+            stimulus.flags.writeable = False
+
+        with self._lock:
+            self._entries[(fn, variant)] = (stamp, stimuli, fs)
+        return stimuli, fs, stamp
+
+
+    @staticmethod
+    def _load_sidecar(sidecar, stamp):
+        try:
+            with open(f'{sidecar}.json', 'r') as fp:
+                meta = json.load(fp)
+            if (meta['mtime_ns'], meta['size']) != stamp:
+                return None
+            array = np.load(f'{sidecar}.npy', mmap_mode='r')
+        except (OSError, ValueError, KeyError):
+            return None
+        return list(array), meta['fs']
+
+
+    @staticmethod
+    def _save_sidecar(sidecar, stamp, stimuli, fs):
+        if len({len(stimulus) for stimulus in stimuli}) != 1:
+            # Stimuli of different lengths do not fit in one array
+            return
+        # The .json last, so that a sidecar is valid only when complete
+        try:
+            with open(f'{sidecar}.npy.tmp', 'wb') as fp:
+                np.save(fp, np.stack(stimuli))
+            os.replace(f'{sidecar}.npy.tmp', f'{sidecar}.npy')
+            with open(f'{sidecar}.json', 'w') as fp:
+                json.dump({'fs': fs, 'mtime_ns': stamp[0], 'size': stamp[1]}, fp)
+        except OSError as e:
+            print(f'Could not save the stimulus sidecar {sidecar}: {e}')
+
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by all the StimulusBuilders
+STIMULUS_FILES = StimulusFileCache()
+
+
+class Waveform:
+    '''A 1D waveform made of segments and generated only when needed.
+
+    Long stimuli are mostly constant parts or formulas, so keeping them
+    as segments takes almost no memory. The samples are made when
+    asked for, the whole waveform at once (array) or in chunks for
+    streaming (chunks).
+
+    A segment is one of
+        ("array", n_samples, array)
+        ("constant", n_samples, value)
+        ("function", n_samples, function)   function(i0, i1) returns
+                                            the segment's samples i0:i1
+    '''
+
+    def __init__(self, segments=()):
+        self.segments = []
+        for segment in segments:
+            self.append(segment)
+
+
+    def append(self, segment):
+        '''Adds a segment (or an array) to the end.
+        '''
+        if isinstance(segment, np.ndarray):
+            segment = ('array', len(segment), segment)
+        if segment[1] > 0:
+            self.segments.append(segment)
+
+
+    def constant(self, value, n_samples):
+        self.append(('constant', int(n_samples), float(value)))
+
+    def function(self, function, n_samples):
+        self.append(('function', int(n_samples), function))
+
+    def extend(self, waveform):
+        self.segments.extend(waveform.segments)
+
+
+    def __len__(self):
+        return sum(segment[1] for segment in self.segments)
+
+
+    def set_last(self, value):
+        '''Sets the value of the last sample.
+        '''
+        kind, n, data = self.segments.pop()
+        if kind == 'array':
+            data = data[:-1]
+        self.append((kind, n-1, data))
+        self.constant(value, 1)
+
+
+    @property
+    def last(self):
+        return self.get(len(self)-1)[0]
+
+
+    def get(self, i0=0, i1=None, out=None):
+        '''Returns the samples i0:i1, written to out if given.
+        '''
+        if i1 is None:
+            i1 = len(self)
+        if out is None:
+            out = np.empty(i1-i0)
+
+        start = 0
+        for kind, n, data in self.segments:
+            end = start + n
+            a, b = max(i0, start), min(i1, end)
+            if a < b:
+                target = out[a-i0:b-i0]
+                if kind == 'array':
+                    target[:] = data[a-start:b-start]
+                elif kind == 'constant':
+                    target[:] = data
+                else:
+                    target[:] = data(a-start, b-start)
+            if end >= i1:
+                break
+            start = end
+        return out
+
+
+    def array(self):
+        '''Returns the whole waveform as a 1D numpy array.
+        '''
+        return self.get()
+
+
+    def chunks(self, chunk_size=CHUNK_SIZE):
+        '''Yields the waveform in chunk_size long pieces.
+        '''
+        n_samples = len(self)
+        for i0 in range(0, n_samples, chunk_size):
+            yield self.get(i0, min(i0+chunk_size, n_samples))
+
+
+    def mean(self):
+        total = 0.
+        for chunk in self.chunks():
+            total += np.sum(chunk)
+        return total / len(self)
+
+
 class StimulusBuilder:
     '''
     Get various stimulus waveforms
@@ -55,6 +345,30 @@ class StimulusBuilder:
             self.N_frames = int(round((stim_time+prestim_time+poststim_time)/frame_length))
 
             self.overload_stimulus = None
+
+
+    def _key(self, name, *extra):
+        '''Returns the waveform cache key for the current parameters.
+
+        List and array valued parameters are keyed as tuples.
+        '''
+        return _hashable((name, self.stim_time, self.prestim_time, self.poststim_time,
+                self.frame_length, self.stimulus_intensity,
+                self.illumination_intensity, self.fs, self.stimulus_finalval,
+                self.illumination_finalval, self.wtype, *extra))
+
+
+    @staticmethod
+    def _cached_segment(waveform, key, function, n_samples):
+        '''Appends a generated segment to the waveform.
+
+        Short segments are generated whole and cached; Long ones stay
+        functions so that they can be streamed.
+        '''
+        if n_samples*8 > CACHE_SEGMENT_BYTES:
+            waveform.function(function, n_samples)
+        else:
+            waveform.append(WAVEFORM_CACHE.get(key, lambda: function(0, n_samples)))
             
 
     def overload_biosyst_stimulus(self, fn, channel=0, multiplier=1):
@@ -62,33 +376,31 @@ class StimulusBuilder:
         Loads a Biosyst stimulus that gets returned then at
         get_stimulus_pulse instead.
 
-        Returns the overload stimulus and new fs
+        Returns the overload stimulus and new fs. The files are
+        loaded through the STIMULUS_FILES cache.
         '''
+        ffn = os.path.join(USERDATA_DIR, 'biosyst_stimuli', fn)
         
         if fn.endswith('.json'):
-            ffn = os.path.join(USERDATA_DIR, 'biosyst_stimuli', fn)
-            with open(ffn, 'r') as fp:
-                data = json.load(fp)
+            stimuli, self.fs, stamp = STIMULUS_FILES.load(
+                    ffn, 'stims', lambda: _parse_json_stimulus(ffn))
 
-            self.fs = data['fs']
             self.overload_stimulus = []
-
-            for i_stim in range(10):
-                key = f'stim_{i_stim}'
-                if key not in data:
-                    continue
-                self.overload_stimulus.append(multiplier*np.array(data[key]))
+            for i_stim, stimulus in enumerate(stimuli):
+                if multiplier != 1:
+                    stimulus = WAVEFORM_CACHE.get(
+                            ('biosyst', ffn, stamp, i_stim, multiplier),
+                            lambda: multiplier*stimulus)
+                self.overload_stimulus.append(stimulus)
 
             return self.overload_stimulus[0], self.fs
 
         if bsextract is None:
             raise ModuleNotFoundError('Module required\npip install python-biosystfiles')
 
-        ffn = os.path.join(USERDATA_DIR, 'biosyst_stimuli', fn)
-        self.overload_stimulus, self.fs = bsextract(ffn, channel)
-        self.overload_stimulus = self.overload_stimulus.flatten()
-        print(self.overload_stimulus.shape)
-        print(np.max(self.overload_stimulus))
+        stimuli, self.fs, stamp = STIMULUS_FILES.load(
+                ffn, f'ch{channel}', lambda: _parse_biosyst_stimulus(ffn, channel))
+        self.overload_stimulus = stimuli[0]
 
         return self.overload_stimulus, self.fs
     
@@ -105,12 +417,32 @@ class StimulusBuilder:
         if self.overload_stimulus is not None:
             return self.overload_stimulus
 
+        return WAVEFORM_CACHE.get(
+                self._key('stimulus'), lambda: self.get_stimulus_waveform().array())
+
+
+    def get_stimulus_waveform(self):
+        '''
+        Like get_stimulus_pulse but returns a Waveform (or a list of
+        Waveforms for a many channel overload stimulus) that makes the
+        samples only when needed.
+        '''
+        if isinstance(self.overload_stimulus, list):
+            return [Waveform([np.asarray(stim)]) for stim in self.overload_stimulus]
+        elif self.overload_stimulus is not None:
+            return Waveform([np.asarray(self.overload_stimulus)])
+
         N0_samples = int(self.prestim_time*self.fs)
         N1_samples = int(self.stim_time*self.fs)
         N2_samples = int(self.poststim_time*self.fs)
         
+        stimulus = Waveform()
+        intensity = self.stimulus_intensity
+
         if self.wtype == 'square':
-            stimulus = np.concatenate( (np.zeros(N0_samples), np.ones(N1_samples), np.zeros(N2_samples)) )
+            stimulus.constant(0, N0_samples)
+            stimulus.constant(intensity, N1_samples)
+            stimulus.constant(0, N2_samples)
         elif 'logsweep' in self.wtype:
             try:
                 wtype, f0, f1 = self.wtype.split(',')
@@ -122,34 +454,45 @@ class StimulusBuilder:
                 f1=100
                 wtype = self.wtype
             
-            times = np.linspace(0, self.stim_time, N1_samples)
-            active = scipy.signal.chirp(times, f0=f0, f1=f1, t1=self.stim_time, phi=-90, method='logarithmic')
-            
-            if wtype == 'squarelogsweep':
-                active[active>0] = 1
-                active[active<0] = -1
-            elif wtype == '3steplogsweep':
-                cstep = np.sin(np.pi/4)
-                active[np.abs(active) <= cstep] = 0
-                active[active > cstep] = 1
-                active[active < -cstep] = -1
-                
-            elif wtype == 'sinelogsweep':
-                pass
-            else:
+            if wtype not in ['squarelogsweep', '3steplogsweep', 'sinelogsweep']:
                 raise ValueError('Unkown flash_type'.format(wtype))
+
+            stim_time = self.stim_time
+            # Sample times as np.linspace(0, stim_time, N1_samples)
+            step = stim_time / (N1_samples-1) if N1_samples > 1 else 0
+
+            def sweep(i0, i1):
+                if i1 <= i0:
+                    # No stimulus samples (stim_time 0)
+                    return np.zeros(0)
+                times = np.arange(i0, i1) * step
+                if i1 == N1_samples:
+                    times[-1] = stim_time
+                active = scipy.signal.chirp(times, f0=f0, f1=f1, t1=stim_time, phi=-90, method='logarithmic')
+            
+                if wtype == 'squarelogsweep':
+                    active[active>0] = 1
+                    active[active<0] = -1
+                elif wtype == '3steplogsweep':
+                    cstep = np.sin(np.pi/4)
+                    active[np.abs(active) <= cstep] = 0
+                    active[active > cstep] = 1
+                    active[active < -cstep] = -1
+
+                # Move and scale between 0 and 1 (from - 1 and 1)
+                return intensity * (active+1)/2
                 
             # Join with pre and post 0.5 values
-            # and move and scale between 0 and 1 (from - 1 and 1)
-            stimulus = np.concatenate( (np.ones(N0_samples)/2, (active+1)/2, np.ones(N2_samples)/2) )
+            stimulus.constant(intensity/2, N0_samples)
+            self._cached_segment(
+                    stimulus, ('sweep', wtype, f0, f1, stim_time, N1_samples, intensity),
+                    sweep, N1_samples)
+            stimulus.constant(intensity/2, N2_samples)
             
         else:
             raise ValueError('Invalid wtype given, has to be "square" or "sinelogsweep" or "3steplogsweep"')
 
-        stimulus = self.stimulus_intensity * stimulus
-
-   
-        stimulus[-1] = self.stimulus_finalval
+        stimulus.set_last(self.stimulus_finalval)
         
         return stimulus
 
@@ -159,10 +502,19 @@ class StimulusBuilder:
         '''
         Returns 1D np.array.
         '''
-        illumination = np.ones( int((self.stim_time+self.prestim_time+self.poststim_time)*self.fs) )
-        illumination = self.illumination_intensity * illumination
+        return WAVEFORM_CACHE.get(
+                self._key('illumination'), lambda: self.get_illumination_waveform().array())
+
 
-        illumination[-1] = self.illumination_finalval
+    def get_illumination_waveform(self):
+        '''
+        Like get_illumination but returns a Waveform.
+        '''
+        illumination = Waveform()
+        illumination.constant(
+                self.illumination_intensity,
+                int((self.stim_time+self.prestim_time+self.poststim_time)*self.fs))
+        illumination.set_last(self.illumination_finalval)
         
         return illumination
 
@@ -182,8 +534,31 @@ class StimulusBuilder:
         
         Returns 1D np.array.
         '''
-        cameras = []
+        return list(self.get_camera_trains(N, interleaved))
+
+
+    def get_camera_trains(self, N=1, interleaved=False):
+        '''
+        Like get_camera but returns one (N, samples) array (read-only).
+        '''
+        N_total_samples, samples_per_frame, shift = self._camera_timing(N, interleaved)
+
+        def make():
+            trains = camera_trains(
+                    shift*np.arange(N), N_total_samples, samples_per_frame,
+                    self.N_frames)
+            if N_total_samples:
+                trains[:, -1] = 0
+            return trains
+
+        return WAVEFORM_CACHE.get(self._key('camera_trains', N, interleaved), make)
+
 
+    def _camera_timing(self, N, interleaved):
+        '''
+        Returns the total samples, samples per frame half and the
+        interleaving shift of the camera triggers.
+        '''
         N0_samples = int(self.prestim_time*self.fs)
         N1_samples = int(self.stim_time*self.fs)
         N2_samples = int(self.poststim_time*self.fs)
@@ -194,32 +569,199 @@ class StimulusBuilder:
             shift = int(samples_per_frame*2/N)
         else:
             shift = 0
-        
-        for i in range(N):
-            camera = np.concatenate( ( np.ones((samples_per_frame, self.N_frames)), np.zeros((samples_per_frame, self.N_frames)) ) )
-            camera = camera.T.flatten()
-            camera = 3.3*camera
-
-            ashift = shift*i 
-            if ashift:
-                a,b = np.split(camera, [ashift], axis=0)
-                camera = np.concatenate((b,a))
-
-            # Theres a bug in this code that camera wave can be longer
-            # than the stimulus and IR so lets keep it same length
-            if len(camera) > N_total_samples:
-                camera = camera[0:N_total_samples]
-            elif len(camera) < N_total_samples:
-                camera = np.concatenate(
-                    (camera, np.zeros(N_total_samples-len(camera)))
-                    )
-                
-            camera[-1] = 0
+        return N_total_samples, samples_per_frame, shift
+
+
+    def get_camera_waveforms(self, N=1, interleaved=False):
+        '''
+        Like get_camera but returns a list of Waveforms.
+        '''
+        N_total_samples, samples_per_frame, shift = self._camera_timing(N, interleaved)
+
+        def make_train(ashift):
+            def train(i0, i1):
+                return camera_trains(
+                        [ashift], N_total_samples, samples_per_frame,
+                        self.N_frames, i0, i1)[0]
+            return train
 
+        cameras = []
+        for i in range(N):
+            camera = Waveform()
+            self._cached_segment(
+                    camera, ('camera', N_total_samples, samples_per_frame, self.N_frames, shift*i),
+                    make_train(shift*i), N_total_samples)
+            camera.set_last(0)
             cameras.append(camera)
 
         return cameras
 
+
+
+def _hashable(value):
+    '''Returns the value with its lists and arrays turned into tuples.
+    '''
+    if isinstance(value, np.ndarray):
+        value = value.tolist()
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    return value
+
+
+def _parse_json_stimulus(fn):
+    # The stimuli are in the keys stim_0 to stim_9
+    with open(fn, 'r') as fp:
+        data = json.load(fp)
+
+    stimuli = []
+    for i_stim in range(10):
+        key = f'stim_{i_stim}'
+        if key not in data:
+            continue
+        stimuli.append(np.array(data[key]))
+    return stimuli, data['fs']
+
+
+def _parse_biosyst_stimulus(fn, channel):
+    stimulus, fs = bsextract(fn, channel)
+    stimulus = stimulus.flatten()
+    print(f'Loaded a Biosyst stimulus of {stimulus.shape[0]} samples (max {np.max(stimulus)})')
+    return [stimulus], fs
+
+
+def camera_trains(shifts, N_total_samples, samples_per_frame, N_frames, i0=0, i1=None):
+    '''Returns the camera trigger trains of many cameras as one array.
+
+    Each train has N_frames pulses (3.3 V for samples_per_frame and
+    then 0 V for samples_per_frame) and is exactly N_total_samples
+    long: the pulses past the end are cut and the rest is zeros.
+
+    Arguments
+    ---------
+    shifts : sequence of ints
+        For each camera, by how many samples its pulses are advanced
+        (interleaving). Wraps around within the pulses.
+    i0, i1 : int
+        Returns only the samples i0:i1 (for streaming)
+
+    Returns a (len(shifts), i1-i0) array.
+    '''
+    if i1 is None:
+        i1 = N_total_samples
+    shifts = np.asarray(shifts, dtype=int)
+    trains = np.zeros((len(shifts), i1-i0))
+
+    period = 2 * samples_per_frame
+    N_pulsed = min(period*N_frames, i1) - i0
+    if period == 0 or N_pulsed <= 0:
+        return trains
+
+    # One period of each camera's train, starting at the sample i0,
+    # broadcasted over the whole periods and then the last partial one
+    phase = (i0 + shifts[:, None] + np.arange(period)) % period
+    periods = np.where(phase < samples_per_frame, 3.3, 0.)
+
+    n_full = N_pulsed // period * period
+    blocks = trains[:, :n_full]
+    blocks.shape = (len(shifts), n_full // period, period)
+    blocks[:] = periods[:, None, :]
+    trains[:, n_full:N_pulsed] = periods[:, :N_pulsed-n_full]
+    return trains
+
+
+def assemble_channels(stimuli, dtype=float, scaling=None):
+    '''Writes the channels' stimuli into one (channels, samples) array.
+
+    The array is allocated once (C-contiguous) and can be given as is
+    to the NI task writer. The stimuli are not modified or copied
+    elsewhere.
+
+    Arguments
+    ---------
+    stimuli : list
+        1D arrays or Waveforms of the same length, one per channel
+    dtype : type
+        The array's data type. With bool, the samples at 1 or above
+        are True (digital lines).
+    scaling : list or None
+        For raw output, per channel the coefficients (c0, c1, ...)
+        converting volts to device codes as c0 + c1*V + c2*V**2 ...
+        The codes are rounded and clipped to the (integer) dtype.
+
+    Returns a 2D array, or a 1D array if there is only one channel.
+    '''
+    n_samples = len(stimuli[0])
+    if any(len(stimulus) != n_samples for stimulus in stimuli):
+        raise ValueError(
+                f'Stimuli lengths differ: {[len(stimulus) for stimulus in stimuli]}')
+
+    data = np.empty((len(stimuli), n_samples), dtype=dtype)
+    for i_row, (row, stimulus) in enumerate(zip(data, stimuli)):
+        if scaling is not None:
+            _write_codes(stimulus, scaling[i_row], row)
+        elif dtype == bool:
+            if isinstance(stimulus, Waveform):
+                stimulus = stimulus.array()
+            np.greater_equal(stimulus, 1, out=row)
+        elif isinstance(stimulus, Waveform):
+            stimulus.get(out=row)
+        else:
+            row[:] = stimulus
+
+    if len(stimuli) == 1:
+        return data[0]
+    return data
+
+
+def _write_codes(stimulus, coefficients, out):
+    # Converts in chunks so that the volts are never all in memory
+    info = np.iinfo(out.dtype)
+    for i0 in range(0, len(out), CHUNK_SIZE):
+        i1 = min(i0+CHUNK_SIZE, len(out))
+        if isinstance(stimulus, Waveform):
+            volts = stimulus.get(i0, i1)
+        else:
+            volts = np.asarray(stimulus[i0:i1], dtype=float)
+
+        codes = np.zeros(i1-i0)
+        for coefficient in reversed(coefficients):
+            codes *= volts
+            codes += coefficient
+        np.rint(codes, out=codes)
+        np.clip(codes, info.min, info.max, out=codes)
+        out[i0:i1] = codes
+
+
+def compile_repeats(repeats, gaps):
+    '''Joins the waveforms of protocol repeats into one per channel.
+
+    For outputting a whole protocol as one hardware-timed waveform,
+    so that the inter stimulus intervals are sample accurate.
+
+    Arguments
+    ---------
+    repeats : list
+        For each repeat, a list of Waveforms or 1D arrays (one per
+        channel)
+    gaps : list
+        For each repeat, a list of Waveforms or 1D arrays (one per
+        channel) to output after the repeat, for example the ISI.
+
+    Returns a list of Waveforms, one per channel. No samples are made
+    until they are needed.
+    '''
+    compiled = []
+    for i_channel in range(len(repeats[0])):
+        waveform = Waveform()
+        for repeat, gap in zip(repeats, gaps):
+            for part in (repeat[i_channel], gap[i_channel]):
+                if isinstance(part, Waveform):
+                    waveform.extend(part)
+                else:
+                    waveform.append(np.asarray(part))
+        compiled.append(waveform)
+    return compiled
+
         
 
 
@@ -0,0 +1,445 @@
+'''Supervising the local server processes.
+
+The local camera and vio servers are subprocesses of the core. The
+ServerSupervisor owns them, tracks their health and resource usage,
+stops them in a bounded time and can keep a pre-warmed spare server.
+
+Ready handshake
+---------------
+Each server is started with --ready-port. When it is ready to take
+commands, it connects to the ready port and sends "ready".
+
+A spare server (started with --spare and without a port) does its
+slow imports and then connects to the ready port and sends "spare".
+It waits there until the supervisor sends it a port number, binds
+the port and finally sends "ready". Taking a spare into use takes
+only the time of binding the sockets.
+'''
+
+import os
+import sys
+import time
+import socket
+import threading
+import subprocess
+import importlib.util
+
+if importlib.util.find_spec('psutil') is None:
+    HAS_PSUTIL = False
+else:
+    HAS_PSUTIL = True
+
+# In seconds, how long to wait a server to exit by itself before
+# terminating it, and how long after terminating before killing it
+STOP_TIMEOUT = 3
+KILL_TIMEOUT = 1
+
+# In seconds, how long to wait for a spare to finish its startup
+# before falling back to starting a new server
+SPARE_TIMEOUT = 30
+
+
+def _read_message(conn):
+    '''Reads a handshake message (ends in a newline or at EOF).
+    '''
+    message = b''
+    while not message.endswith(b'\n'):
+        data = conn.recv(1)
+        if not data:
+            break
+        message += data
+    return message.decode().strip()
+
+
+def _proc_usage(pid):
+    '''Returns (cpu_seconds, rss_bytes) read from /proc (Linux only).
+    '''
+    with open(f'/proc/{pid}/stat', 'r') as fp:
+        # The fields after the process name; utime and stime are
+        # the fields 14 and 15 of the whole line
+        fields = fp.read().rsplit(')', 1)[1].split()
+    cpu_seconds = (int(fields[11])+int(fields[12])) / os.sysconf('SC_CLK_TCK')
+
+    with open(f'/proc/{pid}/statm', 'r') as fp:
+        rss = int(fp.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    return cpu_seconds, rss
+
+
+class ServerProcess:
+    '''A local server subprocess.
+
+    Has the poll, wait, terminate and kill methods of subprocess.Popen.
+
+    Attributes
+    ----------
+    name : string
+        The server type, "camera" or "vio"
+    port : int or None
+        The server's port, or None for an unassigned spare
+    args : list
+        Extra command line arguments of the server
+    popen : obj
+        The subprocess.Popen
+    start_time : float
+        When the process was started (or the spare taken into use)
+    ready : bool
+        True after the server has reported ready
+    '''
+
+    def __init__(self, name, port=None, args=()):
+        if name not in ['camera', 'vio']:
+            raise ValueError(
+                    f'name has to be "camera" or "vio" not {name}')
+
+        self.name = name
+        self.port = port
+        self.args = list(args)
+        self.ready = False
+        self._conn = None
+
+        self._ready_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._ready_socket.bind(('127.0.0.1', 0))
+        self._ready_socket.listen(1)
+        ready_port = self._ready_socket.getsockname()[1]
+
+        command = [
+                sys.executable,
+                '-m', f'gonioimsoft.{name}_server',
+                '--ready-port', str(ready_port),
+                *self.args,
+                ]
+        if port is None:
+            command.append('--spare')
+        else:
+            command.extend(['--port', str(port)])
+
+        self.popen = subprocess.Popen(command, stdout=subprocess.DEVNULL)
+        self.pid = self.popen.pid
+        self.start_time = time.time()
+
+
+    def poll(self):
+        return self.popen.poll()
+
+    def wait(self, timeout=None):
+        return self.popen.wait(timeout)
+
+    def terminate(self):
+        self.popen.terminate()
+
+    def kill(self):
+        self.popen.kill()
+
+
+    def _accept(self, end_time):
+        '''Accepts the server's handshake connection.
+
+        Returns the connection or None if the server exited or
+        did not connect in time.
+        '''
+        if self._ready_socket is None:
+            return None
+        self._ready_socket.settimeout(0.1)
+        while time.time() < end_time:
+            if self.poll() is not None:
+                print(f'The local {self.name} server exited before it was ready')
+                return None
+            try:
+                conn, addr = self._ready_socket.accept()
+            except socket.timeout:
+                continue
+            conn.settimeout(max(end_time-time.time(), 0.1))
+            return conn
+        return None
+
+
+    def wait_spare(self, timeout=SPARE_TIMEOUT):
+        '''Waits until a spare server has done its startup.
+
+        Returns True if the spare is waiting for a port.
+        '''
+        if self._conn is not None:
+            return True
+        conn = self._accept(time.time()+timeout)
+        if conn is None:
+            return False
+        try:
+            message = _read_message(conn)
+        except OSError:
+            message = ''
+        if message != 'spare':
+            conn.close()
+            return False
+        self._conn = conn
+        return True
+
+
+    def assign(self, port):
+        '''Tells a waiting spare server the port to take into use.
+
+        Call wait_ready afterwards.
+        '''
+        self._conn.sendall(f'{port}\n'.encode())
+        self.port = port
+        self.start_time = time.time()
+
+
+    def wait_ready(self, timeout=60):
+        '''Waits until the server reports ready.
+
+        Arguments
+        ---------
+        timeout : int or float
+            In seconds, the maximum time to wait.
+
+        Returns True if the server is ready and False otherwise.
+        '''
+        if self.ready:
+            return True
+
+        end_time = time.time() + timeout
+        conn, self._conn = self._conn, None
+        if conn is None:
+            conn = self._accept(end_time)
+        if conn is None:
+            print(f'The local server on port {self.port} not ready in time')
+            self.close()
+            return False
+
+        with conn:
+            conn.settimeout(max(end_time-time.time(), 0.1))
+            try:
+                message = _read_message(conn)
+            except OSError:
+                message = ''
+        self.close()
+
+        self.ready = message == 'ready'
+        return self.ready
+
+
+    def close(self):
+        '''Closes the handshake sockets.
+
+        An unassigned spare exits when its handshake is closed.
+        '''
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+        if self._ready_socket is not None:
+            self._ready_socket.close()
+            self._ready_socket = None
+
+
+    def stop(self, timeout=STOP_TIMEOUT):
+        '''Waits the process to exit, terminating or killing it if needed.
+
+        The exit command should be sent to the server first.
+        '''
+        self.close()
+        try:
+            self.popen.wait(timeout)
+            return
+        except subprocess.TimeoutExpired:
+            print(f'Terminating the local server on port {self.port}')
+            self.popen.terminate()
+        try:
+            self.popen.wait(KILL_TIMEOUT)
+        except subprocess.TimeoutExpired:
+            print(f'Killing the local server on port {self.port}')
+            self.popen.kill()
+            self.popen.wait()
+
+
+class ServerSupervisor:
+    '''Owns all the local server processes.
+
+    Attributes
+    ----------
+    servers : dict
+        Keys ports and values ServerProcesses
+    spares : dict
+        Keys server names ("camera", "vio") and values the spare
+        ServerProcesses (not yet assigned to any port)
+    restarts : dict
+        Keys ports and values how many times the server was replaced
+    '''
+
+    def __init__(self):
+        self.servers = {}
+        self.spares = {}
+        self.restarts = {}
+
+        self._spare_args = {}
+        self._cpu_times = {}
+        self._lock = threading.Lock()
+
+
+    def start_server(self, name, port, args=()):
+        '''Starts a server at the port, using a spare if there is one.
+
+        Call wait_ready of the returned ServerProcess before sending
+        commands.
+
+        Arguments
+        ---------
+        name : string
+            "camera" or "vio"
+        port : int
+            The port for the server
+        args : list
+            Extra command line arguments for the server. A spare is
+            used only if args are empty or the same as the spare's.
+        '''
+        with self._lock:
+            previous = self.servers.get(port)
+            if previous is not None:
+                previous.close()
+                self.restarts[port] = self.restarts.get(port, 0) + 1
+
+            process = self._take_spare(name, port, args)
+            if process is None:
+                process = ServerProcess(name, port, args)
+            self.servers[port] = process
+        return process
+
+
+    def _take_spare(self, name, port, args):
+        spare = self.spares.get(name)
+        if spare is None or (args and list(args) != spare.args):
+            return None
+
+        self.spares[name] = None
+        if not spare.wait_spare():
+            print(f'The spare {name} server failed, starting a new server')
+            spare.close()
+            return None
+
+        print(f'Taking the spare {name} server into use on port {port}')
+        spare.assign(port)
+
+        # Replace the spare straight away; Its startup does not
+        # slow down the takeover
+        self.spares[name] = ServerProcess(name, None, self._spare_args[name])
+        return spare
+
+
+    def keep_spare(self, name, args=()):
+        '''Keeps a pre-warmed spare server of the given type running.
+
+        Arguments
+        ---------
+        name : string
+            "camera" or "vio"
+        args : list
+            Extra command line arguments for the spare, for example
+            ['--preload', 'camera.cfg'] for a camera server that loads
+            the MicroManager configuration beforehand.
+        '''
+        with self._lock:
+            spare = self.spares.get(name)
+            if spare is not None and spare.args == list(args):
+                return
+            self._stop_spare(name)
+            self._spare_args[name] = list(args)
+            self.spares[name] = ServerProcess(name, None, args)
+
+
+    def stop_spare(self, name):
+        '''Stops keeping a spare server of the given type.
+        '''
+        with self._lock:
+            self._stop_spare(name)
+            self._spare_args.pop(name, None)
+
+
+    def _stop_spare(self, name):
+        spare = self.spares.pop(name, None)
+        if spare is not None:
+            # An unassigned spare exits when the handshake closes
+            spare.stop(KILL_TIMEOUT)
+
+
+    def stop_server(self, port, timeout=STOP_TIMEOUT):
+        '''Waits the server at the port to exit (terminates if needed).
+
+        Send the exit command to the server first.
+        '''
+        with self._lock:
+            process = self.servers.pop(port, None)
+        if process is not None:
+            process.stop(timeout)
+
+
+    def _usage(self, pid):
+        '''Returns (cpu_percent, rss_bytes), None for unknown values.
+        '''
+        try:
+            if HAS_PSUTIL:
+                import psutil
+                process = psutil.Process(pid)
+                cpu_seconds = sum(process.cpu_times()[:2])
+                rss = process.memory_info().rss
+            else:
+                cpu_seconds, rss = _proc_usage(pid)
+        except Exception:
+            return None, None
+
+        # CPU usage since the previous call
+        now = time.time()
+        previous = self._cpu_times.get(pid)
+        self._cpu_times[pid] = (now, cpu_seconds)
+        if previous is None or now <= previous[0]:
+            return None, rss
+        return 100*(cpu_seconds-previous[1])/(now-previous[0]), rss
+
+
+    def status(self):
+        '''Returns the health and resource usage of the processes.
+
+        Returns a list of dictionaries with the keys "name", "port",
+        "pid", "state" ("running", "starting", "exited" or "spare"),
+        "returncode", "uptime", "restarts", "cpu_percent" (since
+        the previous status call) and "rss" (resident memory in bytes).
+        '''
+        with self._lock:
+            processes = list(self.servers.values())
+            processes += [p for p in self.spares.values() if p is not None]
+
+        status = []
+        for process in processes:
+            returncode = process.poll()
+            if returncode is not None:
+                state = 'exited'
+            elif process.port is None:
+                state = 'spare'
+            elif not process.ready:
+                state = 'starting'
+            else:
+                state = 'running'
+
+            cpu_percent, rss = None, None
+            if returncode is None:
+                cpu_percent, rss = self._usage(process.pid)
+
+            status.append({
+                'name': process.name,
+                'port': process.port,
+                'pid': process.pid,
+                'state': state,
+                'returncode': returncode,
+                'uptime': time.time() - process.start_time,
+                'restarts': self.restarts.get(process.port, 0),
+                'cpu_percent': cpu_percent,
+                'rss': rss,
+                })
+        return status
+
+
+    def close(self):
+        '''Stops the spares and all the servers still running.
+        '''
+        for name in list(self.spares):
+            self.stop_spare(name)
+        for port in list(self.servers):
+            self.stop_server(port)
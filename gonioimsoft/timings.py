@@ -0,0 +1,161 @@
+'''Per-command latency statistics for the clients and the servers.
+
+Timings are collected into histograms with logarithmically spaced
+bins so that the memory use stays constant no matter how many
+commands are sent.
+'''
+
+import math
+import threading
+
+# Histogram range and resolution (values outside go to the end bins)
+MIN_SECONDS = 1e-6
+MAX_SECONDS = 1e3
+BINS_PER_DECADE = 20
+
+
+class Histogram:
+    '''Logarithmically binned histogram of durations.
+
+    Attributes
+    ----------
+    counts : list
+        Counts per bin
+    n : int
+        Total number of recorded values
+    total : float
+        Sum of the recorded values in seconds
+    maximum : float
+        The largest recorded value in seconds
+    '''
+
+    N_BINS = int(math.log10(MAX_SECONDS/MIN_SECONDS) * BINS_PER_DECADE) + 1
+
+    def __init__(self):
+        self.counts = [0] * self.N_BINS
+        self.n = 0
+        self.total = 0.
+        self.maximum = 0.
+
+
+    def add(self, seconds):
+        '''Adds a duration (in seconds) to the histogram.
+        '''
+        if seconds <= MIN_SECONDS:
+            index = 0
+        else:
+            index = int(math.log10(seconds/MIN_SECONDS) * BINS_PER_DECADE)
+            index = min(index, self.N_BINS-1)
+
+        self.counts[index] += 1
+        self.n += 1
+        self.total += seconds
+        self.maximum = max(self.maximum, seconds)
+
+
+    def percentile(self, percent):
+        '''Returns the approximate percentile value in seconds.
+
+        The value is the upper edge of the bin containing the
+        percentile, and at most the largest recorded value.
+        '''
+        if self.n == 0:
+            return 0.
+
+        limit = self.n * percent / 100
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= limit:
+                break
+
+        upper_edge = MIN_SECONDS * 10**((index+1)/BINS_PER_DECADE)
+        return min(upper_edge, self.maximum)
+
+
+class CommandTimings:
+    '''Collects latency histograms per command name and phase.
+
+    Phases are freely named parts of the command's handling, for
+    example "connect", "response" and "total" on the client or
+    "execute" on the server.
+
+    Attributes
+    ----------
+    histograms : dict
+        Keys (command_name, phase) tuples and values Histograms
+    counters : dict
+        Keys (command_name, counter_name) and values integers, for
+        example the number of connection retries.
+    '''
+
+    def __init__(self):
+        self.histograms = {}
+        self.counters = {}
+        self._lock = threading.Lock()
+
+
+    def record(self, command_name, phase, seconds):
+        '''Records a duration for the command's phase.
+        '''
+        with self._lock:
+            key = (command_name, phase)
+            if key not in self.histograms:
+                self.histograms[key] = Histogram()
+            self.histograms[key].add(seconds)
+
+
+    def count(self, command_name, counter_name, amount=1):
+        '''Increments a counter of the command.
+        '''
+        with self._lock:
+            key = (command_name, counter_name)
+            self.counters[key] = self.counters.get(key, 0) + amount
+
+
+    def summary(self):
+        '''Returns the statistics as a JSON serializable dictionary.
+
+        Format: {command_name: {phase: {"n", "mean", "p50", "p95",
+        "p99", "max"}, counter_name: value}}
+        '''
+        summary = {}
+        with self._lock:
+            for (command_name, phase), hist in self.histograms.items():
+                summary.setdefault(command_name, {})[phase] = {
+                        'n': hist.n,
+                        'mean': hist.total / hist.n,
+                        'p50': hist.percentile(50),
+                        'p95': hist.percentile(95),
+                        'p99': hist.percentile(99),
+                        'max': hist.maximum,
+                        }
+            for (command_name, counter_name), value in self.counters.items():
+                summary.setdefault(command_name, {})[counter_name] = value
+        return summary
+
+
+    def clear(self):
+        '''Forgets all the recorded timings.
+        '''
+        with self._lock:
+            self.histograms = {}
+            self.counters = {}
+
+
+def format_summary(summary):
+    '''Returns a CommandTimings summary as a printable table.
+    '''
+    lines = [f'{"command": >20} {"phase": >10} {"n": >6} '
+             f'{"p50 ms": >9} {"p95 ms": >9} {"p99 ms": >9} {"max ms": >9}']
+
+    for command_name in sorted(summary):
+        for phase, stats in summary[command_name].items():
+            if not isinstance(stats, dict):
+                lines.append(f'{command_name: >20} {phase: >10} {stats: >6}')
+                continue
+            lines.append(
+                    f'{command_name: >20} {phase: >10} {stats["n"]: >6} '
+                    f'{1000*stats["p50"]: >9.3f} {1000*stats["p95"]: >9.3f} '
+                    f'{1000*stats["p99"]: >9.3f} {1000*stats["max"]: >9.3f}')
+    return '\n'.join(lines)
@@ -0,0 +1,263 @@
+'''Background transfer of recorded files to a central storage.
+
+When camera servers run on other PCs, their recordings are saved on
+the local disk of each PC. A TransferAgent (running in the camera
+server) pushes the finished files to a TransferReceiver (running on
+the central storage machine) while the imaging goes on.
+
+Protocol (one connection per file)
+----------------------------------
+1) The agent sends a JSON line {"path", "size", "sha256"} where path
+   is relative to the receiver's directory.
+2) The receiver answers a JSON line {"offset"} telling how many bytes
+   of the file it already has from an earlier interrupted transfer.
+3) The agent sends the rest of the file starting from the offset.
+4) The receiver checks the SHA-256 of the whole file and answers
+   "ok" or "bad" (a bad partial file is removed).
+
+Run the receiver from the terminal
+
+    python -m gonioimsoft.transfer --port 50500 --directory central_data
+'''
+
+import os
+import json
+import time
+import queue
+import socket
+import hashlib
+import argparse
+import threading
+
+TRANSFER_PORT = 50500
+
+# Bytes per sent chunk
+CHUNK_SIZE = 256*1024
+
+# In bytes per second, the bandwidth limit while a camera acquires
+# images. None means no limit.
+ACTIVE_RATE = 2*1024*1024
+IDLE_RATE = None
+
+# In seconds, wait before retrying a failed transfer
+RETRY_INTERVAL = 5
+
+
+def file_sha256(fn, size=None):
+    '''Returns the SHA-256 hex digest of the file (first size bytes).
+    '''
+    sha = hashlib.sha256()
+    remaining = size
+    with open(fn, 'rb') as fp:
+        while remaining is None or remaining > 0:
+            n_read = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+            chunk = fp.read(n_read)
+            if not chunk:
+                break
+            sha.update(chunk)
+            if remaining is not None:
+                remaining -= len(chunk)
+    return sha.hexdigest()
+
+
+def _readline(conn):
+    line = b''
+    while not line.endswith(b'\n'):
+        data = conn.recv(1)
+        if not data:
+            raise ConnectionError('Connection closed')
+        line += data
+    return line.decode().strip()
+
+
+class TransferAgent:
+    '''Pushes finished files to a TransferReceiver in a background thread.
+
+    Attributes
+    ----------
+    host, port
+        The receiver's address
+    root : string
+        Local directory that the sent paths are relative to
+    acquiring : bool
+        If True, the bandwidth is limited to ACTIVE_RATE
+    status : dict
+        Counters "queued", "sent_files", "sent_bytes" and "failures"
+    '''
+
+    def __init__(self, host, port=TRANSFER_PORT, root='.'):
+        self.host = host
+        self.port = int(port)
+        self.root = os.path.abspath(root)
+        self.acquiring = False
+
+        self.queue = queue.Queue()
+        self.status = {'queued': 0, 'sent_files': 0, 'sent_bytes': 0,
+                       'failures': 0}
+        self._stop = False
+
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+
+    def enqueue(self, fn):
+        '''Adds a finished file to the transfer queue.
+        '''
+        self.status['queued'] += 1
+        self.queue.put(os.path.abspath(fn))
+
+
+    def set_acquiring(self, acquiring):
+        '''Tells the agent if an acquisition is running (throttles).
+        '''
+        self.acquiring = acquiring
+
+
+    def stop(self):
+        '''Stops the agent after the current file.
+        '''
+        self._stop = True
+        self.queue.put(None)
+
+
+    def _loop(self):
+        while not self._stop:
+            fn = self.queue.get()
+            if fn is None:
+                break
+            try:
+                self._send(fn)
+            except (OSError, ValueError) as e:
+                print(f'Transfer of {fn} failed, retrying later: {e}')
+                self.status['failures'] += 1
+                time.sleep(RETRY_INTERVAL)
+                self.queue.put(fn)
+                continue
+            self.status['queued'] -= 1
+            self.status['sent_files'] += 1
+
+
+    def _send(self, fn):
+        size = os.path.getsize(fn)
+        header = {
+                'path': os.path.relpath(fn, self.root).replace(os.sep, '/'),
+                'size': size, 'sha256': file_sha256(fn)}
+
+        with socket.create_connection((self.host, self.port)) as conn:
+            conn.sendall(json.dumps(header).encode()+b'\n')
+            offset = json.loads(_readline(conn))['offset']
+
+            start_time = time.time()
+            sent = 0
+            with open(fn, 'rb') as fp:
+                fp.seek(offset)
+                while True:
+                    chunk = fp.read(CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    conn.sendall(chunk)
+                    sent += len(chunk)
+                    self.status['sent_bytes'] += len(chunk)
+
+                    rate = ACTIVE_RATE if self.acquiring else IDLE_RATE
+                    if rate:
+                        wait = sent/rate - (time.time()-start_time)
+                        if wait > 0:
+                            time.sleep(wait)
+
+            result = _readline(conn)
+        if result != 'ok':
+            raise ValueError(f'Receiver reports checksum mismatch')
+
+
+class TransferReceiver:
+    '''Receives files from TransferAgents and stores them.
+
+    Partially received files are kept with a ".part" suffix so that
+    an interrupted transfer can be resumed.
+    '''
+
+    def __init__(self, port=TRANSFER_PORT, directory='.'):
+        self.directory = os.path.abspath(directory)
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind(('', int(port)))
+        self.socket.listen(4)
+
+
+    def _path(self, relpath):
+        fn = os.path.abspath(os.path.join(self.directory, relpath))
+        if os.path.commonpath([fn, self.directory]) != self.directory:
+            raise ValueError(f'Path outside the directory: {relpath}')
+        return fn
+
+
+    def handle(self, conn):
+        '''Receives one file over the connection.
+        '''
+        header = json.loads(_readline(conn))
+        fn = self._path(header['path'])
+        partfn = fn + '.part'
+        os.makedirs(os.path.dirname(fn), exist_ok=True)
+
+        offset = 0
+        if os.path.exists(partfn):
+            offset = min(os.path.getsize(partfn), header['size'])
+        conn.sendall(json.dumps({'offset': offset}).encode()+b'\n')
+
+        with open(partfn, 'ab') as fp:
+            fp.truncate(offset)
+            remaining = header['size'] - offset
+            while remaining > 0:
+                data = conn.recv(min(CHUNK_SIZE, remaining))
+                if not data:
+                    # Interrupted; Keep the part file for resuming
+                    return
+                fp.write(data)
+                remaining -= len(data)
+
+        if file_sha256(partfn) == header['sha256']:
+            os.replace(partfn, fn)
+            print(f'Received {header["path"]}')
+            conn.sendall(b'ok\n')
+        else:
+            os.remove(partfn)
+            print(f'Checksum mismatch for {header["path"]}')
+            conn.sendall(b'bad\n')
+
+
+    def _handle_thread(self, conn):
+        with conn:
+            try:
+                self.handle(conn)
+            except (OSError, ValueError) as e:
+                print(f'Receiving failed: {e}')
+
+
+    def run(self):
+        '''Receives files (each in its own thread) until interrupted.
+        '''
+        print(f'Receiving files to {self.directory}')
+        while True:
+            conn, addr = self.socket.accept()
+            threading.Thread(
+                    target=self._handle_thread, args=(conn,),
+                    daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            prog='GonioImsoft Transfer Receiver',
+            description='Receives recordings from remote camera servers')
+
+    parser.add_argument('-p', '--port', default=TRANSFER_PORT)
+    parser.add_argument('-d', '--directory', default='.')
+
+    args = parser.parse_args()
+
+    receiver = TransferReceiver(args.port, args.directory)
+    receiver.run()
+
+
+if __name__ == "__main__":
+    main()
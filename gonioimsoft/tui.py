@@ -17,7 +17,11 @@ from gonioimsoft.directories import (
         IS_USERDATA_INITIALIZED,
         initialize_userdata,
         )
-from gonioimsoft.core import GonioImsoftCore, nidaqmx
+from gonioimsoft.core import GonioImsoftCore
+from gonioimsoft.daq import NIBackend
+from gonioimsoft.clientbase import ServerDownError
+from gonioimsoft.timings import format_summary
+from gonioimsoft.stimulus import WAVEFORM_CACHE, STIMULUS_FILES
 from gonioimsoft.imaging_parameters import (
         DEFAULT_DYNAMIC_PARAMETERS,
         ParameterEditor,
@@ -53,6 +57,8 @@ class Console:
             except TypeError as e:
                 print(e)
                 self.help()
+            except ServerDownError as e:
+                print(e)
         else:
             print('Command {} does not exist'.format(command_name))
             self.help()
@@ -321,6 +327,108 @@ class Console:
         except Exception as e:
             print(e)
 
+    def transfer(self, host, port=None):
+        '''Makes the camera servers push recordings to a central storage.
+
+        Arguments
+        ---------
+        host : string
+            Address of the machine running the transfer receiver
+            (python -m gonioimsoft.transfer) or "none" to stop.
+        port : int or None
+            The receiver's port. If not given, uses the default.
+        '''
+        for i_camera, camera in enumerate(self.core.cameras):
+            camera.set_transfer(host, port)
+            print(f'cam{i_camera} transfers: {camera.get_transfer_status()}')
+
+    def abort(self):
+        '''Aborts the series acquisitions running on the cameras.
+        '''
+        self.core.abort_acquisitions()
+
+    def acquisition(self):
+        '''Prints the series acquisition status of the cameras.
+        '''
+        for i_camera, camera in enumerate(self.core.cameras):
+            print(f'cam{i_camera}: {camera.get_acquisition_status()}')
+
+    def spare(self, name='camera', preload=None):
+        '''Keeps a pre-warmed spare server that replaces crashed servers.
+
+        Arguments
+        ---------
+        name : string
+            "camera" or "vio", or "off" to stop keeping spares.
+        preload : string
+            The camera (configuration) that a camera spare loads
+            beforehand. By default, the camera of the first client.
+        '''
+        if name == 'off':
+            for name in ['camera', 'vio']:
+                self.core.supervisor.stop_spare(name)
+        else:
+            self.core.keep_spare(name, preload)
+
+    def servers(self):
+        '''Prints the health and resource usage of the local servers.
+        '''
+        for status in self.core.get_server_status():
+            cpu = status['cpu_percent']
+            cpu = '-' if cpu is None else f'{cpu:.0f}%'
+            rss = status['rss']
+            rss = '-' if rss is None else f'{rss/1e6:.0f} MB'
+            print(f'{status["name"]: >6} {str(status["port"]): >6} '
+                  f'pid {status["pid"]: <7} {status["state"]: <8} '
+                  f'up {status["uptime"]:.0f} s, restarts {status["restarts"]}, '
+                  f'cpu {cpu}, mem {rss}')
+
+    def journal(self, fn):
+        '''Records the commands sent to the servers to a journal file.
+
+        Arguments
+        ---------
+        fn : string
+            The journal file (jsonl) or "off" to stop recording.
+        '''
+        if fn == 'off':
+            self.core.stop_journal()
+        else:
+            self.core.start_journal(fn)
+
+    def stats(self):
+        '''Prints round trip timings of the commands sent to the servers.
+        '''
+        for name, stats in self.core.get_latency_stats().items():
+            print(f'\n# {name} client (round trips)')
+            print(format_summary(stats['client']))
+            print(f'\n# {name} server (execution)')
+            if stats['server'] is None:
+                print('  Server not reachable')
+            else:
+                print(format_summary(stats['server']))
+        print()
+
+    def waveforms(self, clear=None):
+        '''Prints the statistics of the generated waveforms cache.
+
+        Arguments
+        ---------
+        clear : string
+            If "clear", empties the cache (and the loaded stimulus
+            files).
+        '''
+        if clear == 'clear':
+            WAVEFORM_CACHE.clear()
+            STIMULUS_FILES.clear()
+        stats = WAVEFORM_CACHE.stats()
+        total = stats['hits'] + stats['misses']
+        ratio = stats['hits']/total if total else 0
+        print(f'{stats["entries"]} waveforms, {stats["bytes"]/1e6:.1f} / '
+              f'{stats["max_bytes"]/1e6:.0f} MB, hits {stats["hits"]} '
+              f'({100*ratio:.0f}%), misses {stats["misses"]}, '
+              f'evictions {stats["evictions"]}')
+
     def set_snapexpo(self, time):
         '''Sets the exposure time for snap images
         '''
@@ -388,6 +496,8 @@ class GonioImsoftTUI:
                 ['Quit', self.quit],
                 ['\n', None],
                 ['Add a local camera', self.add_local_camera],
+                ['Add many local cameras', self.add_local_cameras],
+                ['Add many cameras on one local server', self.add_local_multicameras],
                 ['Add a remote camera', self.add_remote_camera],
                 ['Edit camera settings', self.camera_settings_edit],
                 ['Remove camera', self.remove_camera],
@@ -440,6 +550,37 @@ class GonioImsoftTUI:
         self._add_camera(client)
 
 
+    def _input_n_cameras(self):
+        n_cameras = self.libui.input('How many cameras', 'back')
+        if not n_cameras:
+            return None
+        try:
+            return int(n_cameras)
+        except ValueError:
+            self.libui.print(f'Not a number: {n_cameras}')
+            return None
+
+
+    def add_local_cameras(self):
+        '''Add many cameras, starting their local servers in parallel.
+        '''
+        n_cameras = self._input_n_cameras()
+        if not n_cameras:
+            return
+        for client in self.core.add_local_camera_clients(n_cameras):
+            self._add_camera(client)
+
+
+    def add_local_multicameras(self):
+        '''Add many cameras controlled by one local server process.
+        '''
+        n_cameras = self._input_n_cameras()
+        if not n_cameras:
+            return
+        for client in self.core.add_local_multicamera_clients(n_cameras):
+            self._add_camera(client)
+
+
     def add_local_vio(self):
         '''Start a local vio server and a client.
         '''
@@ -545,10 +686,10 @@ class GonioImsoftTUI:
                 ar = 'Serial CLOSED'
 
         # Check DAQ
-        if nidaqmx is None:
-            daq = 'UNAVAILABLE'
-        else:
+        if isinstance(self.core.daq.backend, NIBackend):
             daq = 'AVAILABLE'
+        else:
+            daq = 'SIMULATED'
 
         status = "\n {} | {} | nidaqmx {}".format(cam, ar, daq)
         
@@ -592,6 +733,15 @@ class GonioImsoftTUI:
             return True
 
 
+    def _image_series(self):
+        '''Runs the core's image_series, telling if a server is down.
+        '''
+        try:
+            self.core.image_series(inter_loop_callback=self.image_series_callback)
+        except ServerDownError as e:
+            self.libui.print(f'Imaging cancelled: {e}')
+
+
     def loop_dynamic(self, static=False, camera=True):
         '''
         Running the dynamic imaging protocol.
@@ -668,7 +818,7 @@ class GonioImsoftTUI:
             if static:
                 if trigger and self.core.trigger_rotation:
                     if camera:
-                        self.core.image_series(inter_loop_callback=self.image_series_callback)
+                        self._image_series()
                     else:
                         self.core.send_trigger()
                 if key == ' ':
@@ -677,7 +827,7 @@ class GonioImsoftTUI:
             else:
                 if key == ' ':
                     if camera:
-                        self.core.image_series(inter_loop_callback=self.image_series_callback)
+                        self._image_series()
                     else:
                         self.core.send_trigger()
             
@@ -687,15 +837,16 @@ class GonioImsoftTUI:
                 self.core.set_zero()
             elif key == 's':
                 if camera:
-                    self.core.take_snap(save=True)
+                    try:
+                        self.core.take_snap(save=True)
+                    except ServerDownError as e:
+                        self.libui.print(f'No snap taken: {e}')
             elif key in ['\r', '\n']:
                 # If user hits enter we'll exit
-                time.sleep(0.5)
-                self.core.do_trigger()
+                self.core.release_cameras()
                 break
             elif key == 'e':
-                time.sleep(0.5)
-                self.core.do_trigger()
+                self.core.release_cameras()
                 
                 if self.core.initialize(name, sex, age, camera=camera, libui=self.libui) is None:
                     continue
@@ -718,8 +869,7 @@ class GonioImsoftTUI:
                     self.core.motors[2].move_raw(1)
             elif key == '`':
                 
-                time.sleep(0.5)
-                self.core.do_trigger()
+                self.core.release_cameras()
                 
                 user_input = self.libui.input("Type command >> ", '')
                 if user_input is None:
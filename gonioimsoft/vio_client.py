@@ -6,6 +6,8 @@ class VIOClient(ClientBase):
     '''Analog voltage input/output client.
     '''
 
+    server_type = 'vio'
+
     def __init__(self, host=None, port=None, running_index=0):
 
         if host is None:
@@ -13,6 +15,7 @@ class VIOClient(ClientBase):
         if port is None:
             port = int(VIO_PORT)
         super().__init__(host, port)
+        self._settings = None
 
 
     def analog_input(self, duration, save=None, wait_trigger=False):
@@ -27,12 +30,19 @@ class VIOClient(ClientBase):
     def set_settings(self, device, channels, fs):
         '''Configures the setttings in use.
         '''
+        self._settings = (device, channels, fs)
         self.send_command(
                 f'set_settings;{device}:{channels}:{fs}')
         
     
-    def start_server(self):
-        super().start_server('vio')
+    def on_restart(self):
+        '''Reapplies the settings after a server restart.
+        '''
+        if self._settings is not None:
+            self.set_settings(*self._settings)
+
+    def start_server(self, wait=True):
+        super().start_server('vio', wait=wait)
        
 
 def main():
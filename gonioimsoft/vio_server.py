@@ -2,24 +2,29 @@
 '''
 
 import os
+import argparse
 import multiprocessing
+import importlib.util
 
 import numpy as np
-import matplotlib.pyplot as plt
 
-try:
-    import nidaqmx
-except ImportError:
-    nidaqmx = None
+# The heavy modules (nidaqmx and matplotlib) are imported only when
+# first needed so that the server starts up fast.
+if importlib.util.find_spec('nidaqmx') is None:
     print('nidaqmx not available')
+    HAS_NIDAQMX = False
+else:
+    HAS_NIDAQMX = True
 
 from .common import VIO_PORT
-from .serverbase import ServerBase
+from .daq import NIBackend, SimulatedBackend
+from .serverbase import ServerBase, wait_spare_assignment
 
 
 class Plotter:
          
     def loop(self, queue, title):
+        import matplotlib.pyplot as plt
         
         fig = plt.figure()
         ax = fig.add_subplot(111)
@@ -52,17 +57,26 @@ class DummyBoard:
 
     For documentation, see the NIBoard class.
     '''
-    def analog_input(self, duration, wait_trigger=False):
+    def analog_input(self, duration, save=None, wait_trigger=False):
         print('DummyBoard.analog_input(...)')
-        print(f'dur={duration} | wait_trigger={wait_trigger}')
+        print(f'dur={duration} | save={save} | wait_trigger={wait_trigger}')
 
     def set_settings(self, device, channels, fs):
         print('DummyBoard.set_settings(...)')
         print(f'dvs={device} | chs={channels} | fs={fs}')
 
 class NIBoard:
-    def __init__(self):
+    '''Analog input from an NI board.
+
+    Arguments
+    ---------
+    backend : obj or None
+        NIBackend or SimulatedBackend (see daq.py). If None, makes a
+        NIBackend when the first recording is done.
+    '''
+    def __init__(self, backend=None):
 
+        self.backend = backend
         self.device = 'Dev2'
         self.channels = ['ai0']
         self.fs = 1000
@@ -113,23 +127,21 @@ class NIBoard:
         else:
             wait_trigger = False
 
+        if self.backend is None:
+            self.backend = NIBackend()
 
-        with nidaqmx.Task() as task:
-            
-            for channel in self.channels:
-                task.ai_channels.add_ai_voltage_chan(f'{self.device}/{channel}')
-
-            task.timing.cfg_samp_clk_timing(
-                    self.fs, samps_per_chan=N_samples)
-            task.ai_conv_rate = self.fs
-            if wait_trigger:
-                task.triggers.start_trigger.cfg_dig_edge_start_trig(
-                        f'/{self.device}/PFI0')
-
+        task = self.backend.create_task(
+                'ai', [f'{self.device}/{channel}' for channel in self.channels],
+                self.fs, N_samples,
+                trigger='rising' if wait_trigger else None,
+                trigger_source=f'/{self.device}/PFI0')
+        try:
             task.start()
 
             data = task.read(
                 timeout=timeout, number_of_samples_per_channel=N_samples)
+        finally:
+            task.close()
 
 
         if save is not None:
@@ -167,13 +179,52 @@ class VIOServer(ServerBase):
 
 
 def main():
+
+    parser = argparse.ArgumentParser(
+            prog='GonioImsoft VIO Server',
+            description='Controls an analog input/output board')
+
+    parser.add_argument('-p', '--port')
+    parser.add_argument('-r', '--ready-port')
+    parser.add_argument('-b', '--board',
+            help='"ni", "sim" (simulated NI board) or "dummy"')
+    parser.add_argument('--spare', action='store_true',
+            help='Start as a spare server and wait for a port (needs --ready-port)')
+
+    args = parser.parse_args()
         
-    if nidaqmx is None:
+    if args.board == 'ni':
+        board = NIBoard()
+    elif args.board == 'sim':
+        board = NIBoard(SimulatedBackend(realtime=True))
+    elif args.board == 'dummy':
         board = DummyBoard()
     else:
-        board = NIBoard()
-
-    server = VIOServer(board)
+        # Default
+        if HAS_NIDAQMX:
+            board = NIBoard()
+        else:
+            board = DummyBoard()
+
+    ready_conn = None
+    if args.spare:
+        # Do the slow imports now, before anybody waits for us
+        if isinstance(board, NIBoard) and board.backend is None:
+            board.backend = NIBackend()
+        try:
+            ready_conn, args.port = wait_spare_assignment(int(args.ready_port))
+        except ConnectionError:
+            print('The spare was not taken into use')
+            return
+
+    if args.port:
+        args.port = int(args.port)
+
+    server = VIOServer(board, args.port)
+    if ready_conn is not None:
+        server.send_ready(conn=ready_conn)
+    elif args.ready_port:
+        server.send_ready(int(args.ready_port))
     server.run()
 
 